@@ -0,0 +1,39 @@
+"""
+AFM Control API client library by nano analytik GmbH
+
+Reusable building blocks for Python clients of the AFM Control WebSocket API. The example scripts in this
+directory are built on top of this package.
+"""
+
+from .client import AFMClient, is_stream_frame
+from .decoding import LineData, decode_array, decode_line, decode_map
+from .errors import AFMAuthenticationError, AFMConnectionError, AFMError
+from .frames import Command, decode_frame, frame_kind
+from .rendering import LinePlot, decimate_minmax
+from .recorder import ScanRecorder, open_scan, parse_resolution
+from .streams import BLOCK, COALESCE, DROP_OLDEST, StreamBuffer, StreamStats
+
+__all__ = [
+    "AFMClient",
+    "AFMError",
+    "AFMAuthenticationError",
+    "AFMConnectionError",
+    "is_stream_frame",
+    "Command",
+    "decode_frame",
+    "frame_kind",
+    "LineData",
+    "decode_array",
+    "decode_line",
+    "decode_map",
+    "ScanRecorder",
+    "open_scan",
+    "parse_resolution",
+    "LinePlot",
+    "decimate_minmax",
+    "StreamBuffer",
+    "StreamStats",
+    "DROP_OLDEST",
+    "COALESCE",
+    "BLOCK",
+]
@@ -0,0 +1,449 @@
+"""
+Multiprocess analysis of the line stream
+
+Analyses heavier than plotting (noise spectra, roughness per line, feature detection) must not run on the
+event loop that reads the socket: while they run, nothing is received. AnalysisPipeline runs them in a
+pool of worker processes instead:
+
+- every decoded line is copied into a slot of a ring of fixed-size slots in shared memory (no pickling
+  of the arrays); only the slot number is sent to the workers,
+- the workers run the registered stage functions on read-only views of the slot and send the results
+  back; a slot is reused once every stage has finished with it,
+- submit() never waits: when all slots are busy because the workers cannot keep up, the line is dropped
+  and counted instead of stalling the receive path,
+- results arrive asynchronously in a StreamBuffer (pipeline.results) and at the result handlers, on the
+  event loop of the pipeline,
+- per-stage counters (submitted, completed, failed, dropped, backlog, lines per second, worker time and
+  latency from submit to result) show which stage cannot keep up.
+
+Stage functions are called as function(line) with a LineData whose arrays are only valid during the call,
+and must return a picklable value. They must be defined at module level (or be functools.partial objects
+of such functions) so that the worker processes can import them:
+
+    pipeline = AnalysisPipeline(workers=4)
+    pipeline.add_stage("roughness", roughness)
+    pipeline.add_stage("spectrum", noise_spectrum)
+    async with pipeline:
+        pipeline.attach(client, channel=0)
+        async for result in pipeline.results:
+            print(result.stage, result.y_position, result.value)
+
+Usage:
+    python -m afm_api.analysis --uri ws://127.0.0.1:1234 --api-key KEY --channel 0 --duration 30
+
+Run from the examples/python directory.
+"""
+
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import threading
+import time
+from collections import deque, namedtuple
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from .client import AFMClient
+from .correction import line_leveler
+from .decoding import LineData, decode_line
+from .streams import DROP_OLDEST, StreamBuffer
+
+logger = logging.getLogger(__name__)
+
+# Slot header: channel (-1 for None), y_position, number of points
+_HEADER = 3
+
+AnalysisResult = namedtuple("AnalysisResult",
+                            ("stage", "channel", "y_position", "value", "error", "worker_time", "latency"))
+
+
+class LineRing:
+    """Fixed number of line slots (x, y_forward, y_backward of up to max_points) in one shared memory block."""
+
+    def __init__(self, slots, max_points, name=None):
+        self.slots = slots
+        self.max_points = max_points
+        self.slot_size = _HEADER + 3 * max_points
+        size = slots * self.slot_size * np.dtype(np.float64).itemsize
+        self.memory = shared_memory.SharedMemory(name=name, create=name is None, size=size)
+        self.array = np.ndarray((slots, self.slot_size), dtype=np.float64, buffer=self.memory.buf)
+
+    @property
+    def name(self):
+        return self.memory.name
+
+    def write(self, slot, line):
+        points = len(line)
+        if points > self.max_points:
+            raise ValueError(f"Line with {points} points does not fit slots of {self.max_points} points")
+        record = self.array[slot]
+        record[0] = -1 if line.channel is None else line.channel
+        record[1] = -1 if line.y_position is None else line.y_position
+        record[2] = points
+        start = _HEADER
+        for vector in (line.x, line.y_forward, line.y_backward):
+            record[start:start + points] = vector
+            start += self.max_points
+
+    def read(self, slot):
+        """LineData with read-only views into the slot."""
+        record = self.array[slot]
+        points = int(record[2])
+        vectors = []
+        start = _HEADER
+        for _ in range(3):
+            vector = record[start:start + points]
+            vector.flags.writeable = False
+            vectors.append(vector)
+            start += self.max_points
+        channel = None if record[0] < 0 else int(record[0])
+        y_position = None if record[1] < 0 else int(record[1])
+        return LineData(channel, "Measurement Data", y_position, "shared", *vectors)
+
+    def close(self, unlink=False):
+        # Views into the buffer must be released before the memory can be closed
+        self.array = None
+        self.memory.close()
+        if unlink:
+            self.memory.unlink()
+
+
+def _worker(ring_name, slots, max_points, functions, tasks, results):
+    ring = LineRing(slots, max_points, ring_name)
+    try:
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            slot, stage = task
+            line = ring.read(slot)
+            started = time.thread_time()
+            try:
+                value, error = functions[stage](line), None
+            except Exception as e:
+                value, error = None, f"{type(e).__name__}: {e}"
+            del line
+            results.put((slot, stage, value, error, time.thread_time() - started))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        ring.close()
+
+
+class StageStats:
+    __slots__ = ("submitted", "completed", "failed", "dropped", "worker_time", "latency_total", "latency_max",
+                 "started")
+
+    def __init__(self):
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.dropped = 0
+        self.worker_time = 0.0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.started = time.monotonic()
+
+    @property
+    def backlog(self):
+        """Lines submitted to the stage and not finished yet."""
+        return self.submitted - self.completed - self.failed
+
+    def as_dict(self):
+        finished = self.completed + self.failed
+        elapsed = time.monotonic() - self.started
+        return {
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "failed": self.failed,
+            "dropped": self.dropped,
+            "backlog": self.backlog,
+            "lines_per_second": finished / elapsed if elapsed > 0 else 0.0,
+            "worker_ms_mean": 1e3 * self.worker_time / finished if finished else None,
+            "latency_ms_mean": 1e3 * self.latency_total / finished if finished else None,
+            "latency_ms_max": 1e3 * self.latency_max,
+        }
+
+
+class AnalysisPipeline:
+    """
+    Pool of worker processes running registered analysis stages on every submitted line.
+
+    slots is the number of lines that can be in the workers at the same time, max_points the longest line.
+    start(), submit() and the result delivery belong to the event loop that called start().
+    """
+
+    def __init__(self, workers=None, slots=64, max_points=2048, results_maxlen=1024, context=None):
+        self.workers = workers or max(1, multiprocessing.cpu_count() - 1)
+        self.slots = slots
+        self.max_points = max_points
+        self.results = StreamBuffer("result", None, results_maxlen, DROP_OLDEST)
+        self.stages = {}
+        self.stats = {}
+        self._context = context or multiprocessing.get_context()
+        self._functions = []
+        self._stage_names = []
+        self._result_handlers = []
+        self._ring = None
+        self._processes = []
+        self._tasks = None
+        self._results_queue = None
+        self._result_thread = None
+        self._loop = None
+        self._free = deque()
+        # Per slot: stages still working on it, and (channel, y_position, submit time) of its line
+        self._references = [0] * slots
+        self._lines = [None] * slots
+        self._attached = []
+
+    @property
+    def running(self):
+        return self._ring is not None
+
+    def add_stage(self, name, function):
+        """Register function(line) -> value as a stage. Stages must be added before start()."""
+        if self.running:
+            raise RuntimeError("Stages must be added before the pipeline is started")
+        if name in self.stages:
+            raise ValueError(f"Stage {name!r} already exists")
+        self.stages[name] = len(self._functions)
+        self._stage_names.append(name)
+        self._functions.append(function)
+        self.stats[name] = StageStats()
+
+    def add_result_handler(self, handler):
+        """Call handler(AnalysisResult) on the event loop for every result."""
+        self._result_handlers.append(handler)
+
+    def remove_result_handler(self, handler):
+        if handler in self._result_handlers:
+            self._result_handlers.remove(handler)
+
+    # Lifecycle
+
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.stop()
+
+    def start(self):
+        """Create the shared memory ring and start the worker processes. Call from the event loop."""
+        if self.running:
+            return
+        if not self._functions:
+            raise RuntimeError("No analysis stages registered")
+        self._loop = asyncio.get_running_loop()
+        self._ring = LineRing(self.slots, self.max_points)
+        self._free = deque(range(self.slots))
+        self._tasks = self._context.Queue()
+        self._results_queue = self._context.Queue()
+        self._processes = [
+            self._context.Process(target=_worker, name=f"afm-analysis-{index}", daemon=True,
+                                  args=(self._ring.name, self.slots, self.max_points, self._functions,
+                                        self._tasks, self._results_queue))
+            for index in range(self.workers)
+        ]
+        for process in self._processes:
+            process.start()
+        self._result_thread = threading.Thread(target=self._receive_results, name="afm-analysis-results",
+                                               daemon=True)
+        self._result_thread.start()
+        for stats in self.stats.values():
+            stats.started = time.monotonic()
+
+    async def stop(self, timeout=5.0):
+        """Let the workers finish the queued lines, stop them and release the shared memory."""
+        if not self.running:
+            return
+        for client, handler in self._attached:
+            client.remove_frame_handler(handler)
+        self._attached.clear()
+        for _ in self._processes:
+            self._tasks.put(None)
+        await asyncio.get_running_loop().run_in_executor(None, self._join, timeout)
+        self._results_queue.put(None)
+        await asyncio.get_running_loop().run_in_executor(None, self._result_thread.join, timeout)
+        # Deliver the results handed to the loop by the thread
+        await asyncio.sleep(0)
+        self._tasks.close()
+        self._results_queue.close()
+        self._ring.close(unlink=True)
+        self._ring = None
+        self._processes = []
+        self.results.close()
+
+    def _join(self, timeout):
+        deadline = time.monotonic() + timeout
+        for process in self._processes:
+            process.join(max(deadline - time.monotonic(), 0))
+            if process.is_alive():
+                logger.warning("Analysis worker %s did not stop, terminating it", process.name)
+                process.terminate()
+                process.join()
+
+    # Input
+
+    def submit(self, line):
+        """
+        Hand a LineData to all stages without waiting. Returns False if the line was dropped because every
+        slot is still in use.
+        """
+        if len(line) > self.max_points:
+            raise ValueError(f"Line with {len(line)} points is longer than max_points={self.max_points}")
+        if not self._free:
+            for stats in self.stats.values():
+                stats.dropped += 1
+            return False
+        slot = self._free.popleft()
+        self._ring.write(slot, line)
+        self._references[slot] = len(self._functions)
+        self._lines[slot] = (line.channel, line.y_position, time.monotonic())
+        for name, stage in self.stages.items():
+            self.stats[name].submitted += 1
+            self._tasks.put((slot, stage))
+        return True
+
+    def attach(self, client, channel=None):
+        """Submit every streamed line of the client (of one channel, or all) as it arrives."""
+        def on_frame(data):
+            payload = data.get("payload") or {}
+            if data.get("object") != "MeasurementDataSubscription" or payload.get("type") != "line":
+                return
+            if not isinstance(payload.get("value"), dict):
+                return
+            if channel is None or payload.get("channel") == channel:
+                self.submit(decode_line(payload))
+
+        client.add_frame_handler(on_frame)
+        self._attached.append((client, on_frame))
+
+    # Results
+
+    def _receive_results(self):
+        # Runs in a thread: waits for results of the workers and hands them to the event loop
+        while True:
+            message = self._results_queue.get()
+            if message is None:
+                break
+            try:
+                self._loop.call_soon_threadsafe(self._on_result, message, time.monotonic())
+            except RuntimeError:
+                # The event loop is closed
+                break
+
+    def _on_result(self, message, received):
+        slot, stage, value, error, worker_time = message
+        name = self._stage_names[stage]
+        stats = self.stats[name]
+        channel, y_position, submitted = self._lines[slot]
+        latency = received - submitted
+        if error is None:
+            stats.completed += 1
+        else:
+            stats.failed += 1
+        stats.worker_time += worker_time
+        stats.latency_total += latency
+        stats.latency_max = max(stats.latency_max, latency)
+        self._references[slot] -= 1
+        if self._references[slot] == 0:
+            self._free.append(slot)
+        result = AnalysisResult(name, channel, y_position, value, error, worker_time, latency)
+        self.results.put_nowait(result)
+        for handler in list(self._result_handlers):
+            try:
+                handler(result)
+            except Exception:
+                logger.exception("Error in analysis result handler")
+
+    def snapshot(self):
+        """Counters per stage and the use of the shared memory ring."""
+        return {
+            "workers": self.workers,
+            "slots": self.slots,
+            "slots_in_use": self.slots - len(self._free) if self.running else 0,
+            "results_dropped": self.results.stats.dropped,
+            "stages": {name: stats.as_dict() for name, stats in self.stats.items()},
+        }
+
+
+# Analysis functions for the workers
+
+def roughness(line):
+    """Roughness of the tilt-corrected forward trace: Ra (mean absolute), Rq (RMS) and Rt (peak to valley)."""
+    y = line_leveler(len(line))(line.y_forward)
+    y = y[~np.isnan(y)]
+    if not len(y):
+        return None
+    y = y - y.mean()
+    return {"Ra": float(np.abs(y).mean()), "Rq": float(np.sqrt((y * y).mean())), "Rt": float(np.ptp(y))}
+
+
+def noise_spectrum(line):
+    """Dominant spatial frequency (1/µm) and its amplitude in the tilt-corrected forward trace."""
+    y = np.nan_to_num(line_leveler(len(line))(line.y_forward))
+    if len(y) < 4:
+        return None
+    spacing = (line.x[-1] - line.x[0]) / (len(y) - 1) if line.x[-1] != line.x[0] else 1.0
+    amplitudes = np.abs(np.fft.rfft(y * np.hanning(len(y)))) * 4 / len(y)
+    frequencies = np.fft.rfftfreq(len(y), spacing)
+    peak = int(np.argmax(amplitudes[1:])) + 1
+    return {"frequency": float(frequencies[peak]), "amplitude": float(amplitudes[peak]),
+            "rms": float(np.sqrt(np.mean(y * y)))}
+
+
+def detect_features(line, threshold=5.0):
+    """
+    Positions (x) of points of the tilt-corrected forward trace that deviate from the median by more than
+    threshold times the robust standard deviation (1.4826 * median absolute deviation).
+    """
+    y = line_leveler(len(line))(line.y_forward)
+    deviation = y - np.nanmedian(y)
+    sigma = 1.4826 * np.nanmedian(np.abs(deviation))
+    if not sigma:
+        return []
+    return np.asarray(line.x)[np.abs(deviation) > threshold * sigma].tolist()
+
+
+STAGES = {"roughness": roughness, "spectrum": noise_spectrum, "features": detect_features}
+
+
+async def run(args):
+    pipeline = AnalysisPipeline(workers=args.workers, max_points=args.max_points)
+    for name in args.stages:
+        pipeline.add_stage(name, STAGES[name])
+    async with AFMClient(args.uri, args.api_key) as client, pipeline:
+        pipeline.attach(client, args.channel)
+        await client.subscribe_measurement_data(args.channel, "line", "base64")
+        started = time.monotonic()
+        try:
+            while True:
+                remaining = args.duration - (time.monotonic() - started)
+                if remaining <= 0:
+                    break
+                try:
+                    result = await asyncio.wait_for(pipeline.results.get(), remaining)
+                except asyncio.TimeoutError:
+                    break
+                print(f"line {result.y_position} {result.stage}: {result.error or result.value}")
+        finally:
+            print(pipeline.snapshot())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--uri", default="ws://127.0.0.1:1234")
+    parser.add_argument("--api-key", default="AFM-Control-API-Key")
+    parser.add_argument("--channel", type=int, default=0)
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds to analyse")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: CPUs - 1)")
+    parser.add_argument("--max-points", type=int, default=2048, help="longest line in points")
+    parser.add_argument("--stages", nargs="+", choices=sorted(STAGES), default=sorted(STAGES))
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,625 @@
+"""
+Title: Local stream broker for the AFM Control API
+
+Description:
+Every tool that shows or records live data (plotter, recorder, QA scripts) would otherwise open its own
+connection to AFM Control and subscribe to the same channels again, and the instrument PC serializes every
+line once per connection. StreamBroker holds one authenticated upstream connection instead and serves any
+number of local consumers:
+
+- consumers connect to the broker over a local WebSocket (TCP on localhost, or a Unix socket) and speak the
+  same API v1.1 as the server, so AFMClient and the example scripts work unchanged. The API key of the
+  instrument stays in the broker; local consumers can be given a key of their own,
+- line, map and log subscriptions are reference counted: the first consumer of a channel subscribes
+  upstream, the last one to leave unsubscribes. Upstream data is requested in one format (base64 by
+  default); each frame is decoded once and encoded once per format the consumers asked for, then queued
+  to every subscriber. A slow consumer loses its oldest frames (DROP_OLDEST) and never holds up the others,
+- get requests are forwarded over the shared connection; identical gets in flight at the same time are
+  sent upstream only once,
+- set requests are forwarded in arrival order over the same connection. Only one consumer at a time may
+  control the instrument: the first one to send a set holds control until it disconnects or has not sent a
+  set for control_lease seconds; sets of other consumers meanwhile get a "Control denied" error. With
+  read_only=True every set except subscriptions is refused,
+- with share_lines(), decoded lines are also written to a ring of slots in shared memory, which consumers on
+  the same machine read with SharedLineReader without any socket or JSON decoding.
+
+The upstream connection reconnects automatically and replays the subscriptions.
+
+Usage:
+    python -m afm_api.broker --uri ws://192.168.1.10:1234 --api-key KEY --port 1235
+    python -m afm_api.broker --uri ws://192.168.1.10:1234 --api-key KEY --unix /tmp/afm.sock \\
+        --shared-memory afm_lines --channels 0 1
+
+Consumers then connect to ws://127.0.0.1:1235 (any API key unless --local-api-key is given), or with
+AFMClient("ws://localhost", key, unix_path="/tmp/afm.sock").
+
+Run from the examples/python directory.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import sys
+import time
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+import websockets
+
+from .client import AFMClient, subscription_state
+from .decoding import LINE_VECTORS, LineData, decode_array
+from .errors import AFMConnectionError, AFMError
+from .frames import DATA, LOG, SUBSCRIPTION_OBJECTS, DecodeError, dumps, frame_kind, loads
+from .mock_server import encode_vector
+from .streams import DROP_OLDEST, StreamBuffer
+
+logger = logging.getLogger(__name__)
+
+FORMATS = ("float", "txt", "base64")
+
+# Subscription key of the log stream
+LOG_KEY = ("log", None)
+
+# Shared line ring: header of int64 values (slots, max_points, lines written) followed by one sequence number
+# per slot, then the slots of float64 values (channel, y_position, points, x, y_forward, y_backward)
+_RING_HEADER = 3
+_SLOT_HEADER = 3
+
+
+def error_frame(title, details="", obj=None):
+    frame = {"command": "error", "payload": {"title": title, "details": details}}
+    if obj:
+        frame["object"] = obj
+    return frame
+
+
+def decode_vectors(payload):
+    """Decode the vectors of a measurement frame's value once: {name: array} for x, y_forward, data, ..."""
+    source = payload.get("format", "float")
+    return {name: decode_array(item, source) for name, item in (payload.get("value") or {}).items()
+            if isinstance(item, list) or (source == "base64" and isinstance(item, str))}
+
+
+def convert_payload(payload, data_format, vectors=None):
+    """
+    Payload of a measurement frame with its vectors re-encoded in another subscription format. vectors are
+    the decoded vectors of the payload from decode_vectors(), if they are known already.
+    """
+    if vectors is None:
+        vectors = decode_vectors(payload)
+    value = dict(payload["value"])
+    for name, array in vectors.items():
+        value[name] = encode_vector(array, data_format)
+    return dict(payload, format=data_format, value=value)
+
+
+def line_from_vectors(payload, vectors):
+    """LineData of a "line" frame from its decoded vectors, as decode_line() returns it."""
+    value = payload.get("value") or {}
+    y_position = value.get("y_position", payload.get("y_position"))
+    empty = np.empty(0)
+    return LineData(payload.get("channel"), payload.get("signal", "Measurement Data"),
+                    None if y_position is None else int(y_position), payload.get("format", "float"),
+                    *(vectors.get(name, empty) for name in LINE_VECTORS))
+
+
+class SharedLineRing:
+    """
+    Ring of line slots in a named shared memory block, written by the broker and read by SharedLineReader
+    in other processes. Every slot carries the number of the line it holds, so a reader can tell lines that
+    were overwritten before (or while) it read them.
+    """
+
+    def __init__(self, name, slots=256, max_points=2048, create=True):
+        if create:
+            slot_size = _SLOT_HEADER + 3 * max_points
+            size = (_RING_HEADER + slots) * 8 + slots * slot_size * 8
+            self.memory = shared_memory.SharedMemory(name=name, create=True, size=size)
+        else:
+            self.memory = _attach_untracked(name)
+            slots, max_points = (int(v) for v in np.ndarray((2,), dtype=np.int64, buffer=self.memory.buf))
+        self.slots = slots
+        self.max_points = max_points
+        self.slot_size = _SLOT_HEADER + 3 * max_points
+        self.header = np.ndarray((_RING_HEADER + slots,), dtype=np.int64, buffer=self.memory.buf)
+        self.sequence = self.header[_RING_HEADER:]
+        self.array = np.ndarray((slots, self.slot_size), dtype=np.float64, buffer=self.memory.buf,
+                                offset=(_RING_HEADER + slots) * 8)
+        if create:
+            self.header[:] = 0
+            self.header[0] = slots
+            self.header[1] = max_points
+            self.sequence[:] = -1
+
+    @property
+    def name(self):
+        return self.memory.name
+
+    @property
+    def written(self):
+        return int(self.header[2])
+
+    def write(self, line):
+        points = len(line)
+        if points > self.max_points:
+            raise ValueError(f"Line with {points} points does not fit slots of {self.max_points} points")
+        number = int(self.header[2])
+        slot = number % self.slots
+        # Marked as being written, so that readers do not take a half written slot
+        self.sequence[slot] = -1
+        record = self.array[slot]
+        record[0] = -1 if line.channel is None else line.channel
+        record[1] = -1 if line.y_position is None else line.y_position
+        record[2] = points
+        start = _SLOT_HEADER
+        for vector in (line.x, line.y_forward, line.y_backward):
+            record[start:start + points] = vector
+            start += self.max_points
+        self.sequence[slot] = number
+        self.header[2] = number + 1
+
+    def read(self, number):
+        """Copy of line number as LineData, or None if it is no longer (or not yet) in the ring."""
+        slot = number % self.slots
+        if self.sequence[slot] != number:
+            return None
+        record = self.array[slot].copy()
+        if self.sequence[slot] != number:
+            return None
+        points = int(record[2])
+        start = _SLOT_HEADER
+        vectors = []
+        for _ in range(3):
+            vectors.append(record[start:start + points])
+            start += self.max_points
+        channel = None if record[0] < 0 else int(record[0])
+        y_position = None if record[1] < 0 else int(record[1])
+        return LineData(channel, "Measurement Data", y_position, "shared", *vectors)
+
+    def close(self, unlink=False):
+        # Views into the buffer must be released before the memory can be closed
+        self.header = self.sequence = self.array = None
+        self.memory.close()
+        if unlink:
+            self.memory.unlink()
+
+
+def _attach_untracked(name):
+    # A process that only attaches must not unlink the block when it exits, see bpo-39959
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    memory = shared_memory.SharedMemory(name=name)
+    resource_tracker.unregister(memory._name, "shared_memory")
+    return memory
+
+
+class SharedLineReader:
+    """
+    Reads the lines a StreamBroker shares with share_lines(), from any process on the same machine:
+
+        reader = SharedLineReader("afm_lines")
+        for line in reader.read():
+            ...
+
+    read() returns the lines written since the previous call, oldest first. Lines that were overwritten
+    before the reader got to them are counted in missed.
+    """
+
+    def __init__(self, name, channel=None):
+        self.ring = SharedLineRing(name, create=False)
+        self.channel = channel
+        # Start with the lines written from now on
+        self.cursor = self.ring.written
+        self.missed = 0
+
+    def read(self, max_lines=None):
+        written = self.ring.written
+        first = max(self.cursor, written - self.ring.slots)
+        self.missed += first - self.cursor
+        if max_lines is not None:
+            written = min(written, first + max_lines)
+        lines = []
+        for number in range(first, written):
+            line = self.ring.read(number)
+            if line is None:
+                self.missed += 1
+            elif self.channel is None or line.channel == self.channel:
+                lines.append(line)
+        self.cursor = written
+        return lines
+
+    def close(self):
+        self.ring.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class _Consumer:
+    """A local connection of the broker with its subscriptions and queue of streamed frames."""
+
+    def __init__(self, websocket, maxlen):
+        self.websocket = websocket
+        address = websocket.remote_address
+        self.peer = f"{address[0]}:{address[1]}" if isinstance(address, tuple) else "unix socket"
+        self.authenticated = False
+        # (type, channel) -> format, LOG_KEY -> "txt"
+        self.subscriptions = {}
+        self.frames = StreamBuffer("frames", maxlen=maxlen, policy=DROP_OLDEST)
+        self.requests = 0
+
+    async def send(self, data):
+        await self.websocket.send(data if isinstance(data, str) else dumps(data))
+
+    async def run_sender(self):
+        try:
+            async for message in self.frames:
+                await self.websocket.send(message)
+        except websockets.ConnectionClosed:
+            pass
+
+    def as_dict(self):
+        stats = self.frames.stats
+        return {"peer": self.peer, "subscriptions": [list(key) + [f] for key, f in self.subscriptions.items()],
+                "requests": self.requests, "frames": stats.received, "dropped": stats.dropped,
+                "queued": len(self.frames)}
+
+
+class StreamBroker:
+    """One upstream AFMClient shared by many local consumers, see the module docstring."""
+
+    def __init__(self, uri, api_key, host="127.0.0.1", port=1235, unix_path=None, local_api_key=None,
+                 upstream_format="base64", maxlen=256, read_only=False, control_lease=30.0, timeout=5.0):
+        if upstream_format not in FORMATS:
+            raise ValueError(f"Unknown format {upstream_format!r}, expected one of {FORMATS}")
+        self.host = host
+        self.port = port
+        self.unix_path = unix_path
+        self.local_api_key = local_api_key
+        self.upstream_format = upstream_format
+        self.maxlen = maxlen
+        self.read_only = read_only
+        self.control_lease = control_lease
+        self.upstream = AFMClient(uri, api_key, timeout=timeout, reconnect=True)
+
+        self.consumers = set()
+        # Subscription key -> consumers, and the task of the upstream subscription of each key
+        self._subscribers = {}
+        self._upstream_tasks = {}
+        self._unsubscribe_tasks = {}
+        # Single-flight gets: (object, payload) -> future of the upstream reply
+        self._gets = {}
+        self._controller = None
+        self._control_expires = 0.0
+        self._ring = None
+        self._ring_channels = ()
+        self._server = None
+
+        self.frames_received = 0
+        self.requests_forwarded = 0
+        self.gets_shared = 0
+        self.control_denied = 0
+
+    @property
+    def uri(self):
+        return "ws://localhost" if self.unix_path else f"ws://{self.host}:{self.port}"
+
+    @property
+    def controller(self):
+        """Peer name of the consumer in control of the instrument, or None."""
+        if self._controller is None or time.monotonic() >= self._control_expires:
+            return None
+        return self._controller.peer
+
+    # Lifecycle
+
+    async def start(self):
+        await self.upstream.connect()
+        self.upstream.add_frame_handler(self._on_frame)
+        if self.unix_path:
+            self._server = await websockets.unix_serve(self._handler, self.unix_path, max_size=None)
+        else:
+            self._server = await websockets.serve(self._handler, self.host, self.port, max_size=None)
+            # Pick up the actual port when port 0 was requested
+            self.port = list(self._server.sockets)[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        await self.upstream.close()
+        if self._ring is not None:
+            self._ring.close(unlink=True)
+            self._ring = None
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.stop()
+
+    async def serve_forever(self):
+        await self.start()
+        try:
+            await asyncio.Future()
+        finally:
+            await self.stop()
+
+    async def share_lines(self, name, channels=(0,), slots=256, max_points=2048):
+        """
+        Subscribe to the lines of channels for as long as the broker runs and write every decoded line to
+        the shared memory ring name, for SharedLineReader. Returns the SharedLineRing.
+        """
+        self._ring = SharedLineRing(name, slots, max_points)
+        self._ring_channels = tuple(channels)
+        for channel in self._ring_channels:
+            await self._acquire(("line", channel))
+        return self._ring
+
+    def snapshot(self):
+        return {
+            "upstream_connected": self.upstream.connected,
+            "upstream_reconnects": self.upstream.reconnects,
+            "frames_received": self.frames_received,
+            "upstream_subscriptions": sorted(map(list, self._upstream_tasks), key=str),
+            "requests_forwarded": self.requests_forwarded,
+            "gets_shared": self.gets_shared,
+            "control_denied": self.control_denied,
+            "controller": self.controller,
+            "shared_lines": self._ring.written if self._ring is not None else None,
+            "consumers": [consumer.as_dict() for consumer in self.consumers],
+        }
+
+    # Fan-out of upstream frames
+
+    def _on_frame(self, data):
+        kind = frame_kind(data)
+        # Vectors of a measurement frame, decoded at most once for the ring and all formats
+        vectors = None
+        if kind is DATA:
+            payload = data["payload"]
+            key = (payload.get("type"), payload.get("channel"))
+            if self._ring is not None and key[0] == "line" and key[1] in self._ring_channels:
+                try:
+                    vectors = decode_vectors(payload)
+                    self._ring.write(line_from_vectors(payload, vectors))
+                except ValueError as e:
+                    logger.warning("Line not shared: %s", e)
+        elif kind is LOG:
+            key = LOG_KEY
+        else:
+            return
+        self.frames_received += 1
+        consumers = self._subscribers.get(key)
+        if not consumers:
+            return
+        # Encoded once per format, whatever the number of consumers
+        messages = {}
+        for consumer in consumers:
+            data_format = consumer.subscriptions.get(key)
+            message = messages.get(data_format)
+            if message is None:
+                if kind is DATA and data_format != data["payload"].get("format", "float"):
+                    if vectors is None:
+                        vectors = decode_vectors(data["payload"])
+                    message = dumps(dict(data, payload=convert_payload(data["payload"], data_format, vectors)))
+                else:
+                    message = dumps(data)
+                messages[data_format] = message
+            consumer.frames.put_nowait(message)
+
+    # Upstream subscriptions
+
+    async def _acquire(self, key):
+        task = self._upstream_tasks.get(key)
+        if task is None:
+            task = self._upstream_tasks[key] = asyncio.ensure_future(self._subscribe_upstream(key, True))
+        try:
+            await asyncio.shield(task)
+        except Exception:
+            if self._upstream_tasks.get(key) is task:
+                del self._upstream_tasks[key]
+            raise
+
+    def _release(self, consumer, key):
+        consumers = self._subscribers.get(key)
+        if consumers is not None:
+            consumers.discard(consumer)
+        if consumers or (key[0] == "line" and key[1] in self._ring_channels and self._ring is not None):
+            return
+        self._subscribers.pop(key, None)
+        if self._upstream_tasks.pop(key, None) is not None and self.upstream.connected:
+            self._unsubscribe_tasks[key] = asyncio.ensure_future(self._subscribe_upstream(key, False))
+
+    async def _subscribe_upstream(self, key, subscribed):
+        pending = self._unsubscribe_tasks.get(key)
+        if subscribed and pending is not None:
+            await asyncio.gather(pending, return_exceptions=True)
+        try:
+            if key == LOG_KEY:
+                await self.upstream.subscribe_log(subscribed)
+            else:
+                await self.upstream.subscribe_measurement_data(key[1], key[0], self.upstream_format, subscribed)
+            logger.info("Upstream %s %s", "subscribed to" if subscribed else "unsubscribed from", key)
+        except (AFMError, AFMConnectionError, asyncio.TimeoutError) as e:
+            if subscribed:
+                raise
+            logger.warning("Unsubscribing %s upstream failed: %s", key, e)
+        finally:
+            if not subscribed and self._unsubscribe_tasks.get(key) is asyncio.current_task():
+                del self._unsubscribe_tasks[key]
+
+    # Local consumers
+
+    async def _handler(self, websocket, path=None):
+        consumer = _Consumer(websocket, self.maxlen)
+        sender = asyncio.ensure_future(consumer.run_sender())
+        tasks = set()
+        self.consumers.add(consumer)
+        try:
+            async for message in websocket:
+                try:
+                    request = loads(message)
+                except DecodeError as e:
+                    await consumer.send(error_frame("Invalid JSON", str(e)))
+                    continue
+                if not consumer.authenticated:
+                    if request.get("command") != "authenticate" or (
+                            self.local_api_key is not None and request.get("apikey") != self.local_api_key):
+                        await consumer.send(error_frame("Authentication failed", "Invalid API key"))
+                        await websocket.close()
+                        return
+                    consumer.authenticated = True
+                    await consumer.send({"command": "response", "object": "authenticate",
+                                         "payload": {"status": "authenticated"}})
+                    continue
+                consumer.requests += 1
+                # Handled concurrently, so that consumers can pipeline their requests
+                task = asyncio.ensure_future(self._handle_request(consumer, request))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            self.consumers.discard(consumer)
+            for task in tasks:
+                task.cancel()
+            consumer.frames.close()
+            sender.cancel()
+            for key in list(consumer.subscriptions):
+                self._release(consumer, key)
+            if self._controller is consumer:
+                self._controller = None
+                logger.info("Control released by %s", consumer.peer)
+
+    async def _handle_request(self, consumer, request):
+        command = request.get("command")
+        obj = (request.get("object") or "").strip()
+        payload = request.get("payload") or {}
+        try:
+            if command not in ("get", "set"):
+                reply = error_frame("Unknown command", str(command))
+            elif obj in SUBSCRIPTION_OBJECTS:
+                reply = await self._subscription_request(consumer, command, obj, payload)
+            elif command == "get":
+                reply = await self._get(obj, payload)
+            else:
+                reply = await self._set(consumer, obj, payload)
+        except AFMError as e:
+            reply = error_frame(e.title, e.details, e.object or obj)
+        except (AFMConnectionError, asyncio.TimeoutError) as e:
+            reply = error_frame("Connection lost", f"Upstream connection: {e}", obj)
+        try:
+            await consumer.send(reply)
+        except websockets.ConnectionClosed:
+            pass
+
+    async def _get(self, obj, payload):
+        key = (obj, json.dumps(payload, sort_keys=True))
+        future = self._gets.get(key)
+        if future is None:
+            self.requests_forwarded += 1
+            future = self._gets[key] = asyncio.ensure_future(self.upstream.request("get", obj, payload))
+            future.add_done_callback(lambda _: self._gets.pop(key, None))
+        else:
+            self.gets_shared += 1
+        result = await asyncio.shield(future)
+        return {"command": "response", "object": obj, "payload": result}
+
+    async def _set(self, consumer, obj, payload):
+        if self.read_only:
+            self.control_denied += 1
+            return error_frame("Control denied", "The broker is read-only", obj)
+        holder = self.controller
+        if holder is not None and self._controller is not consumer:
+            self.control_denied += 1
+            return error_frame("Control denied", f"The instrument is controlled by {holder}", obj)
+        if self._controller is not consumer:
+            logger.info("Control taken by %s", consumer.peer)
+        self._controller = consumer
+        self._control_expires = time.monotonic() + self.control_lease
+        self.requests_forwarded += 1
+        result = await self.upstream.request("set", obj, payload)
+        return {"command": "response", "object": obj, "payload": result}
+
+    async def _subscription_request(self, consumer, command, obj, payload):
+        if command == "set":
+            key, subscribed = subscription_state(payload)
+            if key[0] == "log":
+                key, data_format = LOG_KEY, "txt"
+            else:
+                data_format = payload.get("format", "float")
+                if key[0] not in ("line", "map"):
+                    return error_frame("Invalid value", f"{obj}: unsupported type {key[0]!r}", obj)
+                if data_format not in FORMATS:
+                    return error_frame("Invalid value", f"{obj}: unsupported format {data_format!r}", obj)
+                key = (key[0], int(key[1] or 0))
+            if subscribed:
+                if key not in consumer.subscriptions:
+                    try:
+                        await self._acquire(key)
+                    except asyncio.CancelledError:
+                        # The consumer left while the upstream subscription was set up
+                        self._release(consumer, key)
+                        raise
+                    self._subscribers.setdefault(key, set()).add(consumer)
+                consumer.subscriptions[key] = data_format
+            elif consumer.subscriptions.pop(key, None) is not None:
+                self._release(consumer, key)
+        subscriptions = [{"channel": channel, "format": data_format, "type": data_type}
+                         for (data_type, channel), data_format in sorted(consumer.subscriptions.items(), key=str)
+                         if data_type != "log"]
+        if obj == "DataSubscription" and LOG_KEY in consumer.subscriptions:
+            subscriptions.append({"format": "txt", "type": "log"})
+        return {"command": "response", "object": obj, "payload": {"subscriptions": subscriptions}}
+
+
+async def run(args):
+    broker = StreamBroker(args.uri, args.api_key, args.host, args.port, args.unix, args.local_api_key,
+                          args.upstream_format, args.maxlen, args.read_only, args.control_lease)
+    async with broker:
+        if args.shared_memory:
+            await broker.share_lines(args.shared_memory, args.channels, args.slots, args.max_points)
+        print(f"Broker for {args.uri} serving on {args.unix or broker.uri}", flush=True)
+        while True:
+            await asyncio.sleep(args.stats or 3600)
+            if args.stats:
+                print(json.dumps(broker.snapshot()), flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--uri", default="ws://127.0.0.1:1234", help="URI of the AFM Control server")
+    parser.add_argument("--api-key", required=True, help="API key of the AFM Control server")
+    parser.add_argument("--host", default="127.0.0.1", help="local address to serve consumers on")
+    parser.add_argument("--port", type=int, default=1235, help="local port to serve consumers on")
+    parser.add_argument("--unix", help="serve consumers on this Unix socket instead of a TCP port")
+    parser.add_argument("--local-api-key", help="API key local consumers must send (default: any)")
+    parser.add_argument("--upstream-format", choices=FORMATS, default="base64",
+                        help="format of the upstream subscriptions")
+    parser.add_argument("--maxlen", type=int, default=256, help="frames queued per consumer before dropping")
+    parser.add_argument("--read-only", action="store_true", help="refuse all set requests except subscriptions")
+    parser.add_argument("--control-lease", type=float, default=30.0,
+                        help="seconds a consumer keeps control after its last set")
+    parser.add_argument("--shared-memory", help="share the decoded lines in this shared memory block")
+    parser.add_argument("--channels", type=int, nargs="+", default=[0], help="channels to share")
+    parser.add_argument("--slots", type=int, default=256, help="lines kept in shared memory")
+    parser.add_argument("--max-points", type=int, default=2048, help="points per shared line")
+    parser.add_argument("--stats", type=float, default=0, help="print statistics every N seconds")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    try:
+        asyncio.run(run(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
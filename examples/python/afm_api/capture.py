@@ -0,0 +1,232 @@
+"""
+Binary capture of WebSocket sessions
+
+A capture file holds every frame a client sent and received, with its monotonic time, so the exact traffic
+of a real scan can be replayed offline (see afm_api.replay_server) to reproduce and benchmark decoding,
+queueing and rendering.
+
+File layout (little-endian):
+
+    header:  8s magic b"AFMCAPT\\n", H version, H compression (0: none, 1: zstd), d wall clock start time
+    records: Q nanoseconds since the start, B direction, I length, then the frame (UTF-8 text, or bytes
+             for binary frames)
+
+Records are appended one after the other, so a capture that was cut off (e.g. by a crash) is readable up
+to its last complete record. With compression, the record stream after the header is one zstd stream;
+this needs the zstandard package (pip install zstandard).
+
+Captures are written by AFMClient.start_capture(). Authentication API keys are replaced with "***".
+
+Usage:
+    python -m afm_api.capture session.afmcap
+
+prints a summary of a capture. Run from the examples/python directory.
+"""
+
+import argparse
+import json
+import re
+import struct
+import time
+from collections import Counter, namedtuple
+
+MAGIC = b"AFMCAPT\n"
+VERSION = 1
+
+COMPRESSION_NONE = 0
+COMPRESSION_ZSTD = 1
+
+# Directions of a record
+RECEIVED = 0
+SENT = 1
+# Flag of binary WebSocket frames
+BINARY = 0x80
+
+_HEADER = struct.Struct("<8sHHd")
+_RECORD = struct.Struct("<QBI")
+_OBJECT_RE = re.compile(r'"object"\s*:\s*"([^"]*)"')
+
+Record = namedtuple("Record", ("time_ns", "direction", "message"))
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise RuntimeError("zstd compressed captures require the zstandard package (pip install zstandard)") \
+            from None
+    return zstandard
+
+
+def redact(message):
+    """Replace the API key of an authenticate command."""
+    if '"authenticate"' not in message:
+        return message
+    try:
+        data = json.loads(message)
+    except ValueError:
+        return message
+    if data.get("command") == "authenticate" and "apikey" in data:
+        data["apikey"] = "***"
+        return json.dumps(data)
+    return message
+
+
+class SessionWriter:
+    """Append-only writer of a capture file."""
+
+    def __init__(self, path, compress=False, flush_interval=1.0):
+        self.path = path
+        self.compress = compress
+        # Seconds between flushes of buffered records to the file
+        self.flush_interval = flush_interval
+        self.records = 0
+        self.bytes = 0
+        self._file = open(path, "wb")
+        self._file.write(_HEADER.pack(MAGIC, VERSION, COMPRESSION_ZSTD if compress else COMPRESSION_NONE,
+                                      time.time()))
+        self._compressor = None
+        if compress:
+            zstandard = _zstandard()
+            self._compressor = zstandard.ZstdCompressor(level=3).compressobj()
+            self._flush_block = zstandard.COMPRESSOBJ_FLUSH_BLOCK
+        self._started = time.monotonic_ns()
+        self._flushed = time.monotonic()
+
+    @property
+    def closed(self):
+        return self._file is None
+
+    def write(self, direction, message):
+        """Append one frame; message is the str (text frame) or bytes (binary frame) as sent on the wire."""
+        if self._file is None:
+            return
+        if isinstance(message, str):
+            data = message.encode("utf-8")
+        else:
+            data = bytes(message)
+            direction |= BINARY
+        record = _RECORD.pack(time.monotonic_ns() - self._started, direction, len(data)) + data
+        if self._compressor is not None:
+            record = self._compressor.compress(record)
+        self._file.write(record)
+        self.records += 1
+        self.bytes += len(data)
+        if time.monotonic() - self._flushed >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        if self._file is None:
+            return
+        if self._compressor is not None:
+            self._file.write(self._compressor.flush(self._flush_block))
+        self._file.flush()
+        self._flushed = time.monotonic()
+
+    def close(self):
+        if self._file is None:
+            return
+        if self._compressor is not None:
+            self._file.write(self._compressor.flush())
+        self._file.close()
+        self._file = None
+
+
+def _read(stream, size):
+    # Decompressing readers may return fewer bytes than requested before the end of the stream
+    data = stream.read(size)
+    while len(data) < size:
+        more = stream.read(size - len(data))
+        if not more:
+            break
+        data += more
+    return data
+
+
+class SessionReader:
+    """Iterates the Records of a capture file, in the order they were written."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            header = f.read(_HEADER.size)
+        if len(header) < _HEADER.size:
+            raise ValueError(f"{path} is not a capture file")
+        magic, self.version, self.compression, self.started = _HEADER.unpack(header)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a capture file")
+        if self.version > VERSION:
+            raise ValueError(f"Capture version {self.version} is not supported")
+        # Set when the last record was cut off
+        self.truncated = False
+
+    def _open(self):
+        f = open(self.path, "rb")
+        f.seek(_HEADER.size)
+        if self.compression == COMPRESSION_ZSTD:
+            zstandard = _zstandard()
+            return zstandard.ZstdDecompressor().stream_reader(f, closefd=True)
+        return f
+
+    def __iter__(self):
+        stream = self._open()
+        try:
+            while True:
+                try:
+                    header = _read(stream, _RECORD.size)
+                    if len(header) < _RECORD.size:
+                        self.truncated = bool(header)
+                        return
+                    time_ns, direction, length = _RECORD.unpack(header)
+                    data = _read(stream, length)
+                except Exception as e:
+                    # An incomplete zstd stream of a capture that was not closed
+                    if type(e).__name__ != "ZstdError":
+                        raise
+                    self.truncated = True
+                    return
+                if len(data) < length:
+                    self.truncated = True
+                    return
+                message = data if direction & BINARY else data.decode("utf-8")
+                yield Record(time_ns, direction & ~BINARY, message)
+        finally:
+            stream.close()
+
+    def summary(self):
+        """Counts, sizes and duration of the capture, and frames per object."""
+        counts = {RECEIVED: 0, SENT: 0}
+        sizes = {RECEIVED: 0, SENT: 0}
+        objects = Counter()
+        last = 0
+        for record in self:
+            counts[record.direction] += 1
+            sizes[record.direction] += len(record.message)
+            last = record.time_ns
+            if record.direction == RECEIVED and isinstance(record.message, str):
+                match = _OBJECT_RE.search(record.message, 0, 200)
+                if match:
+                    objects[match.group(1).strip()] += 1
+        return {
+            "path": self.path,
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S%z", time.localtime(self.started)),
+            "compression": "zstd" if self.compression == COMPRESSION_ZSTD else None,
+            "duration_s": round(last / 1e9, 3),
+            "received_frames": counts[RECEIVED],
+            "received_bytes": sizes[RECEIVED],
+            "sent_frames": counts[SENT],
+            "sent_bytes": sizes[SENT],
+            "truncated": self.truncated,
+            "received_by_object": dict(objects.most_common()),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("capture", help="capture file")
+    args = parser.parse_args()
+    print(json.dumps(SessionReader(args.capture).summary(), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,680 @@
+"""
+Asynchronous client for the AFM Control WebSocket API
+
+Compatible with API v1.0 and above
+
+The client owns one WebSocket connection and a single background reader task. Every incoming frame is
+read exactly once by that task and dispatched:
+
+- streamed frames (line/map data of MeasurementDataSubscription, LogEvent messages) go to the bounded
+  stream buffers returned by stream() and to the registered frame handlers,
+- "response" and "error" frames of set/get commands complete the future of the request that is waiting
+  for them.
+
+The AFM Control server does not echo a request id, so replies are correlated by object name and by order
+of issue: the n-th reply for "ScannerRange" belongs to the n-th pending request for "ScannerRange". Error
+frames that do not carry an object name are assigned to the oldest pending request.
+
+Because the reader task is the only consumer of the socket, requests do not have to wait for each other.
+Many set/get commands can be sent back-to-back and their replies collected afterwards, which replaces N
+sequential round trips with a single round-trip window:
+
+    async with AFMClient("ws://127.0.0.1:1234", api_key) as client:
+        await client.pipeline([
+            ("set", "ScannerRange", {"property": "value", "value": 10.0}),
+            ("set", "ScannerResolution", {"property": "index", "value": 1}),
+            ("set", "AFMPIDConstantP", {"property": "value", "value": 10}),
+            ("set", "AFMPIDConstantI", {"property": "value", "value": 290}),
+        ])
+
+With reconnect=True the client remembers the subscriptions set through it. When the connection drops, it
+reconnects with jittered exponential backoff and replays the authentication and all subscriptions in one
+pipelined burst. Line rows (y_position) that were streamed while the connection was down are reported to
+the missed rows handlers once the stream resumes, so recorders can flag or backfill them.
+
+Replies that are too large to decode as a whole (full MeasurementData images) can be requested with
+request_raw(), which hands the undecoded message to a parser, see afm_api.measurement_data.
+
+Frames are decoded and encoded by afm_api.frames, with msgspec or orjson when installed. Every frame is
+classified once on arrival; fixed commands (trigger(), get() of a plain property) are sent as cached text.
+
+start_capture() writes every frame sent and received to a capture file (see afm_api.capture), which
+afm_api.replay_server plays back for offline profiling.
+
+With parameter_cache=True, client.parameters (see afm_api.parameters) is filled by one pipelined snapshot
+on every connect and kept up to date by the client's own set commands.
+
+With unix_path the connection is opened over a Unix socket instead of TCP, e.g. to a local afm_api.broker.
+"""
+
+import asyncio
+import logging
+import random
+import re
+import time
+from collections import deque
+
+import websockets
+
+from .capture import RECEIVED, SENT, SessionWriter, redact
+from .errors import AFMAuthenticationError, AFMConnectionError, AFMError
+from .frames import (DATA, ERROR, RESPONSE, STREAM_KINDS, STREAM_OBJECTS, SUBSCRIPTION_OBJECTS, DecodeError,
+                     dumps, encode_command, frame_kind, get_command, loads, trigger_command)
+from .parameters import ParameterCache
+from .recorder import parse_resolution
+from .streams import DROP_OLDEST, StreamBuffer, stream_key
+
+logger = logging.getLogger(__name__)
+
+_COMMAND_RE = re.compile(r'"command"\s*:\s*"([^"]*)"')
+_OBJECT_RE = re.compile(r'"object"\s*:\s*"([^"]*)"')
+
+
+def is_stream_frame(data):
+    """Return True for frames pushed by a subscription rather than sent as a reply to a request."""
+    obj = data.get("object")
+    if obj in STREAM_OBJECTS:
+        return True
+    if obj in SUBSCRIPTION_OBJECTS:
+        # Subscription confirmations echo the request; streamed data carries the measured "value"
+        payload = data.get("payload") or {}
+        return isinstance(payload.get("value"), dict)
+    return False
+
+
+def subscription_state(payload):
+    """Return ((type, channel), subscribed) for the payload of a subscription set command."""
+    if "subscription" in payload:
+        subscribed = bool(payload["subscription"])
+    elif payload.get("property") == "subscription":
+        subscribed = bool(payload.get("value"))
+    else:
+        subscribed = True
+    return (payload.get("type"), payload.get("channel")), subscribed
+
+
+def missed_rows(last_row, row, resolution=None):
+    """
+    Rows skipped between two streamed lines. A row at or before the last one means the scan wrapped around
+    (continuous scanning) or was restarted; without a resolution the end of the previous pass is unknown.
+    """
+    if row > last_row:
+        return list(range(last_row + 1, row))
+    tail = list(range(last_row + 1, resolution)) if resolution else []
+    return tail + list(range(row))
+
+
+def _consume_result(future):
+    # Mark the result of an abandoned request as retrieved
+    if not future.cancelled():
+        future.exception()
+
+
+class _PendingRequest:
+    __slots__ = ("object", "future", "parser")
+
+    def __init__(self, obj, future, parser=None):
+        self.object = obj
+        self.future = future
+        # Called with the undecoded reply message instead of json.loads, see AFMClient.request_raw()
+        self.parser = parser
+
+
+class AFMClient:
+    """Headless WebSocket client for AFM Control with request/response correlation and pipelining."""
+
+    def __init__(self, uri, api_key, timeout=5.0, reconnect=False, reconnect_delay=0.5, reconnect_max_delay=30.0,
+                 reconnect_attempts=None, parameter_cache=False, unix_path=None):
+        self.uri = uri
+        # Connect over this Unix socket instead of TCP, e.g. to a local afm_api.broker
+        self.unix_path = unix_path
+        self.api_key = api_key
+        self.timeout = timeout
+        # Automatic reconnection; reconnect_attempts=None retries until close() is called
+        self.reconnect = reconnect
+        self.reconnect_delay = reconnect_delay
+        self.reconnect_max_delay = reconnect_max_delay
+        self.reconnect_attempts = reconnect_attempts
+        self.reconnects = 0
+        # Cached parameter values; always available, filled automatically with parameter_cache=True
+        self.parameters = ParameterCache(self)
+        self.parameter_cache = parameter_cache
+
+        self.websocket = None
+        self.authenticated = False
+        # Traffic counters of the reader task, e.g. for throughput measurements
+        self.messages_received = 0
+        self.bytes_received = 0
+        # SessionWriter of start_capture()
+        self.capture = None
+
+        self._reader_task = None
+        self._send_lock = None
+        # Pending requests in order of issue, globally and per object name
+        self._pending = deque()
+        self._pending_by_object = {}
+        self._raw_requests = 0
+        self._frame_handlers = []
+        self._disconnect_handlers = []
+        self._reconnect_handlers = []
+        self._missed_rows_handlers = []
+        self._streams = []
+
+        # Active subscriptions, (type, channel) -> (object, payload), replayed after a reconnect
+        self.subscriptions = {}
+        # Last streamed line row per channel, and the rows at the time the connection was lost
+        self._last_rows = {}
+        self._rows_at_loss = {}
+        self._resolution = None
+        self._reconnect_task = None
+
+    @property
+    def connected(self):
+        return self.websocket is not None and self._reader_task is not None and not self._reader_task.done()
+
+    @property
+    def reconnecting(self):
+        return self._reconnect_task is not None and not self._reconnect_task.done()
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    # Connection handling
+
+    async def connect(self):
+        """Open the WebSocket connection, authenticate and start the background reader."""
+        if self.connected:
+            return
+        try:
+            await self._open()
+        except BaseException:
+            self.websocket = None
+            raise
+        if self.parameter_cache:
+            await self.parameters.snapshot()
+
+    async def _open(self, replay=()):
+        """
+        Connect and authenticate. The (command, object, payload) tuples in replay are sent right behind the
+        authentication, without waiting for its reply; returns the futures of their replies.
+        """
+        self._send_lock = asyncio.Lock()
+        if self.unix_path:
+            self.websocket = await websockets.unix_connect(self.unix_path, self.uri, max_size=None)
+        else:
+            self.websocket = await websockets.connect(self.uri, max_size=None)
+        futures = []
+        try:
+            message = dumps({"command": "authenticate", "apikey": self.api_key})
+            if self.capture is not None:
+                self.capture.write(SENT, redact(message))
+            await self.websocket.send(message)
+            for command, obj, payload in replay:
+                futures.append(await self._send_request(command, obj, payload))
+            await self._authenticate()
+        except BaseException:
+            self._fail_pending(AFMConnectionError("Connection failed"))
+            await self.websocket.close()
+            raise
+        self._reader_task = asyncio.ensure_future(self._reader())
+        return futures
+
+    async def _authenticate(self):
+        # The first frame must be the authentication command; its reply is read before the reader starts
+        response = await asyncio.wait_for(self.websocket.recv(), self.timeout)
+        if self.capture is not None:
+            self.capture.write(RECEIVED, response)
+        response_data = loads(response)
+        if response_data.get("command") == "error":
+            error = AFMError.from_frame(response_data)
+            raise AFMAuthenticationError(error.title, error.details, error.object)
+        self.authenticated = True
+
+    async def close(self):
+        """Close the connection, end all streams and fail all requests still waiting for a reply."""
+        if self._reconnect_task is not None:
+            self._reconnect_task.cancel()
+            self._reconnect_task = None
+        # Streams are closed first, so that a reader waiting on a full BLOCK stream can finish
+        for stream in self._streams:
+            stream.close()
+        self._streams.clear()
+        websocket, self.websocket = self.websocket, None
+        if websocket is not None:
+            await websocket.close()
+        if self._reader_task is not None:
+            try:
+                await self._reader_task
+            except Exception:
+                pass
+            self._reader_task = None
+        self._fail_pending(AFMConnectionError("Connection closed"))
+        self.authenticated = False
+        self.subscriptions.clear()
+        self._last_rows.clear()
+        self._rows_at_loss.clear()
+        self.stop_capture()
+
+    # Capture
+
+    def start_capture(self, path, compress=False):
+        """
+        Write every frame sent and received from now on to a capture file (zstd compressed with compress=True).
+        Start it before connect() to include the authentication. Returns the SessionWriter.
+        """
+        self.stop_capture()
+        self.capture = SessionWriter(path, compress)
+        return self.capture
+
+    def stop_capture(self):
+        if self.capture is not None:
+            self.capture.close()
+            self.capture = None
+
+    # Frame dispatch
+
+    def add_frame_handler(self, handler):
+        """Call handler(data) for every streamed or unsolicited frame. Coroutine functions are scheduled."""
+        self._frame_handlers.append(handler)
+
+    def remove_frame_handler(self, handler):
+        self._frame_handlers.remove(handler)
+
+    def stream(self, data_type="line", channel=None, maxlen=64, policy=DROP_OLDEST):
+        """
+        Return a new StreamBuffer receiving the streamed frames of one type and channel.
+
+        data_type is "line", "map" or "log"; channel None receives all channels. The subscription itself
+        is not changed, see subscribe_measurement_data() and subscribe_log().
+        """
+        return self.add_stream(StreamBuffer(data_type, channel, maxlen, policy))
+
+    def add_stream(self, stream):
+        """
+        Register a stream consumer. Any object with matches(key), put_nowait(frame) -> bool, an async
+        put(frame) and close() can be used, see StreamBuffer.
+        """
+        self._streams.append(stream)
+        return stream
+
+    def close_stream(self, stream):
+        stream.close()
+        if stream in self._streams:
+            self._streams.remove(stream)
+
+    def add_disconnect_handler(self, handler):
+        """
+        Call handler(exception) when the connection is lost and, with reconnect=True, could not be
+        restored.
+        """
+        self._disconnect_handlers.append(handler)
+
+    def remove_disconnect_handler(self, handler):
+        if handler in self._disconnect_handlers:
+            self._disconnect_handlers.remove(handler)
+
+    def add_reconnect_handler(self, handler):
+        """Call handler(attempts, downtime) when the connection has been restored after a loss."""
+        self._reconnect_handlers.append(handler)
+
+    def remove_reconnect_handler(self, handler):
+        if handler in self._reconnect_handlers:
+            self._reconnect_handlers.remove(handler)
+
+    def add_missed_rows_handler(self, handler):
+        """Call handler(channel, rows) with the line rows streamed while the connection was down."""
+        self._missed_rows_handlers.append(handler)
+
+    def remove_missed_rows_handler(self, handler):
+        if handler in self._missed_rows_handlers:
+            self._missed_rows_handlers.remove(handler)
+
+    async def _reader(self):
+        error = None
+        try:
+            async for message in self.websocket:
+                self.messages_received += 1
+                self.bytes_received += len(message)
+                if self.capture is not None:
+                    self.capture.write(RECEIVED, message)
+                frame = self._dispatch(message)
+                if frame is not None:
+                    await self._publish(*frame)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            error = e
+        finally:
+            self.authenticated = False
+            self._fail_pending(AFMConnectionError(f"Connection lost: {error}" if error else "Connection closed"))
+        if self.websocket is not None:
+            # The connection went away without close() being called
+            if self.reconnect:
+                self._rows_at_loss.update(self._last_rows)
+                if not self.reconnecting:
+                    self._reconnect_task = asyncio.ensure_future(self._reconnect(error))
+            else:
+                self._notify_disconnect(error)
+
+    def _notify_disconnect(self, error):
+        for handler in list(self._disconnect_handlers):
+            try:
+                handler(error)
+            except Exception:
+                logger.exception("Error in disconnect handler")
+
+    async def _reconnect(self, error):
+        lost = time.monotonic()
+        attempt = 0
+        while self.reconnect_attempts is None or attempt < self.reconnect_attempts:
+            attempt += 1
+            delay = min(self.reconnect_max_delay, self.reconnect_delay * 2 ** (attempt - 1))
+            # Equal jitter: clients that lost the connection at the same time do not retry in lockstep
+            await asyncio.sleep(delay / 2 + random.uniform(0, delay / 2))
+            replay = [("set", obj, payload) for obj, payload in self.subscriptions.values()]
+            if self._rows_at_loss:
+                # Needed to tell the rows missed when the scan wrapped around during the outage
+                replay.append(("get", "ScannerResolution", {"property": "value"}))
+            try:
+                futures = await self._open(replay)
+            except AFMAuthenticationError as e:
+                error = e
+                break
+            except (OSError, asyncio.TimeoutError, websockets.WebSocketException, AFMConnectionError) as e:
+                error = e
+                logger.info("Reconnect attempt %d to %s failed: %s", attempt, self.uri, e)
+                continue
+            results = await asyncio.gather(*(self._wait(future, None) for future in futures),
+                                           return_exceptions=True)
+            for (command, obj, payload), result in zip(replay, results):
+                if isinstance(result, Exception):
+                    logger.warning("Replaying %s %s after reconnect failed: %s", command, obj, result)
+                elif obj == "ScannerResolution":
+                    self._resolution = parse_resolution(result)
+            if self.parameter_cache and self.connected:
+                # Anything may have changed while the connection was down
+                self.parameters.invalidate()
+                try:
+                    await self.parameters.snapshot()
+                except AFMConnectionError:
+                    pass
+            if not self.connected:
+                # Lost again during the replay; this task is still in charge of reconnecting
+                error = AFMConnectionError("Connection lost during replay")
+                continue
+            self.reconnects += 1
+            self._reconnect_task = None
+            logger.info("Reconnected to %s after %d attempts", self.uri, attempt)
+            for handler in list(self._reconnect_handlers):
+                try:
+                    handler(attempt, time.monotonic() - lost)
+                except Exception:
+                    logger.exception("Error in reconnect handler")
+            return
+        self._reconnect_task = None
+        self.websocket = None
+        self._notify_disconnect(error)
+
+    def _dispatch(self, message):
+        """
+        Resolve replies to pending requests. Returns (frame, kind) of streamed and unsolicited frames for
+        publishing.
+        """
+        if self._raw_requests and self._dispatch_raw(message):
+            return None
+        try:
+            data = loads(message)
+        except DecodeError as e:
+            logger.warning("Failed to decode JSON: %s", e)
+            return None
+        kind = frame_kind(data)
+        if kind is RESPONSE or kind is ERROR:
+            pending = self._pop_pending(data.get("object"))
+            if pending is not None:
+                if not pending.future.done():
+                    if kind is ERROR:
+                        pending.future.set_exception(AFMError.from_frame(data))
+                    else:
+                        pending.future.set_result(data.get("payload") or {})
+                return None
+        return data, kind
+
+    def _dispatch_raw(self, message):
+        # Hand the reply of a request_raw() to its parser without decoding the message first
+        match = _OBJECT_RE.search(message)
+        if match is None:
+            return False
+        queue = self._pending_by_object.get(match.group(1).strip())
+        if not queue or queue[0].parser is None:
+            return False
+        command = _COMMAND_RE.search(message)
+        if command is None or command.group(1) != "response":
+            return False
+        pending = self._pop_pending(match.group(1))
+        if not pending.future.done():
+            try:
+                pending.future.set_result(pending.parser(message))
+            except Exception as e:
+                pending.future.set_exception(e)
+        return True
+
+    async def _publish(self, data, kind):
+        if self.reconnect and kind is DATA:
+            self._track_rows(data)
+        if self.parameter_cache:
+            self.parameters.on_frame(data)
+        if self._streams and kind in STREAM_KINDS:
+            key = stream_key(data)
+            for stream in list(self._streams):
+                try:
+                    if stream.matches(key) and not stream.put_nowait(data):
+                        # A BLOCK consumer is full: stop reading until it has made room
+                        await stream.put(data)
+                except Exception:
+                    logger.exception("Error in stream consumer")
+        self._emit(data)
+
+    def _track_rows(self, data):
+        payload = data["payload"]
+        if data.get("object") != "MeasurementDataSubscription" or payload.get("type") != "line":
+            return
+        value = payload["value"]
+        row = value.get("y_position", payload.get("y_position"))
+        if row is None:
+            return
+        channel = payload.get("channel")
+        row = int(row)
+        self._last_rows[channel] = row
+        last_row = self._rows_at_loss.pop(channel, None)
+        if last_row is None:
+            return
+        rows = missed_rows(last_row, row, self._resolution)
+        if rows:
+            logger.warning("Missed %d rows of channel %s while reconnecting", len(rows), channel)
+            for handler in list(self._missed_rows_handlers):
+                try:
+                    handler(channel, rows)
+                except Exception:
+                    logger.exception("Error in missed rows handler")
+
+    def _emit(self, data):
+        for handler in list(self._frame_handlers):
+            try:
+                result = handler(data)
+                if asyncio.iscoroutine(result):
+                    asyncio.ensure_future(result)
+            except Exception:
+                logger.exception("Error in frame handler")
+
+    def _pop_pending(self, obj):
+        if obj:
+            # The server sometimes pads object names with spaces (see " FoundResonanceProperties ")
+            queue = self._pending_by_object.get(obj.strip())
+            if not queue:
+                return None
+            pending = queue.popleft()
+            self._pending.remove(pending)
+        else:
+            if not self._pending:
+                return None
+            pending = self._pending.popleft()
+            self._pending_by_object[pending.object].remove(pending)
+        return pending
+
+    def _fail_pending(self, exception):
+        while self._pending:
+            pending = self._pending.popleft()
+            if not pending.future.done():
+                pending.future.set_exception(exception)
+        self._pending_by_object.clear()
+
+    # Requests
+
+    def _check_open(self):
+        if not self.connected:
+            raise AFMConnectionError("Not connected to the server. Please connect first.")
+
+    async def _issue(self, command, obj, payload, message=None):
+        """Register a pending request and send it. Returns the future that receives the reply."""
+        self._check_open()
+        return await self._send_request(command, obj, payload, message=message)
+
+    async def _send_request(self, command, obj, payload, parser=None, message=None):
+        # message: the encoded command when it was encoded in advance, see afm_api.frames.Command
+        if message is None:
+            message = encode_command(command, obj, payload)
+        future = asyncio.get_running_loop().create_future()
+        pending = _PendingRequest(obj.strip(), future, parser)
+        # Registration and sending happen under one lock so that the order of issue is the order on the wire
+        async with self._send_lock:
+            self._pending.append(pending)
+            self._pending_by_object.setdefault(pending.object, deque()).append(pending)
+            try:
+                if self.capture is not None:
+                    self.capture.write(SENT, message)
+                await self.websocket.send(message)
+            except Exception as e:
+                self._pending.remove(pending)
+                self._pending_by_object[pending.object].remove(pending)
+                raise AFMConnectionError(f"Failed to send {command} {obj}: {e}") from e
+        return future
+
+    async def _wait(self, future, timeout):
+        timeout = self.timeout if timeout is None else timeout
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            # The request stays registered, so that a late reply is consumed by it and does not shift the
+            # correlation of later requests for the same object
+            future.add_done_callback(_consume_result)
+            raise
+
+    async def request(self, command, obj, payload, timeout=None, message=None):
+        """Send a command and return the payload of its reply. Raises AFMError for error frames."""
+        future = await self._issue(command, obj, payload, message)
+        result = await self._wait(future, timeout)
+        self._on_success(command, obj, payload, result)
+        return result
+
+    async def request_raw(self, command, obj, payload, parser, timeout=None):
+        """
+        Send a command and return parser(message) for the undecoded text of its reply.
+
+        For replies too large to decode as a whole, e.g. full MeasurementData images: the reader recognizes
+        the reply by its command and object name and passes the message to the parser without json.loads.
+        Exceptions raised by the parser are raised here.
+        """
+        self._check_open()
+        self._raw_requests += 1
+        try:
+            future = await self._send_request(command, obj, payload, parser)
+            return await self._wait(future, timeout)
+        finally:
+            self._raw_requests -= 1
+
+    async def set(self, obj, value, property="value", timeout=None, **extra):
+        payload = {"property": property, "value": value}
+        payload.update(extra)
+        return await self.request("set", obj, payload, timeout)
+
+    async def get(self, obj, property="value", timeout=None, **extra):
+        if not extra:
+            return await self.request_command(get_command(obj, property), timeout)
+        payload = {"property": property}
+        payload.update(extra)
+        return await self.request("get", obj, payload, timeout)
+
+    async def trigger(self, obj, timeout=None):
+        """Trigger an action object, e.g. ActionMeasurementStart."""
+        return await self.request_command(trigger_command(obj), timeout)
+
+    async def request_command(self, command, timeout=None):
+        """request() for a Command of afm_api.frames, whose wire text was encoded in advance."""
+        return await self.request(*command, timeout=timeout, message=command.message)
+
+    async def send(self, command, obj, payload):
+        """Send a command without waiting for its reply. A reply, if any, is passed to the frame handlers."""
+        self._check_open()
+        message = encode_command(command, obj, payload)
+        async with self._send_lock:
+            if self.capture is not None:
+                self.capture.write(SENT, message)
+            await self.websocket.send(message)
+
+    async def pipeline(self, commands, timeout=None, return_exceptions=False):
+        """
+        Send all (command, object, payload) tuples back-to-back, then wait for all replies.
+
+        Returns the reply payloads in the order of the commands. With return_exceptions=True, failed
+        commands yield their exception instead of raising the first one.
+        """
+        futures = []
+        for spec in commands:
+            command, obj, payload = spec
+            futures.append(await self._issue(command, obj, payload, getattr(spec, "message", None)))
+        waiters = [self._wait(future, timeout) for future in futures]
+        results = await asyncio.gather(*waiters, return_exceptions=return_exceptions)
+        for (command, obj, payload), result in zip(commands, results):
+            if not isinstance(result, Exception):
+                self._on_success(command, obj, payload, result)
+        return results
+
+    def _on_success(self, command, obj, payload, result):
+        if command != "set":
+            return
+        obj = obj.strip()
+        self.parameters.on_set(obj, payload, result)
+        if obj not in SUBSCRIPTION_OBJECTS:
+            return
+        # Successful subscription changes are kept for the replay after a reconnect
+        key, subscribed = subscription_state(payload)
+        if subscribed:
+            self.subscriptions[key] = (obj, dict(payload))
+        else:
+            self.subscriptions.pop(key, None)
+
+    # Subscriptions
+
+    async def subscribe_measurement_data(self, channel=0, data_type="line", data_format="float",
+                                         subscription=True):
+        payload = {
+            "property": "type",
+            "type": data_type,
+            "format": data_format,
+            "channel": channel,
+            "subscription": subscription
+        }
+        return await self.request("set", "MeasurementDataSubscription", payload)
+
+    async def subscribe_log(self, subscription=True):
+        payload = {
+            "property": "type",
+            "type": "log",
+            "format": "txt",
+            "subscription": subscription
+        }
+        return await self.request("set", "DataSubscription", payload)
@@ -0,0 +1,307 @@
+"""
+Client-side line and surface correction of streamed measurement data
+
+The server applies MeasurementDataCorrectionMode (none, line, plane, paraboloid, cubic surface) only to the
+one channel it sends, and changing it means streaming the data again. This module corrects the raw line
+stream on the client instead, so that one raw stream can feed several corrected views at no extra cost for
+the server:
+
+- LineLeveler subtracts a least-squares polynomial from every line. The fit matrix depends only on the
+  number of points, so it is computed once; leveling a line, or a whole map of lines, is one matrix product.
+- SurfaceFit fits a plane, paraboloid or cubic surface to the map while it is being scanned. It keeps the
+  normal equations of the fit as running sums: every arriving row adds its contribution (and a rescanned
+  row replaces its previous one), so the surface is available after every line without refitting the
+  whole map.
+- TraceAligner estimates the lateral shift between the forward and backward trace from their
+  cross-correlation and shifts the backward trace onto the forward one.
+- StreamCorrector combines them for LineData streams: add_line() returns the line corrected in every
+  requested mode, image() the corrected map of a mode.
+
+Coordinates are pixel positions scaled to [-1, 1], which keeps the fits well conditioned at any resolution.
+Missing values (NaN) are left out of all fits.
+"""
+
+import functools
+
+import numpy as np
+
+CORRECTION_MODES = ("none", "line", "plane", "paraboloid", "cubic")
+
+# Polynomial order of the surface fitted by each surface mode
+SURFACE_ORDERS = {"plane": 1, "paraboloid": 2, "cubic": 3}
+
+
+def pixel_coordinates(points):
+    """Pixel positions scaled to [-1, 1]."""
+    return np.linspace(-1.0, 1.0, points) if points > 1 else np.zeros(points)
+
+
+def surface_exponents(order):
+    """(x, y) exponents of the terms of a 2-D polynomial of the given order."""
+    return [(i - j, j) for i in range(order + 1) for j in range(i + 1)]
+
+
+class LineLeveler:
+    """Subtract a polynomial of the given order (0: offset, 1: tilt, ...) from lines of a fixed length."""
+
+    def __init__(self, points, order=1):
+        self.points = points
+        self.order = order
+        self._basis = np.vander(pixel_coordinates(points), order + 1, increasing=True)
+        # Least-squares solution operator: coefficients = pinv @ y
+        self._pinv = np.linalg.pinv(self._basis)
+
+    def __call__(self, y):
+        """Level one line (1-D) or every row of a map (2-D). Returns a new array."""
+        y = np.asarray(y, dtype=float)
+        rows = np.atleast_2d(y)
+        invalid = np.isnan(rows).any(axis=1)
+        if not invalid.any():
+            leveled = rows - (rows @ self._pinv.T) @ self._basis.T
+        else:
+            leveled = np.empty_like(rows)
+            valid = ~invalid
+            leveled[valid] = rows[valid] - (rows[valid] @ self._pinv.T) @ self._basis.T
+            for index in np.flatnonzero(invalid):
+                leveled[index] = self._level_masked(rows[index])
+        return leveled.reshape(y.shape)
+
+    def _level_masked(self, y):
+        mask = ~np.isnan(y)
+        if mask.sum() <= self.order:
+            return y - np.nanmean(y) if mask.any() else y.copy()
+        coefficients = np.linalg.lstsq(self._basis[mask], y[mask], rcond=None)[0]
+        return y - self._basis @ coefficients
+
+
+@functools.lru_cache(maxsize=16)
+def line_leveler(points, order=1):
+    """Shared LineLeveler for lines of the given length and order."""
+    return LineLeveler(points, order)
+
+
+class SurfaceFit:
+    """
+    Least-squares polynomial surface over a map that is scanned row by row.
+
+    The normal equations (A^T A) c = A^T z are kept as running sums over the rows. add_row() updates them
+    with the contribution of one row; a row that is scanned again replaces its previous contribution.
+    """
+
+    def __init__(self, resolution, order=1):
+        self.resolution = resolution
+        self.order = order
+        self.exponents = surface_exponents(order)
+        coordinates = pixel_coordinates(resolution)
+        self._x = coordinates
+        self._y = coordinates
+        # Powers of x per term, shape (points, terms)
+        self._x_terms = np.column_stack([coordinates ** ex for ex, _ in self.exponents])
+        self._y_exponents = np.array([ey for _, ey in self.exponents])
+        terms = len(self.exponents)
+        self._ata = np.zeros((terms, terms))
+        self._atz = np.zeros(terms)
+        # Contribution of every row, to replace it when the row is scanned again
+        self._row_ata = np.zeros((resolution, terms, terms))
+        self._row_atz = np.zeros((resolution, terms))
+        self._rows = np.zeros(resolution, dtype=bool)
+        self._coefficients = None
+
+    def __len__(self):
+        """Number of rows in the fit."""
+        return int(self._rows.sum())
+
+    def _row_basis(self, row):
+        return self._x_terms * self._y[row] ** self._y_exponents
+
+    def add_row(self, row, z):
+        """Add (or replace) the values of one row."""
+        z = np.asarray(z, dtype=float)
+        basis = self._row_basis(row)
+        mask = ~np.isnan(z)
+        if not mask.all():
+            basis, z = basis[mask], z[mask]
+        ata = basis.T @ basis
+        atz = basis.T @ z
+        if self._rows[row]:
+            self._ata -= self._row_ata[row]
+            self._atz -= self._row_atz[row]
+        self._ata += ata
+        self._atz += atz
+        self._row_ata[row] = ata
+        self._row_atz[row] = atz
+        self._rows[row] = True
+        self._coefficients = None
+
+    def remove_row(self, row):
+        if self._rows[row]:
+            self._ata -= self._row_ata[row]
+            self._atz -= self._row_atz[row]
+            self._rows[row] = False
+            self._coefficients = None
+
+    def reset(self):
+        self._ata[:] = 0
+        self._atz[:] = 0
+        self._rows[:] = False
+        self._coefficients = None
+
+    def coefficients(self):
+        """Coefficients of the terms in surface_exponents(order), or None before the first row."""
+        if self._coefficients is None and self._rows.any():
+            # lstsq also handles the underdetermined start of a scan (e.g. a plane from a single row)
+            self._coefficients = np.linalg.lstsq(self._ata, self._atz, rcond=None)[0]
+        return self._coefficients
+
+    def evaluate(self, rows=None):
+        """The fitted surface at the given rows (default: all), shape (rows, points)."""
+        rows = np.arange(self.resolution) if rows is None else np.atleast_1d(rows)
+        coefficients = self.coefficients()
+        if coefficients is None:
+            return np.zeros((len(rows), self.resolution))
+        # sum over terms of c * x^ex * y^ey, as (rows x terms) @ (terms x points)
+        y_terms = self._y[rows][:, None] ** self._y_exponents
+        return (y_terms * coefficients) @ self._x_terms.T
+
+    def level_row(self, row, z):
+        return np.asarray(z, dtype=float) - self.evaluate(row)[0]
+
+    def level(self, image):
+        """Subtract the fitted surface from a (resolution x resolution) map."""
+        return np.asarray(image, dtype=float) - self.evaluate()
+
+
+def shift_rows(values, shift):
+    """Shift 1-D or 2-D rows by a fractional number of points with linear interpolation; edges become NaN."""
+    values = np.asarray(values, dtype=float)
+    whole = int(np.floor(shift))
+    fraction = shift - whole
+    shifted = np.full_like(values, np.nan)
+    n = values.shape[-1]
+    if abs(whole) >= n:
+        return shifted
+    # result[i] = values[i - shift], interpolated between values[i - whole] and values[i - whole - 1]
+    source = np.roll(values, whole, axis=-1)
+    if fraction:
+        source = (1 - fraction) * source + fraction * np.roll(source, 1, axis=-1)
+    start, stop = max(whole + (fraction > 0), 0), min(n + whole, n)
+    shifted[..., start:stop] = source[..., start:stop]
+    return shifted
+
+
+def trace_shift(forward, backward, max_shift=None):
+    """
+    Lateral shift in points that moves the backward trace onto the forward trace, from the peak of the
+    cross-correlation of the leveled traces refined to sub-point precision by a parabola through the
+    three highest values.
+    """
+    n = len(forward)
+    # The tilt of the lines would otherwise dominate the correlation
+    leveler = line_leveler(n)
+    forward = np.nan_to_num(leveler(forward))
+    backward = np.nan_to_num(leveler(backward))
+    size = 1 << int(2 * n - 1).bit_length()
+    correlation = np.fft.irfft(np.fft.rfft(forward, size) * np.conj(np.fft.rfft(backward, size)), size)
+    # Lags 0..n-1 followed by -(n-1)..-1
+    lags = np.concatenate((correlation[:n], correlation[size - n + 1:]))
+    offsets = np.concatenate((np.arange(n), np.arange(-n + 1, 0)))
+    if max_shift is not None:
+        keep = np.abs(offsets) <= max_shift
+        lags, offsets = lags[keep], offsets[keep]
+    order = np.argsort(offsets)
+    lags, offsets = lags[order], offsets[order]
+    peak = int(np.argmax(lags))
+    shift = float(offsets[peak])
+    if 0 < peak < len(lags) - 1:
+        left, center, right = lags[peak - 1:peak + 2]
+        denominator = left - 2 * center + right
+        if denominator:
+            shift += 0.5 * (left - right) / denominator
+    return shift
+
+
+class TraceAligner:
+    """
+    Aligns backward traces to forward traces with a shift estimated line by line and smoothed over the
+    lines (exponential moving average with the given weight of the newest line).
+    """
+
+    def __init__(self, max_shift=None, smoothing=0.1):
+        self.max_shift = max_shift
+        self.smoothing = smoothing
+        self.shift = None
+
+    def update(self, forward, backward):
+        """Update the shift estimate with one line pair. Returns the aligned backward trace."""
+        shift = trace_shift(forward, backward, self.max_shift)
+        self.shift = shift if self.shift is None else self.shift + self.smoothing * (shift - self.shift)
+        return self.align(backward)
+
+    def align(self, backward):
+        """Shift backward traces (1-D or 2-D) by the current estimate."""
+        if not self.shift:
+            return np.asarray(backward, dtype=float)
+        return shift_rows(backward, self.shift)
+
+
+class StreamCorrector:
+    """
+    Corrected views of a streamed scan: feed every LineData to add_line(), which returns
+    {mode: (forward, backward)} for the given correction modes; image(mode) returns a corrected map.
+
+    With align=True the backward traces are aligned to the forward traces before they are corrected.
+    """
+
+    def __init__(self, resolution, modes=CORRECTION_MODES, line_order=1, align=False, max_shift=None):
+        unknown = [mode for mode in modes if mode not in CORRECTION_MODES]
+        if unknown:
+            raise ValueError(f"Unknown correction modes {unknown}, expected {CORRECTION_MODES}")
+        self.resolution = resolution
+        self.modes = tuple(modes)
+        self.leveler = LineLeveler(resolution, line_order)
+        self.aligner = TraceAligner(max_shift) if align else None
+        # Raw forward and backward map; unscanned rows are NaN
+        self.raw = np.full((2, resolution, resolution), np.nan)
+        self.fits = {(mode, direction): SurfaceFit(resolution, SURFACE_ORDERS[mode])
+                     for mode in self.modes if mode in SURFACE_ORDERS for direction in (0, 1)}
+
+    def reset(self):
+        self.raw[:] = np.nan
+        for fit in self.fits.values():
+            fit.reset()
+
+    def add_line(self, line):
+        """Add a LineData row and return its corrected traces per mode."""
+        row = line.y_position
+        if len(line) != self.resolution or row is None or not 0 <= row < self.resolution:
+            raise ValueError(f"Line {row} with {len(line)} points does not fit a {self.resolution}x"
+                             f"{self.resolution} map")
+        backward = line.y_backward
+        if self.aligner is not None:
+            backward = self.aligner.update(line.y_forward, backward)
+        traces = (np.asarray(line.y_forward, dtype=float), np.asarray(backward, dtype=float))
+        self.raw[0, row] = traces[0]
+        self.raw[1, row] = traces[1]
+        for (mode, direction), fit in self.fits.items():
+            fit.add_row(row, traces[direction])
+        corrected = {}
+        for mode in self.modes:
+            if mode == "none":
+                corrected[mode] = traces
+            elif mode == "line":
+                corrected[mode] = tuple(self.leveler(np.stack(traces)))
+            else:
+                corrected[mode] = tuple(self.fits[mode, direction].level_row(row, traces[direction])
+                                        for direction in (0, 1))
+        return corrected
+
+    def image(self, mode="plane", direction=0):
+        """The map of one direction (0: forward, 1: backward) corrected in the given mode."""
+        if mode not in self.modes:
+            raise ValueError(f"Mode {mode!r} is not one of {self.modes}")
+        raw = self.raw[direction]
+        if mode == "none":
+            return raw.copy()
+        if mode == "line":
+            return self.leveler(raw)
+        return self.fits[mode, direction].level(raw)
@@ -0,0 +1,111 @@
+"""
+NumPy decoding of streamed measurement data
+
+MeasurementDataSubscription frames carry their vectors in one of three formats:
+
+- "float":  JSON arrays of numbers,
+- "txt":    JSON arrays of strings in scientific notation (e.g. "8.2839e-02"),
+- "base64": base64 coded binary values.
+
+For "base64" the decoded bytes are wrapped with numpy.frombuffer, so the returned array is a read-only
+view over the decoded buffer without any per-value Python objects. For "float" and "txt" the JSON lists are
+converted in a single vectorized step into one float64 array. All arrays returned by this module are
+read-only, so they can be shared between consumers without defensive copies; call .copy() when a
+writable array is needed.
+"""
+
+import base64
+
+import numpy as np
+
+# Binary layout of "base64" coded values (little-endian IEEE 754 double)
+BASE64_DTYPE = np.dtype("<f8")
+
+LINE_VECTORS = ("x", "y_forward", "y_backward")
+
+
+def decode_array(value, data_format="float", dtype=BASE64_DTYPE):
+    """Decode one vector of a measurement frame into a read-only float array."""
+    if data_format == "base64":
+        if isinstance(value, str):
+            value = value.encode("ascii")
+        array = np.frombuffer(base64.b64decode(value), dtype=dtype)
+    else:
+        # "float" lists are converted directly, "txt" strings are parsed by NumPy in the same call
+        array = np.asarray(value, dtype=np.float64)
+        array.flags.writeable = False
+    return array
+
+
+class LineData:
+    """One streamed scan line: x positions in µm and the forward/backward signal as NumPy arrays."""
+
+    __slots__ = ("channel", "signal", "y_position", "data_format", "x", "y_forward", "y_backward")
+
+    def __init__(self, channel, signal, y_position, data_format, x, y_forward, y_backward):
+        self.channel = channel
+        self.signal = signal
+        self.y_position = y_position
+        self.data_format = data_format
+        self.x = x
+        self.y_forward = y_forward
+        self.y_backward = y_backward
+
+    def __len__(self):
+        return len(self.x)
+
+    def __repr__(self):
+        return (f"LineData(channel={self.channel}, signal={self.signal!r}, y_position={self.y_position}, "
+                f"points={len(self.x)})")
+
+    @property
+    def y_range(self):
+        """(min, max) over forward and backward signal without concatenating them."""
+        return (min(self.y_forward.min(), self.y_backward.min()),
+                max(self.y_forward.max(), self.y_backward.max()))
+
+    def is_valid(self):
+        n = len(self.x)
+        return n > 0 and len(self.y_forward) == n and len(self.y_backward) == n
+
+
+def decode_line(payload, dtype=BASE64_DTYPE):
+    """Decode the payload of a "line" MeasurementDataSubscription frame into LineData."""
+    data_format = payload.get("format", "float")
+    value = payload.get("value") or {}
+    vectors = [decode_array(value.get(name, ()), data_format, dtype) for name in LINE_VECTORS]
+    y_position = value.get("y_position", payload.get("y_position"))
+    return LineData(payload.get("channel"), payload.get("signal", "Measurement Data"),
+                    None if y_position is None else int(y_position), data_format, *vectors)
+
+
+def decode_map(payload, dtype=BASE64_DTYPE):
+    """
+    Decode the payload of a "map" MeasurementDataSubscription frame.
+
+    Returns a dict with every vector of the frame's "value" decoded. Vectors whose length is a square
+    number are returned as N x N views, other entries (e.g. scalar metadata) are passed through. API v1.1
+    does not document the layout of map frames, so a frame without a "value" object holding at least one
+    N x N vector raises ValueError instead of returning something that is not a map.
+    """
+    data_format = payload.get("format", "float")
+    values = payload.get("value")
+    if not isinstance(values, dict):
+        raise ValueError(f"Map frame without a \"value\" object: {type(values).__name__}")
+    result = {}
+    for name, value in values.items():
+        if isinstance(value, list) or (data_format == "base64" and isinstance(value, str)):
+            array = decode_array(value, data_format, dtype)
+            side = int(round(np.sqrt(array.size)))
+            if array.ndim == 1 and side > 1 and side * side == array.size:
+                array = array.reshape(side, side)
+            result[name] = array
+        else:
+            result[name] = value
+    if not any(isinstance(value, np.ndarray) and value.ndim == 2 for value in result.values()):
+        raise ValueError(f"Map frame holds no N x N vector, entries: {', '.join(sorted(result)) or 'none'}")
+    return result
+
+
+# Decoder for the payload of each streamed data type
+DECODERS = {"line": decode_line, "map": decode_map}
@@ -0,0 +1,30 @@
+"""
+Exceptions raised by the AFM Control API client library.
+"""
+
+
+class AFMError(Exception):
+    """Error frame returned by the AFM Control API server."""
+
+    def __init__(self, title, details="", obj=None):
+        self.title = title
+        self.details = details
+        self.object = obj
+        message = f"{title}: {details}" if details else title
+        if obj:
+            message = f"{obj}: {message}"
+        super().__init__(message)
+
+    @classmethod
+    def from_frame(cls, data):
+        payload = data.get("payload") or {}
+        title = payload.get("title") or data.get("message") or "Unknown error"
+        return cls(title, payload.get("details", ""), data.get("object"))
+
+
+class AFMAuthenticationError(AFMError):
+    """The server rejected the API key."""
+
+
+class AFMConnectionError(ConnectionError):
+    """The WebSocket connection is not open or was lost while waiting for a reply."""
@@ -0,0 +1,251 @@
+"""
+Connection pool for several AFM Control servers
+
+A Fleet keeps one authenticated AFMClient per instrument, all on the same event loop, so a single process
+can drive every AFM in the lab:
+
+- commands are fanned out to all (or selected) instruments concurrently, e.g. to apply one scan and PID
+  profile to every tool at once; results are returned per instrument, with failures as exceptions instead
+  of aborting the other instruments,
+- each instrument has its own limit of requests in flight, so one slow or busy server does not get
+  flooded while the others are served at full speed,
+- the line (or map, log) streams of all instruments are merged into one async iterator of
+  (instrument, item) pairs.
+
+    fleet = Fleet({"afm1": ("ws://10.0.0.11:1234", key1), "afm2": ("ws://10.0.0.12:1234", key2)})
+    async with fleet:
+        await fleet.apply_profile({"ScannerRange": 10.0, "AFMPIDConstantP": 10, "AFMPIDConstantI": 290})
+        async with fleet.stream("line") as lines:
+            async for instrument, line in lines:
+                ...
+"""
+
+import asyncio
+from collections import namedtuple
+
+from .client import AFMClient
+from .decoding import DECODERS
+from .streams import DROP_OLDEST, StreamBuffer
+
+# Item of a merged fleet stream
+InstrumentItem = namedtuple("InstrumentItem", ("instrument", "item"))
+
+
+def profile_commands(profile):
+    """Turn {object: value} into set commands. Values of dict type are sent as the complete payload."""
+    commands = []
+    for obj, value in profile.items():
+        payload = value if isinstance(value, dict) else {"property": "value", "value": value}
+        commands.append(("set", obj, payload))
+    return commands
+
+
+class _StreamTap:
+    """Per-client stream consumer that tags frames with the instrument name and forwards them."""
+
+    def __init__(self, instrument, buffer, on_close=None):
+        self.instrument = instrument
+        self.buffer = buffer
+        self.on_close = on_close
+        self.closed = False
+
+    def matches(self, key):
+        return self.buffer.matches(key)
+
+    def put_nowait(self, frame):
+        return self.buffer.put_nowait((self.instrument, frame))
+
+    async def put(self, frame):
+        await self.buffer.put((self.instrument, frame))
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            if self.on_close is not None:
+                self.on_close(self)
+
+
+class FleetStream:
+    """
+    Streamed frames of all instruments in one bounded buffer, iterated as InstrumentItem pairs.
+
+    Line and map payloads are decoded (see afm_api.decoding) unless decode=False. The overflow policy
+    applies to the merged buffer, see afm_api.streams.
+    """
+
+    def __init__(self, fleet, data_type="line", channel=None, maxlen=256, policy=DROP_OLDEST, decode=True):
+        self.buffer = StreamBuffer(data_type, channel, maxlen, policy)
+        self.decoder = DECODERS.get(data_type) if decode else None
+        self._taps = {}
+        for name, client in fleet.clients.items():
+            self._taps[name] = client.add_stream(_StreamTap(name, self.buffer, self._on_tap_closed))
+        self._clients = dict(fleet.clients)
+
+    @property
+    def stats(self):
+        return self.buffer.stats
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        instrument, frame = await self.buffer.get()
+        if self.decoder is not None:
+            return InstrumentItem(instrument, self.decoder(frame.get("payload") or {}))
+        return InstrumentItem(instrument, frame)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.close()
+
+    def _on_tap_closed(self, tap):
+        # The merged buffer ends with the last client, e.g. when the fleet is closed
+        if all(other.closed for other in self._taps.values()):
+            self.buffer.close()
+
+    def close(self):
+        for name, tap in list(self._taps.items()):
+            self._clients[name].close_stream(tap)
+        self._taps.clear()
+        self.buffer.close()
+
+
+class Fleet:
+    """Pool of AFMClient connections to several instruments, addressed by name."""
+
+    def __init__(self, instruments, timeout=5.0, max_in_flight=8, reconnect=True):
+        """
+        instruments maps a name to (uri, api_key). max_in_flight limits the number of requests waiting for
+        a reply per instrument.
+        """
+        self.clients = {name: AFMClient(uri, api_key, timeout, reconnect=reconnect)
+                        for name, (uri, api_key) in instruments.items()}
+        self.max_in_flight = max_in_flight
+        # Connection errors of the last connect(), by instrument
+        self.errors = {}
+        self._limits = {}
+
+    def __len__(self):
+        return len(self.clients)
+
+    @property
+    def connected(self):
+        """Names of the instruments with an open connection."""
+        return [name for name, client in self.clients.items() if client.connected]
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def connect(self, names=None):
+        """
+        Connect to all (or the named) instruments concurrently. Instruments that fail are left out and
+        their exceptions are kept in self.errors; returns the names of the connected instruments.
+        """
+        names = self._names(names)
+        results = await asyncio.gather(*(self.clients[name].connect() for name in names), return_exceptions=True)
+        self.errors = {name: result for name, result in zip(names, results) if isinstance(result, Exception)}
+        return [name for name in names if name not in self.errors]
+
+    async def close(self):
+        await asyncio.gather(*(client.close() for client in self.clients.values()), return_exceptions=True)
+
+    def _names(self, names):
+        if names is None:
+            return list(self.clients)
+        unknown = [name for name in names if name not in self.clients]
+        if unknown:
+            raise KeyError(f"Unknown instruments: {', '.join(map(str, unknown))}")
+        return list(names)
+
+    def _limit(self, name):
+        # Created on first use, inside the running event loop
+        if name not in self._limits:
+            self._limits[name] = asyncio.Semaphore(self.max_in_flight)
+        return self._limits[name]
+
+    # Commands
+
+    async def request(self, name, command, obj, payload, timeout=None):
+        """Send one command to one instrument, respecting its in-flight limit."""
+        async with self._limit(name):
+            return await self.clients[name].request(command, obj, payload, timeout)
+
+    async def _run(self, name, commands, timeout):
+        # Requests wait for a free slot in order and are issued in order, so sets of the same object keep
+        # their sequence while up to max_in_flight of them are pipelined
+        return await asyncio.gather(*(self.request(name, command, obj, payload, timeout)
+                                      for command, obj, payload in commands), return_exceptions=True)
+
+    async def apply(self, commands, names=None, timeout=None):
+        """
+        Send the same (command, object, payload) tuples to all (or the named) instruments.
+
+        Returns {name: [result or exception per command]}; disconnected instruments get an
+        AFMConnectionError for every command.
+        """
+        names = self._names(names)
+        results = await asyncio.gather(*(self._run(name, commands, timeout) for name in names))
+        return dict(zip(names, results))
+
+    async def broadcast(self, command, obj, payload, names=None, timeout=None):
+        """Send one command to all (or the named) instruments. Returns {name: result or exception}."""
+        results = await self.apply([(command, obj, payload)], names, timeout)
+        return {name: result[0] for name, result in results.items()}
+
+    async def set(self, obj, value, property="value", names=None, timeout=None, **extra):
+        payload = {"property": property, "value": value}
+        payload.update(extra)
+        return await self.broadcast("set", obj, payload, names, timeout)
+
+    async def get(self, obj, property="value", names=None, timeout=None, **extra):
+        payload = {"property": property}
+        payload.update(extra)
+        return await self.broadcast("get", obj, payload, names, timeout)
+
+    async def trigger(self, obj, names=None, timeout=None):
+        """Trigger an action object, e.g. ActionMeasurementStart, on all (or the named) instruments."""
+        return await self.set(obj, True, property="triggered", names=names, timeout=timeout)
+
+    async def apply_profile(self, profile, names=None, timeout=None):
+        """
+        Set {object: value} on all (or the named) instruments, e.g. a scan or PID profile.
+
+        Returns {name: {object: result or exception}}.
+        """
+        objects = list(profile)
+        results = await self.apply(profile_commands(profile), names, timeout)
+        return {name: dict(zip(objects, result)) for name, result in results.items()}
+
+    @staticmethod
+    def failures(results):
+        """The exceptions in a result dict of broadcast() or apply_profile(), by instrument."""
+        failed = {}
+        for name, result in results.items():
+            values = result.values() if isinstance(result, dict) else [result]
+            errors = [value for value in values if isinstance(value, Exception)]
+            if errors:
+                failed[name] = errors
+        return failed
+
+    # Streams
+
+    def stream(self, data_type="line", channel=None, maxlen=256, policy=DROP_OLDEST, decode=True):
+        """Return a FleetStream merging the streamed frames of all instruments."""
+        return FleetStream(self, data_type, channel, maxlen, policy, decode)
+
+    async def subscribe_measurement_data(self, channel=0, data_type="line", data_format="base64", names=None):
+        payload = {
+            "property": "type",
+            "type": data_type,
+            "format": data_format,
+            "channel": channel,
+            "subscription": True
+        }
+        return await self.broadcast("set", "MeasurementDataSubscription", payload, names)
+
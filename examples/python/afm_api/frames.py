@@ -0,0 +1,314 @@
+"""
+JSON layer of the client: fast decoding and encoding of API frames
+
+Every frame of the AFM Control API is a JSON object {"command", "object", "payload"}. This module is the
+single place where frames are converted from and to text:
+
+- loads() and dumps() use the fastest installed backend: msgspec, then orjson, then the standard library
+  json module. Both fast backends decode a line frame of numbers several times faster than json. Frames
+  they reject (NaN and Infinity literals are not standard JSON) are decoded by json, as before. Every
+  backend encodes the same values as json, although the fast backends write no spaces between items:
+  objects a fast backend cannot encode (NumPy scalars, keys that are not strings) and objects holding NaN
+  or Infinity, which the fast backends would write as null, are encoded by json. The environment variable
+  AFM_JSON_BACKEND=json (or orjson, msgspec) selects a backend explicitly.
+- frame_kind() classifies a decoded frame once as a reply, an error, streamed measurement data or a log
+  event, so the client routes it without repeating the same dict lookups at every stage.
+- decode_frame() returns typed frames (ResponseFrame, ErrorFrame, MeasurementFrame, LogFrame) with the
+  fields of the frame as attributes, for consumers that prefer them to chains of .get() calls.
+- Command holds a command whose wire text is encoded once; trigger_command() and get_command() return
+  cached Commands for fixed commands such as triggering ActionMeasurementStart.
+"""
+
+import functools
+import json
+import math
+import os
+from collections import namedtuple
+
+from .decoding import BASE64_DTYPE, decode_line, decode_map
+
+# Objects whose "response" frames are pushed by the server without a matching request
+STREAM_OBJECTS = ("LogEvent",)
+
+SUBSCRIPTION_OBJECTS = ("MeasurementDataSubscription", "DataSubscription")
+
+# Kinds of frames, see frame_kind()
+RESPONSE = "response"
+ERROR = "error"
+DATA = "data"
+LOG = "log"
+OTHER = "other"
+
+# Kinds of frames that are streamed rather than sent as a reply to a request
+STREAM_KINDS = (DATA, LOG)
+
+
+def _json_backend():
+    return json.loads, json.dumps, (ValueError,), ()
+
+
+def _orjson_backend():
+    import orjson
+
+    def dumps(obj):
+        # Text frames: websockets sends bytes as binary frames
+        return orjson.dumps(obj).decode("utf-8")
+
+    return orjson.loads, dumps, (orjson.JSONDecodeError,), (TypeError, ValueError, OverflowError)
+
+
+def _msgspec_backend():
+    import msgspec
+
+    decoder = msgspec.json.Decoder()
+    encoder = msgspec.json.Encoder()
+
+    def dumps(obj):
+        return encoder.encode(obj).decode("utf-8")
+
+    return decoder.decode, dumps, (msgspec.DecodeError,), (msgspec.EncodeError, TypeError, ValueError, OverflowError)
+
+
+_BACKENDS = {"msgspec": _msgspec_backend, "orjson": _orjson_backend, "json": _json_backend}
+
+
+def available_backends():
+    """Names of the installed backends, fastest first."""
+    names = []
+    for name, backend in _BACKENDS.items():
+        try:
+            backend()
+        except ImportError:
+            continue
+        names.append(name)
+    return names
+
+
+def backend_functions(name, fallback=False):
+    """
+    (loads, dumps) of a backend; raises ImportError if not installed. With fallback=True, dumps falls back
+    to json like dumps() of this module does, otherwise it is the backend's own.
+    """
+    if name not in _BACKENDS:
+        raise ValueError(f"Unknown JSON backend {name!r}, expected one of {tuple(_BACKENDS)}")
+    loads, dumps, _, encode_errors = _BACKENDS[name]()
+    return loads, _compatible_dumps(dumps, encode_errors) if fallback else dumps
+
+
+def _has_non_finite(obj):
+    """True if obj holds a NaN or infinite float at any depth."""
+    if isinstance(obj, float):
+        return not math.isfinite(obj)
+    if isinstance(obj, dict):
+        return any(_has_non_finite(value) for value in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return any(_has_non_finite(value) for value in obj)
+    return False
+
+
+def _compatible_dumps(fast_dumps, errors):
+    """Wrap the dumps of a fast backend so that it encodes everything json.dumps encodes, to the same values."""
+    if not errors:
+        return fast_dumps
+
+    def dumps(obj):
+        try:
+            text = fast_dumps(obj)
+        except errors:
+            return json.dumps(obj)
+        # NaN and Infinity come out as null, json writes them as NaN and Infinity. Only text with a null
+        # can hold one, so ordinary commands are not searched.
+        if "null" in text and _has_non_finite(obj):
+            return json.dumps(obj)
+        return text
+
+    return dumps
+
+
+def _select_backend():
+    requested = os.environ.get("AFM_JSON_BACKEND")
+    if requested:
+        if requested not in _BACKENDS:
+            raise ValueError(f"Unknown AFM_JSON_BACKEND {requested!r}, expected one of {tuple(_BACKENDS)}")
+        return requested, _BACKENDS[requested]()
+    for name, backend in _BACKENDS.items():
+        try:
+            return name, backend()
+        except ImportError:
+            continue
+
+
+BACKEND, (_loads, _fast_dumps, _errors, _encode_errors) = _select_backend()
+_dumps = _compatible_dumps(_fast_dumps, _encode_errors)
+
+# Exceptions raised by loads() for text that is not JSON
+DecodeError = ValueError
+
+
+def loads(message):
+    """Decode the text (or bytes) of a frame."""
+    try:
+        return _loads(message)
+    except _errors:
+        if BACKEND == "json":
+            raise
+    # Not strict JSON, e.g. NaN values: json raises ValueError if it is not JSON at all
+    return json.loads(message)
+
+
+def dumps(obj):
+    """Encode a frame as JSON text."""
+    return _dumps(obj)
+
+
+def frame_kind(data):
+    """Classify a decoded frame as RESPONSE, ERROR, DATA, LOG or OTHER."""
+    command = data.get("command")
+    if command == "error":
+        return ERROR
+    obj = data.get("object")
+    if obj in STREAM_OBJECTS:
+        return LOG
+    if obj in SUBSCRIPTION_OBJECTS:
+        # Subscription confirmations echo the request; streamed data carries the measured "value"
+        payload = data.get("payload")
+        if isinstance(payload, dict) and isinstance(payload.get("value"), dict):
+            return DATA
+    return RESPONSE if command == "response" else OTHER
+
+
+class Frame:
+    """A decoded frame with its command, object name and payload as attributes."""
+
+    __slots__ = ("command", "object", "payload")
+    kind = OTHER
+
+    def __init__(self, command, obj, payload):
+        self.command = command
+        self.object = obj
+        self.payload = payload
+
+    def __repr__(self):
+        return f"{type(self).__name__}(command={self.command!r}, object={self.object!r})"
+
+    def as_dict(self):
+        return {"command": self.command, "object": self.object, "payload": self.payload}
+
+
+class ResponseFrame(Frame):
+    """Reply to a set or get command."""
+
+    __slots__ = ()
+    kind = RESPONSE
+
+    @property
+    def value(self):
+        return self.payload.get("value")
+
+
+class ErrorFrame(Frame):
+    """Error reply; object is None when the server did not name the object."""
+
+    __slots__ = ()
+    kind = ERROR
+
+    @property
+    def title(self):
+        return self.payload.get("title") or "Unknown error"
+
+    @property
+    def details(self):
+        return self.payload.get("details", "")
+
+
+class MeasurementFrame(Frame):
+    """Streamed line or map data of a MeasurementDataSubscription."""
+
+    __slots__ = ("type", "channel", "format", "value")
+    kind = DATA
+
+    def __init__(self, command, obj, payload):
+        super().__init__(command, obj, payload)
+        self.type = payload.get("type")
+        self.channel = payload.get("channel")
+        self.format = payload.get("format", "float")
+        self.value = payload["value"]
+
+    def __repr__(self):
+        return f"MeasurementFrame(type={self.type!r}, channel={self.channel}, format={self.format!r})"
+
+    @property
+    def y_position(self):
+        row = self.value.get("y_position", self.payload.get("y_position"))
+        return None if row is None else int(row)
+
+    def line(self, dtype=BASE64_DTYPE):
+        """The line as LineData, see afm_api.decoding.decode_line()."""
+        return decode_line(self.payload, dtype)
+
+    def map(self, dtype=BASE64_DTYPE):
+        """The decoded vectors of a map frame, see afm_api.decoding.decode_map()."""
+        return decode_map(self.payload, dtype)
+
+
+class LogFrame(Frame):
+    """LogEvent message of a log subscription."""
+
+    __slots__ = ()
+    kind = LOG
+
+    @property
+    def level(self):
+        return self.payload.get("level")
+
+    @property
+    def message(self):
+        return self.payload.get("message")
+
+    @property
+    def timestamp(self):
+        return self.payload.get("timestamp")
+
+
+_FRAME_TYPES = {RESPONSE: ResponseFrame, ERROR: ErrorFrame, DATA: MeasurementFrame, LOG: LogFrame, OTHER: Frame}
+
+
+def typed_frame(data, kind=None):
+    """The typed Frame of a decoded frame dict."""
+    kind = frame_kind(data) if kind is None else kind
+    payload = data.get("payload")
+    return _FRAME_TYPES[kind](data.get("command"), data.get("object"), payload if payload is not None else {})
+
+
+def decode_frame(message):
+    """Decode the text of a frame into its typed Frame."""
+    return typed_frame(loads(message))
+
+
+class Command(namedtuple("Command", ("command", "object", "payload"))):
+    """
+    A (command, object, payload) tuple whose wire text is encoded once, in message. Commands can be used
+    wherever AFMClient takes such tuples, e.g. in pipeline(); the payload must not be changed afterwards.
+    """
+
+    def __new__(cls, command, obj, payload):
+        self = super().__new__(cls, command, obj, payload)
+        self.message = encode_command(command, obj, payload)
+        return self
+
+
+@functools.lru_cache(maxsize=256)
+def trigger_command(obj):
+    """The cached Command that triggers an action object, e.g. ActionMeasurementStart."""
+    return Command("set", obj, {"property": "triggered", "value": True})
+
+
+@functools.lru_cache(maxsize=256)
+def get_command(obj, property="value"):
+    """The cached Command that reads a property of an object."""
+    return Command("get", obj, {"property": property})
+
+
+def encode_command(command, obj, payload):
+    """The wire text of a command."""
+    return dumps({"command": command, "object": obj, "payload": payload})
@@ -0,0 +1,329 @@
+"""
+Connection health monitoring with APIEcho latency probes
+
+HealthMonitor sends "APIEcho" requests with a unique, timestamped "property" at a fixed rate on an
+AFMClient, next to whatever subscriptions are streaming on it, and records each round-trip time in a
+LatencyHistogram. Because probes share the socket with line data, a saturated link shows up as growing
+RTT long before replies time out.
+
+Besides the RTT percentiles, the monitor counts timeouts, errors, disconnects and reconnects, and tracks
+stream lag: the age of the most recent line/map frame and, for frames carrying a server send time
+("server_time", e.g. from the mock server), the send-to-receive delay.
+
+Usage as a CLI:
+    python -m afm_api.health --uri ws://127.0.0.1:1234 --api-key KEY --rate 10 --subscribe 0
+
+Run from the examples/python directory.
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import time
+
+import numpy as np
+
+from .client import AFMClient
+from .errors import AFMConnectionError, AFMError
+from .streams import stream_key
+
+
+class LatencyHistogram:
+    """
+    HDR-style histogram of latencies with a bounded relative error.
+
+    Values are recorded in microseconds into log-linear buckets: each power of two is split into
+    2 ** (significant_bits - 1) linear sub-buckets, so the relative error of every reported value is below
+    2 ** -(significant_bits - 1) (under 1 % with the default of 8 bits) while the memory use stays fixed,
+    independent of the number of samples. Values above the highest trackable value are clamped to it.
+    """
+
+    def __init__(self, highest=60.0, significant_bits=8):
+        self.sub_bucket_count = 1 << significant_bits
+        self.sub_bucket_half = self.sub_bucket_count >> 1
+        self.highest = int(highest * 1e6)
+        self.counts = np.zeros(self._index(self.highest) + 1, dtype=np.int64)
+        self.reset()
+
+    def reset(self):
+        self.counts[:] = 0
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = 0.0
+
+    def _index(self, value):
+        if value < self.sub_bucket_count:
+            return value
+        shift = value.bit_length() - self.sub_bucket_half.bit_length()
+        return shift * self.sub_bucket_half + (value >> shift)
+
+    def _upper(self, index):
+        """Highest value (in microseconds) that falls into the bucket."""
+        if index < self.sub_bucket_count:
+            return index
+        shift = (index - self.sub_bucket_count) // self.sub_bucket_half + 1
+        return ((index - shift * self.sub_bucket_half + 1) << shift) - 1
+
+    def record(self, seconds):
+        micros = min(max(int(seconds * 1e6), 0), self.highest)
+        self.counts[self._index(micros)] += 1
+        self.count += 1
+        self.total += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+
+    def merge(self, other):
+        """Add the samples of another histogram with the same configuration."""
+        self.counts += other.counts
+        self.count += other.count
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def percentile(self, percent):
+        """Value in seconds below or at which the given percentage of the samples lie, None if empty."""
+        if not self.count:
+            return None
+        rank = max(math.ceil(percent / 100 * self.count), 1)
+        index = int(np.searchsorted(np.cumsum(self.counts), rank))
+        return min(self._upper(index) / 1e6, self.max)
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    def as_dict(self, scale=1e3):
+        """Summary in milliseconds (or another unit given by scale)."""
+        def scaled(value):
+            return None if value is None else round(float(value) * scale, 3)
+        return {
+            "count": self.count,
+            "min": scaled(self.min if self.count else None),
+            "mean": scaled(self.mean),
+            "p50": scaled(self.percentile(50)),
+            "p90": scaled(self.percentile(90)),
+            "p99": scaled(self.percentile(99)),
+            "p999": scaled(self.percentile(99.9)),
+            "max": scaled(self.max if self.count else None),
+        }
+
+
+class HealthMonitor:
+    """
+    Periodic APIEcho probing and stream lag tracking for an AFMClient.
+
+    start() and stop() must be called on the event loop of the client. snapshot() only reads counters and
+    may also be called from a GUI thread for display.
+    """
+
+    def __init__(self, client, rate=1.0, timeout=None):
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.client = client
+        self.rate = rate
+        self.timeout = timeout
+
+        self.rtt = LatencyHistogram()
+        self.stream_lag = LatencyHistogram()
+        self.last_rtt = None
+        self.probes = 0
+        self.timeouts = 0
+        self.errors = 0
+        self.mismatched = 0
+        self.disconnects = 0
+        self.reconnects = 0
+        self.frames = 0
+        self.last_frame = None
+        self.last_stream_lag = None
+
+        self._sequence = 0
+        self._lost = False
+        self._task = None
+
+    @property
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        if self.running:
+            return
+        self.client.add_frame_handler(self._on_frame)
+        self.client.add_disconnect_handler(self._on_disconnect)
+        self.client.add_reconnect_handler(self._on_reconnect)
+        self._task = asyncio.ensure_future(self._probe_loop())
+
+    def stop(self):
+        if self._task is None:
+            return
+        self.client.remove_frame_handler(self._on_frame)
+        self.client.remove_disconnect_handler(self._on_disconnect)
+        self.client.remove_reconnect_handler(self._on_reconnect)
+        self._task.cancel()
+        self._task = None
+
+    async def probe(self):
+        """Send one APIEcho request and return its round-trip time in seconds, None if it failed."""
+        self._sequence += 1
+        token = f"health-{self._sequence}-{time.time_ns()}"
+        self.probes += 1
+        sent = time.perf_counter()
+        try:
+            reply = await self.client.get("APIEcho", property=token, timeout=self.timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            return None
+        except (AFMError, AFMConnectionError):
+            self.errors += 1
+            return None
+        rtt = time.perf_counter() - sent
+        if (reply or {}).get("property") != token:
+            # A reply correlated with the wrong request would make the measurement meaningless
+            self.mismatched += 1
+            return None
+        if self._lost:
+            self._lost = False
+            self.reconnects += 1
+        self.rtt.record(rtt)
+        self.last_rtt = rtt
+        return rtt
+
+    async def _probe_loop(self):
+        loop = asyncio.get_running_loop()
+        interval = 1.0 / self.rate
+        deadline = loop.time()
+        while True:
+            if self.client.connected:
+                await self.probe()
+            # Probes are sent on a fixed schedule; slow replies delay the next probe instead of piling up
+            deadline = max(deadline + interval, loop.time())
+            await asyncio.sleep(deadline - loop.time())
+
+    def _on_frame(self, data):
+        if stream_key(data)[0] not in ("line", "map"):
+            return
+        self.frames += 1
+        self.last_frame = time.monotonic()
+        server_time = (data.get("payload") or {}).get("server_time")
+        if server_time is not None:
+            self.last_stream_lag = time.time() - server_time
+            self.stream_lag.record(self.last_stream_lag)
+
+    def _on_disconnect(self, error):
+        self.disconnects += 1
+        self._lost = True
+
+    def _on_reconnect(self, attempts, downtime):
+        # Automatic reconnects of the client; the connection was lost once and restored
+        self.disconnects += 1
+        self.reconnects += 1
+
+    def reset(self):
+        """Start a new measurement interval for the histograms; the counters keep running."""
+        self.rtt.reset()
+        self.stream_lag.reset()
+
+    @property
+    def frame_age(self):
+        """Seconds since the last streamed line/map frame, None if none was received."""
+        return None if self.last_frame is None else time.monotonic() - self.last_frame
+
+    def snapshot(self):
+        def ms(value):
+            return None if value is None else round(value * 1e3, 3)
+        frame_age = self.frame_age
+        return {
+            "connected": self.client.connected,
+            "rtt_current_ms": ms(self.last_rtt),
+            "rtt_ms": self.rtt.as_dict(),
+            "probes": self.probes,
+            "timeouts": self.timeouts,
+            "errors": self.errors,
+            "mismatched": self.mismatched,
+            "disconnects": self.disconnects,
+            "reconnects": self.reconnects,
+            "frames": self.frames,
+            "frame_age_s": None if frame_age is None else round(frame_age, 3),
+            "stream_lag_current_ms": ms(self.last_stream_lag),
+            "stream_lag_ms": self.stream_lag.as_dict(),
+        }
+
+    def alarms(self, max_rtt_p99=None, max_frame_age=None, max_stream_lag_p99=None):
+        """Return a list of human readable alarm messages for the given thresholds (seconds)."""
+        alarms = []
+        if not self.client.connected:
+            alarms.append("not connected")
+        p99 = self.rtt.percentile(99)
+        if max_rtt_p99 is not None and p99 is not None and p99 > max_rtt_p99:
+            alarms.append(f"RTT p99 {p99 * 1e3:.1f} ms above {max_rtt_p99 * 1e3:.1f} ms")
+        frame_age = self.frame_age
+        if max_frame_age is not None and frame_age is not None and frame_age > max_frame_age:
+            alarms.append(f"no stream data for {frame_age:.1f} s")
+        lag_p99 = self.stream_lag.percentile(99)
+        if max_stream_lag_p99 is not None and lag_p99 is not None and lag_p99 > max_stream_lag_p99:
+            alarms.append(f"stream lag p99 {lag_p99 * 1e3:.1f} ms above {max_stream_lag_p99 * 1e3:.1f} ms")
+        return alarms
+
+
+def format_report(report):
+    rtt = report["rtt_ms"]
+    line = (f"RTT {report['rtt_current_ms']} ms (p50 {rtt['p50']}, p99 {rtt['p99']}, max {rtt['max']} ms), "
+            f"timeouts {report['timeouts']}, errors {report['errors']}, reconnects {report['reconnects']}")
+    if report["frames"]:
+        line += f", frames {report['frames']}, last frame {report['frame_age_s']} s ago"
+        if report["stream_lag_ms"]["count"]:
+            line += f", stream lag p99 {report['stream_lag_ms']['p99']} ms"
+    return line
+
+
+async def monitor(args):
+    async with AFMClient(args.uri, args.api_key, args.timeout, reconnect=args.reconnect) as client:
+        for channel in args.subscribe:
+            await client.subscribe_measurement_data(channel, "line", args.format)
+        health = HealthMonitor(client, args.rate, args.timeout)
+        # Every interval is reported on its own, the whole run is kept in separate histograms
+        run_rtt = LatencyHistogram()
+        run_stream_lag = LatencyHistogram()
+        health.start()
+        started = time.monotonic()
+        try:
+            while not args.duration or time.monotonic() - started < args.duration:
+                await asyncio.sleep(args.interval)
+                alarms = health.alarms(None if args.max_rtt_p99 is None else args.max_rtt_p99 / 1e3)
+                print(format_report(health.snapshot()) + "".join(f"  ALARM: {alarm}" for alarm in alarms))
+                run_rtt.merge(health.rtt)
+                run_stream_lag.merge(health.stream_lag)
+                health.reset()
+        finally:
+            health.stop()
+            run_rtt.merge(health.rtt)
+            run_stream_lag.merge(health.stream_lag)
+            report = health.snapshot()
+            report["rtt_ms"] = run_rtt.as_dict()
+            report["stream_lag_ms"] = run_stream_lag.as_dict()
+            print(json.dumps(report, indent=2))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--uri", default="ws://127.0.0.1:1234")
+    parser.add_argument("--api-key", default="AFM-Control-API-Key")
+    parser.add_argument("--rate", type=float, default=10.0, help="probes per second")
+    parser.add_argument("--timeout", type=float, default=5.0, help="probe timeout in seconds")
+    parser.add_argument("--interval", type=float, default=1.0, help="seconds between reports")
+    parser.add_argument("--duration", type=float, default=0, help="seconds to run, 0 until interrupted")
+    parser.add_argument("--subscribe", type=int, nargs="*", default=[], metavar="CHANNEL",
+                        help="line channels to subscribe to while probing")
+    parser.add_argument("--format", default="base64", choices=["float", "txt", "base64"])
+    parser.add_argument("--reconnect", action="store_true", help="reconnect automatically when the link drops")
+    parser.add_argument("--max-rtt-p99", type=float, help="alarm threshold for the RTT p99 in ms")
+    args = parser.parse_args()
+    try:
+        asyncio.run(monitor(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
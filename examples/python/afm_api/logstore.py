@@ -0,0 +1,434 @@
+"""
+Title: Indexed on-disk store for the AFM Control log stream
+
+Description:
+LogEvent frames of the "log" DataSubscription can arrive in bursts of thousands. Printing each of them to
+a Tk Text widget slows down the whole GUI. This module moves them off the hot path:
+
+- LogSink is a frame handler that only appends the LogEvent payload to a pending queue. A writer thread
+  parses the events and writes them to SQLite in batches, one transaction per batch.
+- LogStore is the SQLite database (WAL mode, so queries do not block the writer). It has indexes on time,
+  level and scan, and old rows are deleted beyond max_rows, so the file does not grow without bound.
+- Scans are delimited by the "Measurement started" and "Measurement finished/stopped" log messages. Every
+  event is stored with the scan it occurred in, so a query like "errors during scan 12" is one index lookup:
+
+      store.query(level="error", scan=12)
+
+- LogTail keeps the newest formatted lines for a GUI console, which shows only this bounded tail.
+
+Usage:
+    python -m afm_api.logstore afm_log.sqlite --scans
+    python -m afm_api.logstore afm_log.sqlite --level error --scan 12
+    python -m afm_api.logstore afm_log.sqlite --record --uri ws://127.0.0.1:1234
+
+Run from the examples/python directory.
+"""
+
+import argparse
+import asyncio
+import re
+import sqlite3
+import threading
+import time
+from collections import deque, namedtuple
+
+LEVELS = ("debug", "info", "warning", "error", "critical")
+_LEVEL_NUMBERS = {name: number for number, name in enumerate(LEVELS)}
+_LEVEL_NUMBERS.update({"warn": 2, "err": 3, "fatal": 4})
+
+# Log messages that start and end a scan
+SCAN_START = re.compile(r"measurement started", re.IGNORECASE)
+SCAN_END = re.compile(r"measurement (finished|stopped|aborted)", re.IGNORECASE)
+
+LogRecord = namedtuple("LogRecord", ("id", "time", "level", "message", "instrument", "scan"))
+Scan = namedtuple("Scan", ("id", "instrument", "started", "ended", "status"))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS scans (
+    id INTEGER PRIMARY KEY,
+    instrument TEXT,
+    started REAL NOT NULL,
+    ended REAL,
+    status TEXT
+);
+CREATE TABLE IF NOT EXISTS log (
+    id INTEGER PRIMARY KEY,
+    time REAL NOT NULL,
+    level INTEGER NOT NULL,
+    message TEXT NOT NULL,
+    instrument TEXT,
+    scan INTEGER
+);
+CREATE INDEX IF NOT EXISTS log_time ON log (time);
+CREATE INDEX IF NOT EXISTS log_level_time ON log (level, time);
+CREATE INDEX IF NOT EXISTS log_scan_level ON log (scan, level);
+"""
+
+
+def level_number(level):
+    """Numeric level (index into LEVELS) of a level name; unknown names count as info."""
+    if isinstance(level, int):
+        return min(max(level, 0), len(LEVELS) - 1)
+    return _LEVEL_NUMBERS.get(str(level).strip().lower(), 1)
+
+
+def parse_log_event(payload, received):
+    """(time, level number, message) of a LogEvent payload; the receive time stands in for a missing timestamp."""
+    if not isinstance(payload, dict):
+        return received, 1, str(payload)
+    message = payload.get("message")
+    if message is None:
+        message = payload.get("value", "")
+    timestamp = payload.get("timestamp")
+    try:
+        timestamp = float(timestamp) if timestamp is not None else received
+    except (TypeError, ValueError):
+        timestamp = received
+    return timestamp, level_number(payload.get("level", "info")), str(message)
+
+
+def format_record(timestamp, level, message, instrument=None):
+    """One console line of a log event."""
+    clock = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(timestamp))
+    source = f"{instrument} " if instrument else ""
+    return f"[{clock}] {source}{LEVELS[level]}: {message}"
+
+
+class LogStore:
+    """SQLite database of log events and scans. A LogStore (like its connection) belongs to one thread."""
+
+    def __init__(self, path, max_rows=1_000_000):
+        self.path = path
+        # Oldest events beyond this number are deleted by prune()
+        self.max_rows = max_rows
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        # Durable enough for a log; a power failure loses at most the last batches
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(_SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    # Writing
+
+    def insert(self, rows):
+        """Insert (time, level, message, instrument, scan) rows in one transaction."""
+        with self.connection:
+            self.connection.executemany(
+                "INSERT INTO log (time, level, message, instrument, scan) VALUES (?, ?, ?, ?, ?)", rows)
+
+    def start_scan(self, instrument, started):
+        with self.connection:
+            cursor = self.connection.execute("INSERT INTO scans (instrument, started) VALUES (?, ?)",
+                                             (instrument, started))
+        return cursor.lastrowid
+
+    def end_scan(self, scan, ended, status):
+        with self.connection:
+            self.connection.execute("UPDATE scans SET ended = ?, status = ? WHERE id = ?", (ended, status, scan))
+
+    def prune(self):
+        """Delete the oldest events beyond max_rows. Returns the number of deleted events."""
+        with self.connection:
+            cursor = self.connection.execute(
+                "DELETE FROM log WHERE id <= (SELECT MAX(id) FROM log) - ?", (self.max_rows,))
+        return cursor.rowcount
+
+    # Queries
+
+    def query(self, level=None, scan=None, instrument=None, since=None, until=None, contains=None, limit=1000,
+              newest_first=False):
+        """
+        Log events matching all given conditions: at least the given level, in the given scan, of the given
+        instrument, in the time range [since, until) and containing the given text.
+        """
+        conditions = []
+        values = []
+        if level is not None:
+            conditions.append("level >= ?")
+            values.append(level_number(level))
+        if scan is not None:
+            conditions.append("scan = ?")
+            values.append(scan)
+        if instrument is not None:
+            conditions.append("instrument = ?")
+            values.append(instrument)
+        if since is not None:
+            conditions.append("time >= ?")
+            values.append(since)
+        if until is not None:
+            conditions.append("time < ?")
+            values.append(until)
+        if contains:
+            conditions.append("instr(message, ?) > 0")
+            values.append(contains)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        order = "DESC" if newest_first else "ASC"
+        rows = self.connection.execute(
+            f"SELECT id, time, level, message, instrument, scan FROM log {where} ORDER BY id {order} LIMIT ?",
+            values + [limit])
+        return [LogRecord(id_, time_, LEVELS[level], message, instrument_, scan_)
+                for id_, time_, level, message, instrument_, scan_ in rows]
+
+    def scans(self, instrument=None, limit=100):
+        """The newest scans, newest first."""
+        if instrument is None:
+            rows = self.connection.execute("SELECT * FROM scans ORDER BY id DESC LIMIT ?", (limit,))
+        else:
+            rows = self.connection.execute("SELECT * FROM scans WHERE instrument = ? ORDER BY id DESC LIMIT ?",
+                                           (instrument, limit))
+        return [Scan(*row) for row in rows]
+
+    def counts(self, scan=None):
+        """Number of events per level name, in one scan or overall."""
+        if scan is None:
+            rows = self.connection.execute("SELECT level, COUNT(*) FROM log GROUP BY level")
+        else:
+            rows = self.connection.execute("SELECT level, COUNT(*) FROM log WHERE scan = ? GROUP BY level", (scan,))
+        return {LEVELS[level]: count for level, count in rows}
+
+
+class LogTail:
+    """The newest formatted log lines, shared between the writer thread and a GUI thread."""
+
+    def __init__(self, maxlen=1000):
+        self.maxlen = maxlen
+        # Number of lines ever added; a consumer keeps the count it has seen as its cursor
+        self.total = 0
+        self._lines = deque(maxlen=maxlen)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._lines)
+
+    def extend(self, lines):
+        with self._lock:
+            self._lines.extend(lines)
+            self.total += len(lines)
+
+    def since(self, cursor):
+        """(lines added after cursor that are still kept, new cursor)."""
+        with self._lock:
+            new = min(self.total - cursor, len(self._lines))
+            lines = list(self._lines)[len(self._lines) - new:] if new > 0 else []
+            return lines, self.total
+
+    def lines(self):
+        with self._lock:
+            return list(self._lines)
+
+
+class LogSink:
+    """
+    Frame handler that records LogEvent frames to a LogStore from a writer thread.
+
+    The handler itself only queues the payload; parsing, scan tracking, formatting for the tail and the
+    database writes run on the writer thread, in batches of up to batch_size events at least every
+    flush_interval seconds. When more than max_pending events wait for the writer, new ones are dropped and
+    counted in dropped rather than slowing down the caller.
+    """
+
+    def __init__(self, path, batch_size=1000, flush_interval=0.25, max_rows=1_000_000, tail=1000,
+                 max_pending=100_000, prune_interval=10_000):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_rows = max_rows
+        self.max_pending = max_pending
+        # Events written between two prunes of the oldest rows
+        self.prune_interval = prune_interval
+        self.tail = LogTail(tail)
+        self.written = 0
+        self.dropped = 0
+        self.batches = 0
+        # Current scan per instrument, and the database ids of scans
+        self.current_scans = {}
+
+        self._pending = deque()
+        self._wake = threading.Event()
+        self._flushed = threading.Condition()
+        self._received = 0
+        self._stopping = False
+        self._clients = {}
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name="afm-log-sink", daemon=True)
+        self._ready = threading.Event()
+        self._thread.start()
+        self._ready.wait()
+        if self._error is not None:
+            raise self._error
+
+    # Producer side, called on the client's event loop
+
+    def handler(self, data, instrument=None):
+        """Frame handler: queues LogEvent frames and ignores all other frames."""
+        if data.get("object") != "LogEvent":
+            return
+        if len(self._pending) >= self.max_pending:
+            self.dropped += 1
+            return
+        self._pending.append((time.time(), data.get("payload"), instrument))
+        self._received += 1
+        if len(self._pending) >= self.batch_size:
+            self._wake.set()
+
+    def attach(self, client, instrument=None):
+        """Record the log frames of an AFMClient, tagged with the instrument name if given."""
+        handler = self.handler if instrument is None else (lambda data: self.handler(data, instrument))
+        self._clients[id(client)] = (client, handler)
+        client.add_frame_handler(handler)
+        return self
+
+    def detach(self, client):
+        client_handler = self._clients.pop(id(client), None)
+        if client_handler is not None:
+            client.remove_frame_handler(client_handler[1])
+
+    # Writer thread
+
+    def _run(self):
+        try:
+            store = LogStore(self.path, self.max_rows)
+        except Exception as e:
+            self._error = e
+            self._ready.set()
+            return
+        self._ready.set()
+        since_prune = 0
+        try:
+            while True:
+                self._wake.wait(self.flush_interval)
+                self._wake.clear()
+                stopping = self._stopping
+                while self._pending:
+                    count = self._write_batch(store)
+                    since_prune += count
+                    if since_prune >= self.prune_interval:
+                        store.prune()
+                        since_prune = 0
+                with self._flushed:
+                    self._flushed.notify_all()
+                if stopping:
+                    break
+        finally:
+            store.close()
+
+    def _write_batch(self, store):
+        rows = []
+        lines = []
+        for _ in range(min(self.batch_size, len(self._pending))):
+            received, payload, instrument = self._pending.popleft()
+            timestamp, level, message = parse_log_event(payload, received)
+            scan = self.current_scans.get(instrument)
+            if SCAN_START.search(message):
+                if scan is not None:
+                    store.end_scan(scan, timestamp, "interrupted")
+                scan = self.current_scans[instrument] = store.start_scan(instrument, timestamp)
+            rows.append((timestamp, level, message, instrument, scan))
+            lines.append(format_record(timestamp, level, message, instrument))
+            match = SCAN_END.search(message)
+            if match and scan is not None:
+                store.end_scan(scan, timestamp, match.group(1).lower())
+                del self.current_scans[instrument]
+        store.insert(rows)
+        self.tail.extend(lines)
+        self.written += len(rows)
+        self.batches += 1
+        return len(rows)
+
+    # Control
+
+    def flush(self, timeout=5.0):
+        """Wait until everything queued so far has been written. Returns False on timeout."""
+        target = self._received
+        deadline = time.monotonic() + timeout
+        with self._flushed:
+            while self.written < target:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self._thread.is_alive():
+                    return False
+                self._wake.set()
+                self._flushed.wait(remaining)
+        return True
+
+    def close(self, timeout=5.0):
+        """Detach from all clients, write what is pending and stop the writer thread."""
+        for client, handler in list(self._clients.values()):
+            client.remove_frame_handler(handler)
+        self._clients.clear()
+        self._stopping = True
+        self._wake.set()
+        self._thread.join(timeout)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def store(self):
+        """A new LogStore on the same database for queries in the calling thread."""
+        return LogStore(self.path, self.max_rows)
+
+
+async def record(args):
+    from .client import AFMClient
+
+    sink = LogSink(args.database)
+    try:
+        async with AFMClient(args.uri, args.api_key) as client:
+            sink.attach(client)
+            await client.subscribe_log()
+            print(f"Recording the log of {args.uri} to {args.database}, Ctrl+C to stop")
+            cursor = 0
+            while True:
+                await asyncio.sleep(0.5)
+                lines, cursor = sink.tail.since(cursor)
+                for line in lines:
+                    print(line)
+    finally:
+        sink.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("database", help="SQLite log database")
+    parser.add_argument("--scans", action="store_true", help="list the newest scans")
+    parser.add_argument("--level", choices=LEVELS, help="minimum level")
+    parser.add_argument("--scan", type=int, help="only events of this scan")
+    parser.add_argument("--instrument")
+    parser.add_argument("--contains", help="only messages containing this text")
+    parser.add_argument("--limit", type=int, default=100)
+    parser.add_argument("--record", action="store_true", help="record the log of a server until interrupted")
+    parser.add_argument("--uri", default="ws://127.0.0.1:1234")
+    parser.add_argument("--api-key", default="AFM-Control-API-Key")
+    args = parser.parse_args()
+
+    if args.record:
+        try:
+            asyncio.run(record(args))
+        except KeyboardInterrupt:
+            pass
+        return
+    with LogStore(args.database) as store:
+        if args.scans:
+            for scan in store.scans(args.instrument, args.limit):
+                ended = time.strftime("%H:%M:%S", time.localtime(scan.ended)) if scan.ended else "running"
+                print(f"scan {scan.id:5d}  {scan.instrument or '':10s}  "
+                      f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(scan.started))} to {ended}  "
+                      f"{scan.status or ''}  {store.counts(scan.id)}")
+            return
+        for entry in store.query(args.level, args.scan, args.instrument, contains=args.contains, limit=args.limit,
+                                 newest_first=True)[::-1]:
+            print(format_record(entry.time, level_number(entry.level), entry.message, entry.instrument))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,315 @@
+"""
+Streaming parser for MeasurementData image transfers
+
+"get MeasurementData" with "type": "image" returns the last measurement as one JSON message whose "value" is
+a Gwyddion-like ASCII block: metadata lines ("# Width: 10 µm") followed by an NxN matrix of numbers, one
+image row per line. Decoding it with json.loads and splitting the string creates several full copies of a
+text of many megabytes (about 13 MB for 1024x1024) before a single number is converted.
+
+ImageParser works on the undecoded message instead (see AFMClient.request_raw()): it locates the "value"
+string, unescapes it in chunks of complete lines and converts the rows of every chunk in one vectorized
+step straight into a preallocated array. Besides the message itself, memory is bounded by one chunk and
+the array; with a .npy output the array is a memory-mapped file, so the image never has to fit in RAM.
+
+    image = await fetch_image(client, channel=0, path="scan.npy")
+    image.metadata["Width"], image.data.shape
+
+Images can also be saved in the native Gwyddion format (.gwy) with write_gwy().
+
+Usage:
+    python -m afm_api.measurement_data --uri ws://127.0.0.1:1234 --api-key KEY --channel 0 scan.gwy
+
+Run from the examples/python directory.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import re
+import struct
+import time
+
+import numpy as np
+
+from .client import AFMClient
+
+# Characters of the undecoded message unescaped and converted at a time
+CHUNK_SIZE = 1 << 20
+
+_VALUE_RE = re.compile(r'"value"\s*:\s*"')
+_NUMBER_START = frozenset("0123456789+-.")
+
+# Length units of the metadata, in meters
+LENGTH_UNITS = {"m": 1.0, "mm": 1e-3, "µm": 1e-6, "um": 1e-6, "nm": 1e-9, "pm": 1e-12, "Å": 1e-10}
+
+
+class MeasurementImage:
+    """A measurement map with its metadata. data is a (rows, columns) float array."""
+
+    __slots__ = ("metadata", "data", "payload")
+
+    def __init__(self, metadata, data, payload=None):
+        self.metadata = metadata
+        self.data = data
+        # The reply payload without its "value" (format, type, channel)
+        self.payload = payload or {}
+
+    def __repr__(self):
+        return f"MeasurementImage(shape={self.data.shape}, metadata={len(self.metadata)} entries)"
+
+    @property
+    def size(self):
+        """(width, height) in meters, or None if the metadata does not contain them."""
+        try:
+            return parse_length(self.metadata["Width"]), parse_length(self.metadata["Height"])
+        except (KeyError, ValueError):
+            return None
+
+
+def parse_length(text):
+    """Convert a length such as "10 µm" to meters."""
+    match = re.match(r"\s*([-+0-9.eE]+)\s*(\S*)", str(text))
+    if not match:
+        raise ValueError(f"Cannot parse length {text!r}")
+    unit = match.group(2) or "m"
+    if unit not in LENGTH_UNITS:
+        raise ValueError(f"Unknown length unit {unit!r}")
+    return float(match.group(1)) * LENGTH_UNITS[unit]
+
+
+def _is_data_line(line):
+    line = line.lstrip()
+    return bool(line) and (line[0] in _NUMBER_START or line[:3].lower() in ("nan", "inf"))
+
+
+def _string_end(message, start, end):
+    # Index of the closing quote of a JSON string in message[start:end], or -1
+    quote = message.find('"', start, end)
+    while quote >= 0:
+        backslashes = 0
+        while quote - backslashes - 1 >= start and message[quote - backslashes - 1] == "\\":
+            backslashes += 1
+        if backslashes % 2 == 0:
+            return quote
+        quote = message.find('"', quote + 1, end)
+    return -1
+
+
+def _line_break(message, start, end):
+    # Index just behind the last escaped line break ("\n") in message[start:end], or -1
+    index = message.rfind("\\n", start, end)
+    while index >= 0:
+        backslashes = 0
+        while index - backslashes - 1 >= start and message[index - backslashes - 1] == "\\":
+            backslashes += 1
+        if backslashes % 2 == 0:
+            return index + 2
+        index = message.rfind("\\n", start, index)
+    return -1
+
+
+class ImageParser:
+    """
+    Incremental parser of the ASCII image text: feed() it text in pieces of any size, then call close().
+
+    The array is allocated when the first row arrives, with the shape from the XRes/YRes metadata or else
+    from the number of values in that row (the map is square). With out set to a .npy path, rows are
+    written into a memory-mapped .npy file instead of an in-memory array.
+    """
+
+    def __init__(self, out=None, dtype=np.float64):
+        self.out = out
+        self.dtype = dtype
+        self.metadata = {}
+        self.payload = {}
+        self.data = None
+        self.rows = 0
+        self._flat = None
+        self._filled = 0
+        self._tail = ""
+        self._header = True
+
+    def feed(self, text):
+        """Parse the next piece of decoded text."""
+        text = self._tail + text
+        end = text.rfind("\n") + 1
+        self._tail = text[end:]
+        if end:
+            self._parse(text[:end])
+
+    def _parse(self, block):
+        while self._header and block:
+            line, _, rest = block.partition("\n")
+            if _is_data_line(line):
+                self._allocate(len(line.split()))
+                self._header = False
+                break
+            key, separator, value = line.lstrip("#").partition(":")
+            if not separator:
+                key, separator, value = key.partition("=")
+            if separator:
+                self.metadata[key.strip()] = value.strip()
+            block = rest
+        if not self._header and block.strip():
+            self._convert(block)
+
+    def _allocate(self, columns):
+        columns = int(self.metadata.get("XRes", columns))
+        rows = int(self.metadata.get("YRes", columns))
+        if self.out is not None and os.path.splitext(self.out)[1].lower() == ".npy":
+            self.data = np.lib.format.open_memmap(self.out, mode="w+", dtype=self.dtype, shape=(rows, columns))
+        else:
+            self.data = np.empty((rows, columns), self.dtype)
+        self._flat = self.data.reshape(-1)
+
+    def _convert(self, block):
+        # Whitespace (tabs, spaces, line breaks) separates the values of all rows alike
+        values = np.fromstring(block, dtype=self.dtype, sep=" ")
+        columns = self.data.shape[1]
+        if values.size % columns:
+            raise ValueError(f"Row with other than {columns} values after row {self.rows}")
+        end = self._filled + values.size
+        if end > self._flat.size:
+            raise ValueError(f"More than {self.data.shape[0]} rows of image data")
+        self._flat[self._filled:end] = values
+        self._filled = end
+        self.rows = end // columns
+
+    def close(self):
+        """Parse the remaining text and return the MeasurementImage. Raises ValueError if rows are missing."""
+        if self._tail:
+            tail, self._tail = self._tail, ""
+            self._parse(tail + "\n")
+        if self.data is None:
+            # Metadata only
+            return MeasurementImage(self.metadata, np.empty((0, 0), self.dtype), self.payload)
+        if self._filled != self._flat.size:
+            raise ValueError(f"Incomplete image: {self.rows} of {self.data.shape[0]} rows")
+        if isinstance(self.data, np.memmap):
+            self.data.flush()
+        return MeasurementImage(self.metadata, self.data, self.payload)
+
+    def parse_message(self, message, chunk_size=CHUNK_SIZE):
+        """Parse a complete undecoded "response" message of MeasurementData. Returns the MeasurementImage."""
+        match = _VALUE_RE.search(message)
+        if match is None:
+            data = json.loads(message)
+            raise ValueError(f"No image text in the reply: {data.get('payload')!r}")
+        position = match.end()
+        while True:
+            end = min(position + chunk_size, len(message))
+            quote = _string_end(message, position, end)
+            if quote >= 0:
+                cut = quote
+            else:
+                cut = _line_break(message, position, end)
+                if cut < 0:
+                    if end == len(message):
+                        raise ValueError("Unterminated image text")
+                    # A line longer than a chunk: look further
+                    chunk_size *= 2
+                    continue
+            self.feed(json.loads('"' + message[position:cut] + '"'))
+            position = cut
+            if quote >= 0:
+                break
+        # Everything but the text is small: decode it with the text left out
+        envelope = json.loads(message[:match.start()] + '"value": null' + message[quote + 1:])
+        self.payload = {key: value for key, value in (envelope.get("payload") or {}).items() if key != "value"}
+        return self.close()
+
+
+async def fetch_image(client, channel=0, data_type="image", path=None, timeout=None):
+    """
+    Get the last measurement of a channel with "get MeasurementData" and parse it while it is decoded.
+
+    With path, the image is saved: .npy files are written row by row as a memory map, .gwy files are
+    written with write_gwy() once the image is complete.
+    """
+    npy = path is not None and os.path.splitext(path)[1].lower() == ".npy"
+    parser = ImageParser(path if npy else None)
+    payload = {"property": "value", "format": "txt", "type": data_type, "channel": channel}
+    image = await client.request_raw("get", "MeasurementData", payload, parser.parse_message, timeout)
+    if path is not None and not npy:
+        write_gwy(path, image)
+    return image
+
+
+# Gwyddion native file format (GWYP serialization of a GwyContainer)
+
+def _gwy_component(name, kind, data):
+    return name.encode("utf-8") + b"\0" + kind + data
+
+
+def _gwy_string(text):
+    return text.encode("utf-8") + b"\0"
+
+
+def _gwy_object(name, components):
+    body = b"".join(components)
+    return _gwy_string(name) + struct.pack("<I", len(body)) + body
+
+
+def _gwy_unit(unit):
+    return _gwy_object("GwySIUnit", [_gwy_component("unitstr", b"s", _gwy_string(unit))])
+
+
+def write_gwy(path, image, title=None, chunk_rows=64):
+    """
+    Save a MeasurementImage as a Gwyddion .gwy file. Lengths are converted to meters; the values are
+    converted from the "Value units" of the metadata if it is a length unit. Rows are written in chunks.
+    """
+    rows, columns = image.data.shape
+    width, height = image.size or (1.0, 1.0)
+    value_unit = image.metadata.get("Value units", "")
+    scale = LENGTH_UNITS.get(value_unit, 1.0)
+    title = title or image.metadata.get("Channel", "Measurement Data")
+    data_header = _gwy_string("data") + b"D" + struct.pack("<I", rows * columns)
+    field_components = [
+        _gwy_component("xres", b"i", struct.pack("<i", columns)),
+        _gwy_component("yres", b"i", struct.pack("<i", rows)),
+        _gwy_component("xreal", b"d", struct.pack("<d", width)),
+        _gwy_component("yreal", b"d", struct.pack("<d", height)),
+        _gwy_component("si_unit_xy", b"o", _gwy_unit("m")),
+        _gwy_component("si_unit_z", b"o", _gwy_unit("m" if value_unit in LENGTH_UNITS else value_unit)),
+    ]
+    fields = b"".join(field_components)
+    field_size = len(fields) + len(data_header) + rows * columns * 8
+    field_object = _gwy_string("GwyDataField") + struct.pack("<I", field_size)
+    title_component = _gwy_component("/0/data/title", b"s", _gwy_string(title))
+    container_size = len(_gwy_string("/0/data")) + 1 + len(field_object) + field_size + len(title_component)
+    with open(path, "wb") as f:
+        f.write(b"GWYP" + _gwy_string("GwyContainer") + struct.pack("<I", container_size))
+        f.write(_gwy_string("/0/data") + b"o" + field_object + fields + data_header)
+        for start in range(0, rows, chunk_rows):
+            block = np.asarray(image.data[start:start + chunk_rows], dtype="<f8")
+            f.write((np.nan_to_num(block) * scale).astype("<f8").tobytes())
+        f.write(title_component)
+
+
+async def run(args):
+    async with AFMClient(args.uri, args.api_key, args.timeout) as client:
+        started = time.perf_counter()
+        image = await fetch_image(client, args.channel, path=args.output)
+        elapsed = time.perf_counter() - started
+    print(f"{image.data.shape[0]}x{image.data.shape[1]} image of channel {args.channel} in {elapsed:.3f} s, "
+          f"received {client.bytes_received / 1e6:.1f} MB")
+    for key, value in image.metadata.items():
+        print(f"  {key}: {value}")
+    if args.output:
+        print(f"Saved to {args.output}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("output", nargs="?", help="save the image to this .npy or .gwy file")
+    parser.add_argument("--uri", default="ws://127.0.0.1:1234")
+    parser.add_argument("--api-key", default="AFM-Control-API-Key")
+    parser.add_argument("--channel", type=int, default=0)
+    parser.add_argument("--timeout", type=float, default=60.0, help="reply timeout in seconds")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
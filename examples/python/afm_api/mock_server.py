@@ -0,0 +1,707 @@
+"""
+Title: Mock AFM Control API server
+
+Description:
+A standalone asyncio WebSocket server speaking the v1.1 protocol described in docs/API_v1_1/README.md,
+for testing and benchmarking clients without an instrument. It implements:
+
+- "authenticate" as the mandatory first command (optionally checking the API key),
+- "APIEcho",
+- get/set of the scanner, detection, feedback and measurement data objects,
+- ActionMeasurementStart/ActionMeasurementStop and MeasurementStatus,
+- ActionActuationFrequencySweepStart/Stop, FrequencySweepStatus and FoundResonanceProperties of a simulated
+  cantilever, whose response at ActuationFrequency also drives the "amplitude" and "phase" channels,
+- MeasurementData ("image", "metadata" and "map" of the last measurement as Gwyddion-like ASCII text),
+- MeasurementDataSubscription ("line" and "map" in "float", "txt" and "base64") and DataSubscription
+  ("log"), streaming synthetic, seeded and therefore reproducible topography at a configurable
+  resolution and lines per second,
+- the profile modes of ScannerMode (2 and 3): ScannerProfileLine is scanned ScannerProfileLineRepetition
+  times, with fresh noise and a slow height drift per repetition, each repetition streamed as the line at
+  its repetition index.
+
+Usage:
+    python -m afm_api.mock_server --port 1234 --resolution 512 --lines-per-second 20
+
+Run from the examples/python directory. A lines per second value of 0 streams as fast as the clients
+can receive.
+"""
+
+import argparse
+import asyncio
+import base64
+import io
+import json
+import logging
+import time
+
+import numpy as np
+import websockets
+
+from .decoding import BASE64_DTYPE
+
+logger = logging.getLogger(__name__)
+
+RESOLUTIONS = (64, 128, 256, 512, 1024, 2048)
+SIGNALS = ("topography", "phase", "amplitude", "error")
+CORRECTION_MODES = ("none", "line", "Plane", "Paraboloid", "Cubic surface")
+SCANNER_MODES = ("Single scan", "Continuous scanning", "Profile from navigation", "Profile from scan")
+NAVIGATION_MODES = ("ScannerNavigationModeScan", "ScannerNavigationModeProfile", "ScannerNavigationModePoint")
+
+# Plain "value" objects and their initial values
+DEFAULT_VALUES = {
+    "ScannerRange": 10.0,
+    "ScannerCenterX": 0.0,
+    "ScannerCenterY": 0.0,
+    "ScannerRotation": 0.0,
+    "ScannerLinesPerSecond": 1.0,
+    "ScannerMicroMetersPerSecond": 20.0,
+    "ScannerLimitZ": 100.0,
+    "ScannerDeflectionZ": 50.0,
+    "ScannerProfileLine": 1,
+    "ScannerProfileLineRepetition": 1,
+    "ScannerProfileLineLock": False,
+    "AFMPIDConstantP": 10,
+    "AFMPIDConstantI": 290,
+    "AFMAmplitudeSetPoint": 0.3,
+    "ActuationFrequency": 32733.0,
+    "ActuationAmplitude": 50,
+    "ActuationHalfResonanceFrequency": False,
+    "ActuationOutput": 0,
+    "ActuationFrequencySweepStart": 10000.0,
+    "ActuationFrequencySweepStop": 100000.0,
+    "DetectionGainACIn": 1,
+    "DetectionLockInTimeConstant": 6.0,
+    "DetectionMaxPeakBandwidth": 100.0,
+    "DetectionPeakSelectionMode": 0,
+    "DetectionResonanceOffset": 0.0,
+    "DetectionSetpointPercentage": 70.0,
+    "MotorSpeed": 500.0,
+}
+
+# The documentation uses both spellings
+OBJECT_ALIASES = {"ScannerProfileLineRepetitions": "ScannerProfileLineRepetition"}
+# Height drift of the synthetic sample per repetition of a profile line, e.g. from thermal expansion
+PROFILE_DRIFT = 0.002
+
+
+def encode_vector(values, data_format):
+    """Encode a float array the way the server sends it for the given subscription format."""
+    values = np.round(values, 5)
+    if data_format == "base64":
+        return base64.b64encode(values.astype(BASE64_DTYPE).tobytes()).decode("ascii")
+    if data_format == "txt":
+        return [f"{v:.4e}" for v in values.tolist()]
+    return values.tolist()
+
+
+class SyntheticSample:
+    """Deterministic synthetic surface: terraces, bumps and seeded noise per channel."""
+
+    def __init__(self, seed=0, noise=0.02):
+        self.seed = seed
+        self.noise = noise
+
+    def line(self, channel, row, resolution, scan_range, repetition=None):
+        x = np.linspace(0.0, scan_range, resolution)
+        y = scan_range * row / max(resolution - 1, 1)
+        seed = (self.seed, channel, row, resolution) + (() if repetition is None else (repetition,))
+        rng = np.random.default_rng(seed)
+        base = (np.sin(2 * np.pi * x / (scan_range / 3)) * np.cos(2 * np.pi * y / (scan_range / 4))
+                + 0.5 * np.floor(4 * (x + 0.3 * y) / scan_range))
+        if channel % 2:
+            # Phase-like channels: derivative of the height
+            base = np.gradient(base) * resolution / 10
+        forward = base + rng.normal(0.0, self.noise, resolution)
+        backward = base + 0.01 + rng.normal(0.0, self.noise, resolution)
+        return x, forward, backward
+
+
+class Cantilever:
+    """
+    Cantilever as a damped harmonic oscillator; the defaults are the values of the FoundResonanceProperties
+    example in the documentation.
+    """
+
+    def __init__(self, frequency=32733.0, q=3926.04, peak_amplitude=0.393794):
+        self.frequency = frequency
+        self.q = q
+        self.peak_amplitude = peak_amplitude
+
+    def amplitude(self, frequency):
+        """Oscillation amplitude in V when driven at the given frequency."""
+        f0 = self.frequency
+        return (self.peak_amplitude / self.q * f0 ** 2
+                / np.sqrt((f0 ** 2 - frequency ** 2) ** 2 + (frequency * f0 / self.q) ** 2))
+
+    def phase(self, frequency):
+        """Phase lag in degrees, -90 at resonance."""
+        f0 = self.frequency
+        return -np.degrees(np.arctan2(frequency * f0 / self.q, f0 ** 2 - frequency ** 2))
+
+    def found_properties(self, p, i):
+        bandwidth = self.frequency / self.q
+        return {
+            "Ivalue": i,
+            "LITimeConstant_ms": round(50.0 / bandwidth, 5),
+            "Pvalue": p,
+            "QFactor": round(self.q, 2),
+            "peakBandwidth_Hz": round(bandwidth, 5),
+            "resonanceAmplitude_V": self.peak_amplitude,
+            "resonanceFrequencyActuation_Hz": self.frequency,
+            "resonanceFrequencyVibration_Hz": self.frequency / 2,
+        }
+
+
+class _Connection:
+    def __init__(self, websocket):
+        self.websocket = websocket
+        self.authenticated = False
+        # (type, channel) -> format
+        self.subscriptions = {}
+        self.log_subscribed = False
+        self.frames_sent = 0
+
+    async def send(self, data):
+        await self.websocket.send(data if isinstance(data, str) else json.dumps(data))
+        self.frames_sent += 1
+
+
+class MockAFMServer:
+    """In-process mock of the AFM Control WebSocket API server."""
+
+    def __init__(self, host="127.0.0.1", port=1234, api_key=None, resolution=256, lines_per_second=1.0,
+                 channels=2, seed=0, map_interval=16, stamp_frames=False, sweep_duration=2.0):
+        if resolution not in RESOLUTIONS:
+            raise ValueError(f"Resolution must be one of {RESOLUTIONS}")
+        self.host = host
+        self.port = port
+        self.api_key = api_key
+        self.channels = channels
+        self.map_interval = map_interval
+        # Add the server send time ("server_time", time.time()) to streamed payloads for latency tests
+        self.stamp_frames = stamp_frames
+        self.sample = SyntheticSample(seed)
+        self.cantilever = Cantilever()
+        # Seconds an automatic frequency sweep takes
+        self.sweep_duration = sweep_duration
+        self.found_resonance = None
+
+        self.values = dict(DEFAULT_VALUES)
+        self.values["ScannerLinesPerSecond"] = lines_per_second
+        self.resolution_index = RESOLUTIONS.index(resolution)
+        self.scanner_mode = 0
+        self.navigation_mode = NAVIGATION_MODES[0]
+        self.active_channel = 0
+        self.correction_mode = 0
+        self.direction_mode = 0
+
+        self.connections = set()
+        self.lines_sent = 0
+        self.current_row = None
+        self.image = None
+
+        self._server = None
+        self._scan_task = None
+        self._sweep_task = None
+
+    @property
+    def resolution(self):
+        return RESOLUTIONS[self.resolution_index]
+
+    @property
+    def measuring(self):
+        return self._scan_task is not None and not self._scan_task.done()
+
+    @property
+    def sweeping(self):
+        return self._sweep_task is not None and not self._sweep_task.done()
+
+    @property
+    def uri(self):
+        return f"ws://{self.host}:{self.port}"
+
+    # Server lifecycle
+
+    async def start(self):
+        self._server = await websockets.serve(self._handler, self.host, self.port, max_size=None)
+        # Pick up the actual port when port 0 was requested
+        self.port = list(self._server.sockets)[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        self.stop_measurement()
+        self.stop_sweep()
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.stop()
+
+    async def drop_connections(self):
+        """Close all client connections, e.g. to exercise reconnect handling. The scan keeps running."""
+        for connection in list(self.connections):
+            await connection.websocket.close()
+
+    async def broadcast(self, frame):
+        """Send a frame (a dict or raw text) to every client connection, e.g. to exercise error handling."""
+        for connection in list(self.connections):
+            try:
+                await connection.send(frame)
+            except websockets.ConnectionClosed:
+                self.connections.discard(connection)
+
+    async def serve_forever(self):
+        await self.start()
+        try:
+            await asyncio.Future()
+        finally:
+            await self.stop()
+
+    async def _handler(self, websocket, path=None):
+        connection = _Connection(websocket)
+        self.connections.add(connection)
+        try:
+            async for message in websocket:
+                try:
+                    request = json.loads(message)
+                except json.JSONDecodeError as e:
+                    await connection.send(error_frame("Invalid JSON", str(e)))
+                    continue
+                if not connection.authenticated:
+                    # The first command must be a valid authentication, otherwise the client is disconnected
+                    if request.get("command") != "authenticate" or (
+                            self.api_key is not None and request.get("apikey") != self.api_key):
+                        await connection.send(error_frame("Authentication failed", "Invalid API key"))
+                        await websocket.close()
+                        return
+                    connection.authenticated = True
+                    await connection.send({"command": "response", "object": "authenticate",
+                                           "payload": {"status": "authenticated"}})
+                    continue
+                reply = self.handle_request(connection, request)
+                if reply is not None:
+                    await connection.send(reply)
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            self.connections.discard(connection)
+
+    # Requests
+
+    def handle_request(self, connection, request):
+        command = request.get("command")
+        obj = (request.get("object") or "").strip()
+        obj = OBJECT_ALIASES.get(obj, obj)
+        payload = request.get("payload") or {}
+        if command not in ("get", "set"):
+            return error_frame("Unknown command", str(command))
+        handler = getattr(self, f"_{command}_{obj}", None)
+        try:
+            if handler is not None:
+                result = handler(connection, payload)
+            elif obj in self.values:
+                if command == "set":
+                    self.values[obj] = payload.get("value")
+                result = {"value": self.values[obj]}
+            else:
+                return error_frame("Unknown object", obj)
+        except (TypeError, ValueError, IndexError) as e:
+            return error_frame("Invalid value", f"{obj}: {e}")
+        return {"command": "response", "object": obj, "payload": result}
+
+    def _get_APIEcho(self, connection, payload):
+        return {"property": payload.get("property")}
+
+    def _get_APIVersion(self, connection, payload):
+        if payload.get("value") == "available":
+            return {"value": ["1.0", "1.1"]}
+        return {"value": "1.1"}
+
+    def _set_APIVersion(self, connection, payload):
+        return {"value": payload.get("value")}
+
+    def _get_ScannerResolution(self, connection, payload):
+        return {"value": {"index": self.resolution_index, "text": f"{self.resolution}x{self.resolution}"}}
+
+    def _set_ScannerResolution(self, connection, payload):
+        self.resolution_index = option_index(payload, RESOLUTIONS)
+        return self._get_ScannerResolution(connection, payload)
+
+    def _get_ScannerMode(self, connection, payload):
+        return {"value": {"index": self.scanner_mode, "text": SCANNER_MODES[self.scanner_mode]}}
+
+    def _set_ScannerMode(self, connection, payload):
+        self.scanner_mode = option_index(payload, SCANNER_MODES)
+        return self._get_ScannerMode(connection, payload)
+
+    def _set_profile_value(self, obj, payload):
+        value = int(payload.get("value"))
+        if not 1 <= value <= self.resolution:
+            raise ValueError(f"{value} is not in the range 1 to {self.resolution}")
+        self.values[obj] = value
+        return {"value": value}
+
+    def _set_ScannerProfileLine(self, connection, payload):
+        return self._set_profile_value("ScannerProfileLine", payload)
+
+    def _set_ScannerProfileLineRepetition(self, connection, payload):
+        return self._set_profile_value("ScannerProfileLineRepetition", payload)
+
+    def _get_MeasurementDataActiveChannel(self, connection, payload):
+        return {"value": {"index": self.active_channel, "text": SIGNALS[self.active_channel % len(SIGNALS)]}}
+
+    def _set_MeasurementDataActiveChannel(self, connection, payload):
+        self.active_channel = int(payload.get("value"))
+        return self._get_MeasurementDataActiveChannel(connection, payload)
+
+    def _get_MeasurementDataCorrectionMode(self, connection, payload):
+        return {"value": {"index": self.correction_mode, "text": CORRECTION_MODES[self.correction_mode]}}
+
+    def _set_MeasurementDataCorrectionMode(self, connection, payload):
+        self.correction_mode = option_index(payload, CORRECTION_MODES)
+        return self._get_MeasurementDataCorrectionMode(connection, payload)
+
+    def _get_MeasurementDataDirectionMode(self, connection, payload):
+        return {"value": {"index": self.direction_mode, "text": ("forward", "backward")[self.direction_mode]}}
+
+    def _set_MeasurementDataDirectionMode(self, connection, payload):
+        self.direction_mode = option_index(payload, ("forward", "backward"))
+        return self._get_MeasurementDataDirectionMode(connection, payload)
+
+    def _get_ActiveMeasurementChannels(self, connection, payload):
+        return {"value": self.channels}
+
+    def _get_MeasurementStatus(self, connection, payload):
+        return {"value": "Measurement" if self.measuring else "Idle"}
+
+    def _set_ActionMeasurementStart(self, connection, payload):
+        if payload.get("value"):
+            self.start_measurement()
+        return {"value": self.measuring}
+
+    def _get_ActionMeasurementStart(self, connection, payload):
+        return {"value": self.measuring}
+
+    def _set_ActionMeasurementStop(self, connection, payload):
+        if payload.get("value"):
+            self.stop_measurement()
+        return {"value": not self.measuring}
+
+    def _get_ActionMeasurementStop(self, connection, payload):
+        return {"value": not self.measuring}
+
+    def _set_ActionActuationFrequencySweepStart(self, connection, payload):
+        if payload.get("value"):
+            self.start_sweep()
+        return {"value": self.sweeping}
+
+    def _set_ActionActuationFrequencySweepStop(self, connection, payload):
+        if payload.get("value"):
+            self.stop_sweep()
+        return {"value": not self.sweeping}
+
+    def _get_FrequencySweepStatus(self, connection, payload):
+        return {"value": "Sweep" if self.sweeping else "Idle"}
+
+    def _get_FoundResonanceProperties(self, connection, payload):
+        if self.found_resonance is None:
+            raise ValueError("no resonance found")
+        return dict(self.found_resonance)
+
+    def _set_MeasurementDataSubscription(self, connection, payload):
+        data_type = payload.get("type")
+        data_format = payload.get("format", "float")
+        channel = int(payload.get("channel", 0))
+        if data_type not in ("line", "map"):
+            raise ValueError(f"unsupported type {data_type!r}")
+        if data_format not in ("float", "txt", "base64"):
+            raise ValueError(f"unsupported format {data_format!r}")
+        if not 0 <= channel < self.channels:
+            raise ValueError(f"channel {channel} is not active")
+        if payload.get("subscription", True):
+            connection.subscriptions[(data_type, channel)] = data_format
+        else:
+            connection.subscriptions.pop((data_type, channel), None)
+        return self._subscription_list(connection, include_log=False)
+
+    def _get_MeasurementDataSubscription(self, connection, payload):
+        return self._subscription_list(connection, include_log=False)
+
+    def _set_DataSubscription(self, connection, payload):
+        if payload.get("type") == "log":
+            connection.log_subscribed = bool(payload.get("subscription", True))
+            return self._subscription_list(connection, include_log=True)
+        return self._set_MeasurementDataSubscription(connection, payload)
+
+    def _get_DataSubscription(self, connection, payload):
+        return self._subscription_list(connection, include_log=True)
+
+    def _subscription_list(self, connection, include_log):
+        subscriptions = [{"channel": channel, "format": data_format, "type": data_type}
+                         for (data_type, channel), data_format in sorted(connection.subscriptions.items())]
+        if include_log and connection.log_subscribed:
+            subscriptions.append({"format": "txt", "type": "log"})
+        return {"subscriptions": subscriptions}
+
+    def _get_MeasurementData(self, connection, payload):
+        data_type = payload.get("type", "image")
+        channel = int(payload.get("channel", 0))
+        if data_type not in ("image", "metadata", "map"):
+            raise ValueError(f"unknown type {data_type!r}")
+        if self.image is None:
+            raise ValueError("no measurement data")
+        if not 0 <= channel < self.channels:
+            raise IndexError(f"channel {channel} out of range 0..{self.channels - 1}")
+        data = self.image[channel, self.direction_mode]
+        text = io.StringIO()
+        if data_type != "map":
+            scan_range = float(self.values["ScannerRange"])
+            text.write(f"# Channel: {SIGNALS[channel % len(SIGNALS)]}\n"
+                       f"# Direction: {('forward', 'backward')[self.direction_mode]}\n"
+                       f"# Width: {scan_range:g} µm\n"
+                       f"# Height: {scan_range:g} µm\n"
+                       f"# XRes: {data.shape[1]}\n"
+                       f"# YRes: {data.shape[0]}\n"
+                       f"# Value units: nm\n")
+        if data_type != "metadata":
+            np.savetxt(text, data, fmt="%.5e", delimiter="\t")
+        return {"property": "value", "format": "txt", "type": data_type, "channel": channel,
+                "value": text.getvalue()}
+
+    def _set_navigation_mode(self, name, payload):
+        if payload.get("value"):
+            self.navigation_mode = name
+        elif self.navigation_mode == name:
+            # Resetting the current mode returns to the default "scan" mode
+            self.navigation_mode = NAVIGATION_MODES[0]
+        return {"value": self.navigation_mode == name}
+
+    def _set_ScannerNavigationModeScan(self, connection, payload):
+        return self._set_navigation_mode("ScannerNavigationModeScan", payload)
+
+    def _set_ScannerNavigationModeProfile(self, connection, payload):
+        return self._set_navigation_mode("ScannerNavigationModeProfile", payload)
+
+    def _set_ScannerNavigationModePoint(self, connection, payload):
+        return self._set_navigation_mode("ScannerNavigationModePoint", payload)
+
+    def _get_ScannerNavigationModeScan(self, connection, payload):
+        return {"value": self.navigation_mode == "ScannerNavigationModeScan"}
+
+    def _get_ScannerNavigationModeProfile(self, connection, payload):
+        return {"value": self.navigation_mode == "ScannerNavigationModeProfile"}
+
+    def _get_ScannerNavigationModePoint(self, connection, payload):
+        return {"value": self.navigation_mode == "ScannerNavigationModePoint"}
+
+    # Measurement simulation
+
+    def start_measurement(self):
+        if self.measuring:
+            return
+        self.image = np.full((self.channels, 2, self.resolution, self.resolution), np.nan)
+        self._scan_task = asyncio.ensure_future(self._scan())
+
+    def stop_measurement(self):
+        if self.measuring:
+            self._scan_task.cancel()
+
+    def start_sweep(self):
+        if self.sweeping:
+            return
+        self._sweep_task = asyncio.ensure_future(self._sweep())
+
+    def stop_sweep(self):
+        if self.sweeping:
+            self._sweep_task.cancel()
+
+    async def _sweep(self):
+        await self.broadcast_log("Frequency sweep started")
+        try:
+            await asyncio.sleep(self.sweep_duration)
+        except asyncio.CancelledError:
+            await self.broadcast_log("Frequency sweep stopped")
+            raise
+        start = float(self.values["ActuationFrequencySweepStart"])
+        stop = float(self.values["ActuationFrequencySweepStop"])
+        if min(start, stop) <= self.cantilever.frequency <= max(start, stop):
+            self.found_resonance = self.cantilever.found_properties(self.values["AFMPIDConstantP"],
+                                                                    self.values["AFMPIDConstantI"])
+            self.values["ActuationFrequency"] = self.cantilever.frequency
+            await self.broadcast_log("Frequency sweep finished")
+        else:
+            self.found_resonance = None
+            await self.broadcast_log("Frequency sweep finished: no resonance found", "warning")
+
+    async def _scan(self):
+        await self.broadcast_log("Measurement started")
+        try:
+            while True:
+                resolution = self.resolution
+                started = time.monotonic()
+                if self.scanner_mode in (2, 3):
+                    # Profile modes scan the profile line again and again, one streamed line per repetition
+                    profile_row = min(int(self.values["ScannerProfileLine"]), resolution) - 1
+                    repetitions = min(int(self.values["ScannerProfileLineRepetition"]), resolution)
+                    rows = [(profile_row, repetition) for repetition in range(repetitions)]
+                else:
+                    rows = [(row, None) for row in range(resolution)]
+                for index, (row, repetition) in enumerate(rows):
+                    self.current_row = row
+                    await self._emit_row(row, resolution, repetition)
+                    lines_per_second = self.values["ScannerLinesPerSecond"]
+                    if lines_per_second and lines_per_second > 0:
+                        delay = started + (index + 1) / lines_per_second - time.monotonic()
+                        await asyncio.sleep(max(delay, 0))
+                    else:
+                        # Let the connections run between lines when streaming unthrottled
+                        await asyncio.sleep(0)
+                if self.scanner_mode != 1:
+                    break
+            await self.broadcast_log("Measurement finished")
+        except asyncio.CancelledError:
+            await self.broadcast_log("Measurement stopped")
+            raise
+        finally:
+            self.current_row = None
+
+    async def _emit_row(self, row, resolution, repetition=None):
+        """Stream one line; a repetition of a profile line is sent (and mapped) at the repetition's row."""
+        scan_range = float(self.values["ScannerRange"])
+        frequency = float(self.values["ActuationFrequency"])
+        position = row if repetition is None else repetition
+        encoded = {}
+        sends = []
+        for channel in range(self.channels):
+            x, forward, backward = self.sample.line(channel, row, resolution, scan_range, repetition)
+            if repetition is not None:
+                forward = forward + PROFILE_DRIFT * repetition
+                backward = backward + PROFILE_DRIFT * repetition
+            signal = SIGNALS[channel % len(SIGNALS)]
+            if signal == "amplitude":
+                # Cantilever amplitude at the actuation frequency with 1 % topography contrast
+                amplitude = self.cantilever.amplitude(frequency)
+                forward = amplitude * (1 + 0.01 * (forward - forward.mean()))
+                backward = amplitude * (1 + 0.01 * (backward - backward.mean()))
+            elif signal == "phase":
+                phase = self.cantilever.phase(frequency)
+                forward = forward + phase
+                backward = backward + phase
+            self.image[channel, 0, position] = forward
+            self.image[channel, 1, position] = backward
+            for connection in list(self.connections):
+                for (data_type, sub_channel), data_format in connection.subscriptions.items():
+                    if sub_channel != channel:
+                        continue
+                    if data_type == "map" and not (position % self.map_interval == self.map_interval - 1
+                                                   or position == resolution - 1):
+                        continue
+                    key = (data_type, channel, data_format)
+                    if key not in encoded:
+                        encoded[key] = self._frame(data_type, channel, data_format, position, x, forward,
+                                                   backward)
+                    sends.append(self._send_frame(connection, encoded[key]))
+        self.lines_sent += 1
+        if sends:
+            await asyncio.gather(*sends)
+
+    def _frame(self, data_type, channel, data_format, row, x, forward, backward):
+        if data_type == "line":
+            value = {
+                "x": encode_vector(x, data_format),
+                "y_forward": encode_vector(forward, data_format),
+                "y_backward": encode_vector(backward, data_format),
+                "y_position": row,
+            }
+        else:
+            direction = self.direction_mode
+            value = {
+                "data": encode_vector(np.nan_to_num(self.image[channel, direction]).ravel(), data_format),
+                "y_position": row,
+            }
+        payload = {
+            "channel": channel,
+            "format": data_format,
+            "signal": SIGNALS[channel % len(SIGNALS)],
+            "type": data_type,
+            "value": value,
+        }
+        if self.stamp_frames:
+            # Stamped at send time in _send_frame; the rest of the frame is encoded once
+            return payload
+        return json.dumps({"command": "response", "object": "MeasurementDataSubscription", "payload": payload})
+
+    async def _send_frame(self, connection, frame):
+        if self.stamp_frames:
+            frame = {"command": "response", "object": "MeasurementDataSubscription",
+                     "payload": dict(frame, server_time=time.time())}
+        try:
+            await connection.send(frame)
+        except websockets.ConnectionClosed:
+            self.connections.discard(connection)
+
+    async def broadcast_log(self, message, level="info"):
+        frame = {"command": "response", "object": "LogEvent",
+                 "payload": {"level": level, "message": message, "timestamp": time.time()}}
+        for connection in list(self.connections):
+            if connection.log_subscribed:
+                try:
+                    await connection.send(frame)
+                except websockets.ConnectionClosed:
+                    self.connections.discard(connection)
+
+
+def option_index(payload, options):
+    """Validate the index of an enumerated object (ScannerMode, ScannerResolution, ...)."""
+    index = int(payload.get("value"))
+    if not 0 <= index < len(options):
+        raise IndexError(f"index {index} out of range 0..{len(options) - 1}")
+    return index
+
+
+def error_frame(title, details):
+    return {"command": "error", "payload": {"title": title, "details": details}}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=1234)
+    parser.add_argument("--api-key", default=None, help="accept only this API key (default: any key)")
+    parser.add_argument("--resolution", type=int, default=256, choices=RESOLUTIONS)
+    parser.add_argument("--lines-per-second", type=float, default=1.0, help="0 streams unthrottled")
+    parser.add_argument("--channels", type=int, default=2, choices=range(1, 5))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--map-interval", type=int, default=16, help="lines between two map frames")
+    parser.add_argument("--stamp-frames", action="store_true", help="add server_time to streamed frames")
+    parser.add_argument("--sweep-duration", type=float, default=2.0, help="seconds of an automatic frequency sweep")
+    parser.add_argument("--autostart", action="store_true", help="start a measurement right away")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    server = MockAFMServer(args.host, args.port, args.api_key, args.resolution, args.lines_per_second,
+                           args.channels, args.seed, args.map_interval, args.stamp_frames, args.sweep_duration)
+
+    async def run():
+        await server.start()
+        print(f"Mock AFM Control API server listening on {server.uri}")
+        if args.autostart:
+            server.start_measurement()
+        try:
+            await asyncio.Future()
+        finally:
+            await server.stop()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""
+Objects of the AFM Control API v1.1 and the commands they accept
+
+Taken from the "Set/Get Information" sections of docs/API_v1_1/README.md. Used to validate commands
+before they are sent, e.g. by the recipe executor.
+"""
+
+import difflib
+
+SET = ("set",)
+GET = ("get",)
+SET_GET = ("set", "get")
+
+OBJECTS_V1_1 = {
+    "ActionActuationFrequencySweepStart": SET,
+    "ActionActuationFrequencySweepStop": SET,
+    "ActionAddMeasurementChannel": SET,
+    "ActionMeasurementBufferClear": SET,
+    "ActionMeasurementStart": SET_GET,
+    "ActionMeasurementStop": SET_GET,
+    "ActionMotorApproachContinuous": SET,
+    "ActionMotorApproachOnce": SET,
+    "ActionMotorRetractContinuous": SET_GET,
+    "ActionMotorRetractOnce": SET,
+    "ActionMotorSafeDistance": SET,
+    "ActionRemoveMeasurementChannel": SET,
+    "ActionScannerReset": SET,
+    "ActiveMeasurementChannels": GET,
+    "ActuationAmplitude": SET_GET,
+    "ActuationFrequency": SET_GET,
+    "ActuationFrequencySweepStart": SET,
+    "ActuationFrequencySweepStop": SET,
+    "ActuationHalfResonanceFrequency": SET_GET,
+    "ActuationOutput": SET_GET,
+    "AFMAmplitudeSetPoint": SET_GET,
+    "AFMPIDConstantI": SET_GET,
+    "AFMPIDConstantP": SET_GET,
+    "AFMRegister": SET_GET,
+    "APIEcho": GET,
+    "APIVersion": SET_GET,
+    "DataSubscription": SET_GET,
+    "DetectionGainACIn": SET_GET,
+    "DetectionLockInTimeConstant": SET_GET,
+    "DetectionMaxPeakBandwidth": SET_GET,
+    "DetectionPeakSelectionMode": SET_GET,
+    "DetectionResonanceOffset": SET_GET,
+    "DetectionSetpointPercentage": SET_GET,
+    "FoundResonanceProperties": GET,
+    "FrequencySweepStatus": GET,
+    "MeasurementData": GET,
+    "MeasurementDataActiveChannel": SET_GET,
+    "MeasurementDataCorrectionMode": SET_GET,
+    "MeasurementDataDirectionMode": SET_GET,
+    "MeasurementDataSubscription": SET_GET,
+    "MeasurementStatus": GET,
+    "MotorApproachMode": SET_GET,
+    "MotorPosition": GET,
+    "MotorSpeed": SET_GET,
+    "MotorStatus": GET,
+    "ScannerCenterX": SET_GET,
+    "ScannerCenterY": SET_GET,
+    "ScannerDeflectionZ": GET,
+    "ScannerLimitZ": SET_GET,
+    "ScannerLinesPerSecond": SET_GET,
+    "ScannerMicroMetersPerSecond": SET_GET,
+    "ScannerMode": SET_GET,
+    "ScannerNavigationModePoint": SET_GET,
+    "ScannerNavigationModeProfile": SET_GET,
+    "ScannerNavigationModeScan": SET_GET,
+    "ScannerProfileLine": SET_GET,
+    "ScannerProfileLineLock": SET_GET,
+    "ScannerProfileLineRepetition": SET_GET,
+    # Spelling used in parts of the documentation
+    "ScannerProfileLineRepetitions": SET_GET,
+    "ScannerRange": SET_GET,
+    "ScannerResolution": SET_GET,
+    "ScannerRotation": SET_GET,
+    "ScannerTipDistance": GET,
+}
+
+
+def check_command(command, obj, objects=OBJECTS_V1_1):
+    """Return None if the object accepts the command, otherwise a message explaining why not."""
+    commands = objects.get(obj.strip())
+    if commands is None:
+        suggestions = difflib.get_close_matches(obj.strip(), objects, n=1)
+        hint = f", did you mean {suggestions[0]!r}?" if suggestions else ""
+        return f"unknown object {obj!r}{hint}"
+    if command not in commands:
+        return f"{obj} does not support {command!r} (only {' / '.join(commands)})"
+    return None
@@ -0,0 +1,230 @@
+"""
+Typed parameter cache
+
+Slow-changing values such as ScannerResolution or ScannerRange are needed all the time to interpret
+streamed frames, but every "get" costs a full round trip. ParameterCache keeps them in memory:
+
+- snapshot() fetches all cached parameters in one pipelined round trip; with
+  AFMClient(parameter_cache=True) this happens on every connect and reconnect,
+- successful "set" commands sent through the client update the cached value (from the reply if it
+  contains one, otherwise from the value that was set),
+- every parameter has a time to live; values the server can change on its own (volatile, e.g. the
+  actuation frequency after a frequency sweep) expire, and all of them can be invalidated explicitly,
+- streamed frames invalidate what they contradict: a line whose length does not match the cached
+  resolution, data from a channel beyond ActiveMeasurementChannels, and log messages, which mark all
+  volatile parameters as stale.
+
+Hot paths read values locally with cache.get("ScannerResolution") or cache["ScannerRange"]; fetch()
+returns the cached value or falls back to a round trip.
+"""
+
+import time
+from collections import namedtuple
+
+from .decoding import BASE64_DTYPE
+from .recorder import parse_resolution
+
+# Value of enumerated objects, e.g. MeasurementDataActiveChannel -> IndexValue(0, "topography")
+IndexValue = namedtuple("IndexValue", ("index", "text"))
+
+_MISSING = object()
+
+
+def _value(payload):
+    return payload.get("value", payload) if isinstance(payload, dict) else payload
+
+
+def parse_float(payload):
+    return float(_value(payload))
+
+
+def parse_int(payload):
+    return int(_value(payload))
+
+
+def parse_bool(payload):
+    value = _value(payload)
+    if isinstance(value, str):
+        return value.strip().lower() in ("true", "1", "on")
+    return bool(value)
+
+
+def parse_scanner_resolution(payload):
+    value = _value(payload)
+    if not isinstance(value, dict):
+        # A set command only carries the index into the list of resolutions, not the pixel count
+        raise ValueError("ScannerResolution index without text")
+    return parse_resolution(payload)
+
+
+def vector_length(vector):
+    """Number of values in a streamed vector of any format, without decoding it."""
+    if isinstance(vector, str):
+        return len(vector.rstrip("=")) * 3 // 4 // BASE64_DTYPE.itemsize
+    return len(vector)
+
+
+def parse_index(payload):
+    value = _value(payload)
+    if isinstance(value, dict):
+        return IndexValue(int(value["index"]), value.get("text"))
+    # A set command only carries the index
+    return IndexValue(int(value), None)
+
+
+class Parameter:
+    """A cached object: how to parse its value, how long it stays valid and whether the server changes it."""
+
+    __slots__ = ("name", "parse", "ttl", "volatile")
+
+    def __init__(self, name, parse, ttl=None, volatile=False):
+        self.name = name
+        self.parse = parse
+        # Seconds a value stays valid; None keeps it until it is invalidated
+        self.ttl = ttl
+        self.volatile = volatile
+
+    def __repr__(self):
+        return f"Parameter({self.name!r}, ttl={self.ttl}, volatile={self.volatile})"
+
+
+DEFAULT_PARAMETERS = (
+    Parameter("ScannerResolution", parse_scanner_resolution),
+    Parameter("ScannerRange", parse_float),
+    Parameter("ScannerCenterX", parse_float),
+    Parameter("ScannerCenterY", parse_float),
+    Parameter("ScannerRotation", parse_float),
+    Parameter("ScannerLinesPerSecond", parse_float),
+    Parameter("ScannerMode", parse_index),
+    Parameter("ActiveMeasurementChannels", parse_int),
+    Parameter("MeasurementDataActiveChannel", parse_index),
+    Parameter("MeasurementDataCorrectionMode", parse_index),
+    Parameter("MeasurementDataDirectionMode", parse_index),
+    Parameter("AFMPIDConstantP", parse_float),
+    Parameter("AFMPIDConstantI", parse_float),
+    Parameter("AFMAmplitudeSetPoint", parse_float),
+    # Changed by the server after a frequency sweep
+    Parameter("ActuationFrequency", parse_float, ttl=10.0, volatile=True),
+    Parameter("ActuationAmplitude", parse_float, ttl=10.0, volatile=True),
+)
+
+
+class ParameterCache:
+    """In-memory cache of typed parameter values of one AFMClient."""
+
+    def __init__(self, client, parameters=DEFAULT_PARAMETERS):
+        self.client = client
+        self.parameters = {parameter.name: parameter for parameter in parameters}
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        # name -> (value, time stored)
+        self._values = {}
+
+    def __contains__(self, name):
+        return self.get(name, _MISSING) is not _MISSING
+
+    def __getitem__(self, name):
+        value = self.get(name, _MISSING)
+        if value is _MISSING:
+            raise KeyError(name)
+        return value
+
+    def get(self, name, default=None):
+        """Return the cached value without a round trip, or default if it is unknown or expired."""
+        entry = self._values.get(name)
+        if entry is not None:
+            value, stored = entry
+            ttl = self.parameters[name].ttl
+            if ttl is None or time.monotonic() - stored < ttl:
+                self.hits += 1
+                return value
+            del self._values[name]
+        self.misses += 1
+        return default
+
+    def store(self, name, value):
+        if name in self.parameters:
+            self._values[name] = (value, time.monotonic())
+
+    def invalidate(self, *names):
+        """Drop the given parameters, or all of them if no name is given."""
+        names = names or list(self._values)
+        for name in names:
+            if self._values.pop(name, None) is not None:
+                self.invalidations += 1
+
+    def invalidate_volatile(self):
+        self.invalidate(*[name for name in self._values if self.parameters[name].volatile])
+
+    def as_dict(self):
+        """All valid values, e.g. for saving them with a measurement."""
+        values = {}
+        for name in list(self._values):
+            value = self.get(name, _MISSING)
+            if value is not _MISSING:
+                values[name] = value._asdict() if isinstance(value, IndexValue) else value
+        return values
+
+    # Round trips
+
+    async def snapshot(self, names=None, timeout=None):
+        """Fetch the given (default: all) parameters in one pipelined round trip. Returns the failures."""
+        names = list(self.parameters) if names is None else list(names)
+        replies = await self.client.pipeline([("get", name, {"property": "value"}) for name in names],
+                                             timeout, return_exceptions=True)
+        failed = {}
+        for name, reply in zip(names, replies):
+            if isinstance(reply, Exception):
+                failed[name] = reply
+                continue
+            try:
+                self.store(name, self.parameters[name].parse(reply))
+            except (KeyError, TypeError, ValueError) as e:
+                failed[name] = e
+        return failed
+
+    async def fetch(self, name, timeout=None):
+        """Return the cached value, fetching it from the server if it is unknown or expired."""
+        value = self.get(name, _MISSING)
+        if value is _MISSING:
+            value = self.parameters[name].parse(await self.client.get(name, timeout=timeout))
+            self.store(name, value)
+        return value
+
+    # Updates from the client
+
+    def on_set(self, obj, payload, reply):
+        """Called by the client after a successful set."""
+        parameter = self.parameters.get(obj)
+        if parameter is None or payload.get("property", "value") not in ("value", "index"):
+            return
+        # Prefer the value confirmed by the server; fall back to the value that was set
+        for source in (reply, payload):
+            try:
+                self.store(obj, parameter.parse(source))
+                return
+            except (KeyError, TypeError, ValueError):
+                continue
+        self.invalidate(obj)
+
+    def on_frame(self, data):
+        """Frame handler: invalidate parameters contradicted by streamed data."""
+        obj = data.get("object")
+        if obj == "LogEvent":
+            # Parameter changes made on the instrument itself are reported in the log
+            self.invalidate_volatile()
+            return
+        if obj != "MeasurementDataSubscription":
+            return
+        payload = data.get("payload") or {}
+        channels = self._values.get("ActiveMeasurementChannels")
+        channel = payload.get("channel")
+        if channels is not None and isinstance(channel, int) and channel >= channels[0]:
+            self.invalidate("ActiveMeasurementChannels")
+        resolution = self._values.get("ScannerResolution")
+        value = payload.get("value")
+        if payload.get("type") == "line" and resolution is not None and isinstance(value, dict):
+            x = value.get("x")
+            if x is not None and vector_length(x) != resolution[0]:
+                self.invalidate("ScannerResolution")
@@ -0,0 +1,313 @@
+"""
+Title: Profile line acquisition with streaming averages
+
+Description:
+In the profile modes of ScannerMode ("Profile from navigation" and "Profile from scan") AFM Control scans a
+single line again and again: ScannerProfileLine selects the line, ScannerProfileLineRepetition the number
+of repetitions and ScannerProfileLineLock keeps the line until another one is set. Every repetition is
+streamed as one line of the MeasurementDataSubscription. This module turns that stream into an averaged
+profile while it is still arriving:
+
+- profile_commands() builds the configuration as one batch of commands, so it is sent with a single
+  AFMClient.pipeline() call together with the start of the measurement,
+- ProfileAccumulator updates the mean and variance of every pixel with each repetition (Welford's
+  algorithm), in one pass and without keeping the repetitions. It also fits the drift online: the height
+  of each repetition against its index, and the lateral shift of each repetition against the first one
+  (from the peak of their cross-correlation), again against the index. The per-pixel co-moments with the
+  repetition index give the variance around a linear height trend as well, i.e. the noise without the
+  drift. With store=True the repetitions are also written into a preallocated directions x repetitions x
+  pixels array,
+- acquire_profile() configures the profile, starts the measurement and feeds the line stream of one channel
+  into an accumulator until all repetitions have arrived.
+
+Usage:
+    python -m afm_api.profile --line 128 --repetitions 256 --channel 0 --output profile.csv
+    python -m afm_api.profile --line 64 --repetitions 512 --store lines.npy
+
+Run from the examples/python directory. The mock server (python -m afm_api.mock_server --lines-per-second
+100) simulates the profile modes with a slow height drift.
+"""
+
+import argparse
+import asyncio
+import logging
+from collections import namedtuple
+
+import numpy as np
+
+from .client import AFMClient
+from .decoding import decode_line
+from .frames import Command, trigger_command
+from .recorder import DIRECTIONS
+from .streams import BLOCK
+
+logger = logging.getLogger(__name__)
+
+# ScannerMode indexes of the profile modes, by the source of the profile position
+PROFILE_MODES = {"navigation": 2, "scan": 3}
+
+# Mean and standard deviation per direction and pixel (directions x pixels), the number of repetitions, the
+# height drift per repetition and the lateral drift in µm per repetition, and the stored repetitions or None
+ProfileData = namedtuple("ProfileData", ("x", "mean", "std", "count", "height_drift", "lateral_drift", "lines"))
+
+
+def profile_commands(line, repetitions, lock=True, source="scan"):
+    """
+    The commands that select a profile: ScannerMode, the profile navigation mode for source="navigation",
+    ScannerProfileLine and ScannerProfileLineRepetition (both from 1 to the resolution) and the line lock.
+    """
+    commands = [Command("set", "ScannerMode", {"property": "index", "value": PROFILE_MODES[source]})]
+    if source == "navigation":
+        commands.append(trigger_command("ScannerNavigationModeProfile"))
+    commands += [
+        Command("set", "ScannerProfileLine", {"property": "value", "value": int(line)}),
+        Command("set", "ScannerProfileLineRepetition", {"property": "value", "value": int(repetitions)}),
+        Command("set", "ScannerProfileLineLock", {"property": "state", "value": bool(lock)}),
+    ]
+    return commands
+
+
+def line_shift(reference, values, max_shift):
+    """
+    Shift in pixels of values against the conjugate rFFT of reference (both zero-padded to twice the line
+    length), from the parabola through the cross-correlation peak within +-max_shift pixels.
+    """
+    points = len(values)
+    correlation = np.fft.irfft(np.fft.rfft(values - values.mean(), 2 * points) * reference, 2 * points)
+    # Lags 0..max_shift and -max_shift..-1
+    window = np.concatenate((correlation[-max_shift:], correlation[:max_shift + 1]))
+    peak = int(np.argmax(window))
+    offset = 0.0
+    if 0 < peak < len(window) - 1:
+        left, center, right = window[peak - 1:peak + 2]
+        curvature = left - 2 * center + right
+        if curvature < 0:
+            offset = 0.5 * (left - right) / curvature
+    return peak - max_shift + offset
+
+
+class OnlineRegression:
+    """Least-squares line y = intercept + slope * t, updated point by point with Welford-style co-moments."""
+
+    def __init__(self):
+        self.count = 0
+        self.mean_t = 0.0
+        self.mean_y = 0.0
+        self.m2_t = 0.0
+        self.c_ty = 0.0
+
+    def update(self, t, y):
+        self.count += 1
+        delta_t = t - self.mean_t
+        self.mean_t += delta_t / self.count
+        self.mean_y += (y - self.mean_y) / self.count
+        self.m2_t += delta_t * (t - self.mean_t)
+        self.c_ty += delta_t * (y - self.mean_y)
+
+    @property
+    def slope(self):
+        return self.c_ty / self.m2_t if self.m2_t > 0 else np.nan
+
+    @property
+    def intercept(self):
+        return self.mean_y - self.slope * self.mean_t
+
+
+class ProfileAccumulator:
+    """Running statistics of the repetitions of a profile line, see the module docstring."""
+
+    def __init__(self, repetitions=None, store=False, lateral=True, max_shift=None, dtype=np.float32):
+        self.repetitions = repetitions
+        self.store = store
+        self.lateral = lateral
+        self.max_shift = max_shift
+        self.dtype = dtype
+        self.points = None
+        self.x = None
+        self.count = 0
+        self.rejected = 0
+        self.mean = None
+        self._m2 = None
+        # Co-moment of every pixel with the repetition index, for the variance around the height trend
+        self._c = None
+        self.lines = None
+        self.height = OnlineRegression()
+        self.shift = OnlineRegression()
+        self._reference = None
+
+    def _allocate(self, line):
+        self.points = len(line)
+        self.x = np.array(line.x, dtype=np.float64)
+        shape = (len(DIRECTIONS), self.points)
+        self.mean = np.zeros(shape)
+        self._m2 = np.zeros(shape)
+        self._c = np.zeros(shape)
+        if self.store:
+            if self.repetitions is None:
+                raise ValueError("Storing the repetitions needs their number")
+            self.lines = np.full((len(DIRECTIONS), self.repetitions, self.points), np.nan, dtype=self.dtype)
+        if self.max_shift is None:
+            self.max_shift = max(1, self.points // 8)
+        self.max_shift = min(self.max_shift, self.points - 1)
+
+    def add(self, line):
+        """Add one repetition (LineData). Returns False for a line that does not fit the profile."""
+        if self.points is None and line.is_valid():
+            self._allocate(line)
+        if (not line.is_valid() or len(line) != self.points
+                or (self.repetitions is not None and self.count >= self.repetitions)):
+            self.rejected += 1
+            return False
+        values = np.stack((line.y_forward, line.y_backward)).astype(np.float64)
+        if not np.isfinite(values).all():
+            self.rejected += 1
+            return False
+
+        index = self.count
+        self.count += 1
+        delta = values - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (values - self.mean)
+        # Same Welford update for the co-moment with the index t: delta_t * (values - new mean)
+        delta_t = index - self.height.mean_t
+        self._c += delta_t * (values - self.mean)
+
+        self.height.update(index, float(values.mean()))
+        if self.lateral:
+            forward = values[0]
+            if self._reference is None:
+                self._reference = np.conj(np.fft.rfft(forward - forward.mean(), 2 * self.points))
+            spacing = (self.x[-1] - self.x[0]) / max(self.points - 1, 1)
+            self.shift.update(index, line_shift(self._reference, forward, self.max_shift) * spacing)
+        if self.lines is not None:
+            self.lines[:, index] = values
+        return True
+
+    def variance(self, detrended=False):
+        """
+        Sample variance per direction and pixel. With detrended=True, the variance of the residuals of a
+        straight line fitted through every pixel against the repetition index, i.e. without a linear drift.
+        """
+        if detrended:
+            if self.count < 3 or self.height.m2_t <= 0:
+                return np.full_like(self.mean, np.nan)
+            residual = self._m2 - self._c ** 2 / self.height.m2_t
+            return np.maximum(residual, 0.0) / (self.count - 2)
+        if self.count < 2:
+            return np.full_like(self.mean, np.nan)
+        return self._m2 / (self.count - 1)
+
+    def std(self, detrended=False):
+        return np.sqrt(self.variance(detrended))
+
+    def standard_error(self):
+        """Standard error of the mean profile, per direction and pixel."""
+        return self.std() / np.sqrt(max(self.count, 1))
+
+    @property
+    def height_drift(self):
+        """Change of the mean height per repetition."""
+        return self.height.slope
+
+    @property
+    def lateral_drift(self):
+        """Shift of the profile along x in µm per repetition (NaN with lateral=False)."""
+        return self.shift.slope
+
+    def result(self, detrended=False):
+        return ProfileData(self.x, None if self.mean is None else self.mean.copy(),
+                           None if self.mean is None else self.std(detrended), self.count,
+                           self.height_drift, self.lateral_drift, self.lines)
+
+
+async def acquire_profile(client, line, repetitions, channel=0, source="scan", lock=True, store=False,
+                          start=True, timeout=10.0, progress=None):
+    """
+    Acquire repetitions of the profile line (1 to the resolution) on one channel and return the
+    ProfileAccumulator with their statistics.
+
+    The profile is configured and, with start=True, the measurement started in one pipelined batch. The
+    previous ScannerMode is restored at the end and a measurement that is still running is stopped.
+    progress(accumulator) is called after every repetition; timeout is the longest wait for a line.
+    """
+    accumulator = ProfileAccumulator(repetitions, store=store)
+    # Lines are small and must not be lost for the statistics; the stream holds all repetitions if needed
+    stream = client.stream("line", channel, maxlen=max(int(repetitions), 1), policy=BLOCK)
+    mode = (await client.get("ScannerMode")).get("value") if start else None
+    await client.subscribe_measurement_data(channel, "line", "base64")
+    try:
+        commands = profile_commands(line, repetitions, lock, source)
+        if start:
+            commands.append(trigger_command("ActionMeasurementStart"))
+        # Lines of a running measurement were acquired with the previous settings; the first profile lines
+        # may arrive before the replies of the batch
+        stream.drain()
+        await client.pipeline(commands)
+        while accumulator.count < repetitions:
+            frame = await asyncio.wait_for(stream.get(), timeout)
+            if accumulator.add(decode_line(frame["payload"])) and progress is not None:
+                progress(accumulator)
+    finally:
+        client.close_stream(stream)
+        try:
+            await client.subscribe_measurement_data(channel, "line", "base64", subscription=False)
+            if start:
+                if (await client.get("MeasurementStatus")).get("value") != "Idle":
+                    await client.trigger("ActionMeasurementStop")
+                if isinstance(mode, dict):
+                    await client.set("ScannerMode", mode.get("index"), property="index")
+        except Exception as e:
+            logger.warning("Restoring the scanner after the profile failed: %s", e)
+    return accumulator
+
+
+def save_profile(path, profile):
+    """Write a ProfileData as CSV with x and the mean and standard deviation of both directions."""
+    with open(path, "w") as f:
+        f.write("x_um,forward_mean,forward_std,backward_mean,backward_std\n")
+        for row in zip(profile.x, profile.mean[0], profile.std[0], profile.mean[1], profile.std[1]):
+            f.write(",".join(f"{value:.6g}" for value in row) + "\n")
+
+
+async def run(args):
+    async with AFMClient(args.uri, args.api_key) as client:
+        lines_per_second = float((await client.get("ScannerLinesPerSecond")).get("value") or 0.0)
+        accumulator = await acquire_profile(
+            client, args.line, args.repetitions, args.channel, args.source, not args.no_lock,
+            store=args.store is not None, start=not args.no_start, timeout=args.timeout,
+            progress=lambda acc: print(f"\r{acc.count}/{args.repetitions} repetitions, "
+                                       f"noise {np.nanmedian(acc.std()[0]):.4g}", end="", flush=True))
+    print()
+    profile = accumulator.result()
+    print(f"{profile.count} repetitions of {accumulator.points} points ({accumulator.rejected} rejected)")
+    print(f"noise (median std): {np.median(profile.std[0]):.4g}, without the height drift "
+          f"{np.median(accumulator.std(detrended=True)[0]):.4g}")
+    print(f"standard error of the mean: {np.median(accumulator.standard_error()[0]):.4g}")
+    print(f"height drift: {profile.height_drift:.4g} per repetition"
+          + (f", {profile.height_drift * lines_per_second:.4g} per second" if lines_per_second > 0 else ""))
+    print(f"lateral drift: {profile.lateral_drift * 1e3:.4g} nm per repetition")
+    if args.output:
+        save_profile(args.output, profile)
+    if args.store:
+        np.save(args.store, profile.lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--uri", default="ws://127.0.0.1:1234")
+    parser.add_argument("--api-key", default="AFM-Control-API-Key")
+    parser.add_argument("--line", type=int, required=True, help="profile line, 1 to the resolution")
+    parser.add_argument("--repetitions", type=int, required=True, help="repetitions, 1 to the resolution")
+    parser.add_argument("--channel", type=int, default=0, help="measurement channel")
+    parser.add_argument("--source", choices=sorted(PROFILE_MODES), default="scan",
+                        help="take the profile position from the scan line or from the navigation")
+    parser.add_argument("--no-lock", action="store_true", help="do not lock the profile line")
+    parser.add_argument("--no-start", action="store_true", help="do not start the measurement")
+    parser.add_argument("--timeout", type=float, default=10.0, help="longest wait for a line in seconds")
+    parser.add_argument("--output", help="write the averaged profile as CSV to this file")
+    parser.add_argument("--store", help="keep all repetitions and save them as .npy to this file")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
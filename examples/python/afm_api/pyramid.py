@@ -0,0 +1,284 @@
+"""
+Multi-resolution tile pyramid of recorded scans
+
+Browsing a 2048 x 2048 (or larger) multi-channel recording by loading whole arrays is slow and needs a lot
+of memory for a view that shows a few hundred pixels. A recording made with ScanRecorder(..., pyramid=True)
+therefore also keeps downsampled copies of itself:
+
+- level k halves the rows and columns of level k - 1 (level 0 is the recording itself). Every pixel of a
+  level holds the minimum, maximum and mean of the pixels it covers, and how many of them were acquired,
+  so NaN rows of a running scan do not distort the statistics and means combine exactly across levels.
+  Levels are added until one tile covers the whole map,
+- PyramidBuilder updates the levels incrementally as lines arrive: a new row changes one row of level 1,
+  which changes one row of level 2, and so on, so the cost per line depends on the line length only,
+  not on the number of rows of the map. Each level is a memory-mapped .npy file next to the recording
+  (scan.L1.npy, scan.L2.npy, ...), listed in the recording's JSON sidecar,
+- ScanPyramid reads tiles (tile_size x tile_size pixels of one level) lazily from the memory-mapped files
+  and keeps the most recently used ones in an LRU cache. Only tiles whose rows have all been acquired are
+  cached, so a viewer of a running recording sees the rows as they arrive. region() assembles any
+  rectangle of a level from tiles, and view() picks the coarsest level that still resolves a rectangle of
+  the full map at a given number of pixels.
+
+    pyramid = ScanPyramid("scan.npy")
+    level, image = pyramid.view(0, 0, 2048, 2048, max_pixels=512)     # the whole map at level 2
+    zoomed = pyramid.region(0, 512, 512, 768, 768, stat="max")        # a detail at full resolution
+
+Usage:
+    python -m afm_api.pyramid scan.npy [--tile-size 256]
+    python -m afm_api.pyramid scan.npy --view 0 0 2048 2048 --max-pixels 512
+
+builds the pyramid of an existing recording, or times a view of it.
+
+Run from the examples/python directory.
+"""
+
+import argparse
+import functools
+import json
+import math
+import os
+import time
+from collections import OrderedDict
+
+import numpy as np
+from numpy.lib.format import open_memmap
+
+from .recorder import DIRECTIONS, metadata_path, open_scan
+
+# Statistics kept per pixel of a level, in this order
+STATS = ("min", "max", "mean", "count")
+MIN, MAX, MEAN, COUNT = range(len(STATS))
+
+
+def level_path(path, level):
+    return f"{os.path.splitext(path)[0]}.L{level}.npy"
+
+
+def level_count(rows, columns, tile_size):
+    """Number of levels above level 0 until one tile covers the whole map (at least one)."""
+    size = max(rows, columns)
+    return max(1, math.ceil(math.log2(size / tile_size))) if size > tile_size else 1
+
+
+def _reduce_rows(mins, maxs, sums, counts):
+    """Combine (..., rows, columns) statistics over all rows and pairs of columns into one row."""
+    if mins.shape[-1] % 2:
+        # An odd last column is paired with a column without data
+        pad = [(0, 0)] * (mins.ndim - 1) + [(0, 1)]
+        mins, maxs = np.pad(mins, pad, constant_values=np.nan), np.pad(maxs, pad, constant_values=np.nan)
+        sums, counts = np.pad(sums, pad), np.pad(counts, pad)
+    # Elementwise over the (up to) four pixels of each block: reductions along axes of length 2 are slow
+    mins = functools.reduce(np.fmin, _block_pixels(mins))
+    maxs = functools.reduce(np.fmax, _block_pixels(maxs))
+    sums = functools.reduce(np.add, _block_pixels(sums))
+    counts = functools.reduce(np.add, _block_pixels(counts))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = sums / counts
+    return mins, maxs, means, counts
+
+
+def _block_pixels(values):
+    return [values[..., row, column::2] for row in range(values.shape[-2]) for column in (0, 1)]
+
+
+class PyramidBuilder:
+    """Keeps the levels of a channels x directions x rows x columns recording up to date, row by row."""
+
+    def __init__(self, path, data, tile_size=256, levels=None):
+        self.path = path
+        self.data = data
+        self.tile_size = tile_size
+        # Plain ndarray views of the memory maps for the row updates, without the memmap subclass overhead
+        self._data = data.view(np.ndarray)
+        self._levels = []
+        channels, directions, rows, columns = data.shape
+        levels = levels or level_count(rows, columns, tile_size)
+        self.levels = []
+        for level in range(1, levels + 1):
+            rows, columns = -(-rows // 2), -(-columns // 2)
+            array = open_memmap(level_path(path, level), mode="w+", dtype=data.dtype,
+                                shape=(channels, directions, len(STATS), rows, columns))
+            for plane in array.reshape(-1, rows, columns):
+                plane[:] = np.nan
+            array[:, :, COUNT] = 0
+            self.levels.append(array)
+            self._levels.append(array.view(np.ndarray))
+
+    def update_row(self, channel_index, row):
+        """Propagate a new or changed row of level 0 to all levels."""
+        for level, array in enumerate(self._levels):
+            row //= 2
+            if level == 0:
+                source = self._data[channel_index, :, 2 * row:2 * row + 2].astype(np.float64)
+                acquired = np.isfinite(source)
+                mins = maxs = source
+                sums = np.where(acquired, source, 0.0)
+                counts = acquired.astype(np.float64)
+            else:
+                source = self._levels[level - 1][channel_index, :, :, 2 * row:2 * row + 2].astype(np.float64)
+                mins, maxs = source[:, MIN], source[:, MAX]
+                counts = source[:, COUNT]
+                sums = np.where(counts > 0, source[:, MEAN] * counts, 0.0)
+            target = array[channel_index, :, :, row]
+            for stat, values in enumerate(_reduce_rows(mins, maxs, sums, counts)):
+                target[:, stat] = values
+
+    def rebuild(self):
+        """Compute all levels from the complete level 0, e.g. for a recording made without a pyramid."""
+        channels, _, rows, _ = self.data.shape
+        for channel_index in range(channels):
+            # Every other row updates each block row of level 1 once
+            for row in range(0, rows, 2):
+                self.update_row(channel_index, row)
+
+    def metadata(self):
+        return {"tile_size": self.tile_size, "stats": list(STATS),
+                "levels": [list(array.shape[-2:]) for array in self.levels]}
+
+    def flush(self):
+        for array in self.levels:
+            array.flush()
+
+    def close(self):
+        self.flush()
+        self.levels = []
+        self._levels = []
+
+
+def build_pyramid(path, tile_size=256):
+    """Add the pyramid levels to a finished recording and list them in its sidecar. Returns the metadata."""
+    data, metadata = open_scan(path)
+    builder = PyramidBuilder(path, data, tile_size)
+    builder.rebuild()
+    metadata["pyramid"] = builder.metadata()
+    builder.close()
+    with open(metadata_path(path), "w") as f:
+        json.dump(metadata, f)
+    return metadata["pyramid"]
+
+
+class ScanPyramid:
+    """Lazy, LRU cached tile access to a recording and its pyramid levels, see the module docstring."""
+
+    def __init__(self, path, cache_tiles=256):
+        self.path = path
+        self.cache_tiles = cache_tiles
+        self.data, metadata = open_scan(path)
+        pyramid = metadata.get("pyramid")
+        if pyramid is None:
+            raise ValueError(f"{path} has no pyramid, build it with afm_api.pyramid.build_pyramid()")
+        self.tile_size = pyramid["tile_size"]
+        self.levels = [self.data] + [np.load(level_path(path, level), mmap_mode="r")
+                                     for level in range(1, len(pyramid["levels"]) + 1)]
+        self.channels = metadata.get("channels", list(range(self.data.shape[0])))
+        self._rows_received = None
+        self._cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.refresh(metadata)
+
+    def refresh(self, metadata=None):
+        """Re-read which rows have been acquired, for a recording that is still running."""
+        if metadata is None:
+            _, metadata = open_scan(self.path)
+        rows = self.data.shape[2]
+        received = np.zeros((len(self.channels), rows), dtype=bool)
+        for index, channel_rows in enumerate(metadata.get("rows_received", [])):
+            received[index, channel_rows] = True
+        self._rows_received = received
+
+    def shape(self, level):
+        """(rows, columns) of a level."""
+        return self.levels[level].shape[-2:]
+
+    def tiles(self, level):
+        """(tiles along y, tiles along x) of a level."""
+        rows, columns = self.shape(level)
+        return -(-rows // self.tile_size), -(-columns // self.tile_size)
+
+    def _complete(self, channel_index, level, ty):
+        scale = 2 ** level
+        first = ty * self.tile_size * scale
+        return bool(self._rows_received[channel_index, first:first + self.tile_size * scale].all())
+
+    def tile(self, level, tx, ty, channel=None, direction="forward", stat="mean"):
+        """One tile of a level as a read-only array; stat is ignored at level 0."""
+        channel_index = self.channels.index(channel) if channel is not None else 0
+        direction_index = DIRECTIONS.index(direction)
+        stat_index = STATS.index(stat)
+        key = (level, tx, ty, channel_index, direction_index, 0 if level == 0 else stat_index)
+        tile = self._cache.get(key)
+        if tile is not None:
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return tile
+        self.misses += 1
+        if level == 0:
+            source = self.data[channel_index, direction_index]
+        else:
+            source = self.levels[level][channel_index, direction_index, stat_index]
+        size = self.tile_size
+        tile = np.array(source[ty * size:(ty + 1) * size, tx * size:(tx + 1) * size])
+        tile.flags.writeable = False
+        if self._complete(channel_index, level, ty):
+            self._cache[key] = tile
+            if len(self._cache) > self.cache_tiles:
+                self._cache.popitem(last=False)
+        return tile
+
+    def region(self, level, x0, y0, x1, y1, channel=None, direction="forward", stat="mean"):
+        """Pixels [y0:y1, x0:x1] of a level, read from the tiles that cover them."""
+        rows, columns = self.shape(level)
+        x0, y0, x1, y1 = max(x0, 0), max(y0, 0), min(x1, columns), min(y1, rows)
+        size = self.tile_size
+        out = np.empty((max(y1 - y0, 0), max(x1 - x0, 0)), dtype=self.data.dtype)
+        for ty in range(y0 // size, -(-y1 // size)):
+            for tx in range(x0 // size, -(-x1 // size)):
+                tile = self.tile(level, tx, ty, channel, direction, stat)
+                top, left = ty * size, tx * size
+                ya, yb = max(y0, top), min(y1, top + tile.shape[0])
+                xa, xb = max(x0, left), min(x1, left + tile.shape[1])
+                out[ya - y0:yb - y0, xa - x0:xb - x0] = tile[ya - top:yb - top, xa - left:xb - left]
+        return out
+
+    def view(self, x0, y0, x1, y1, max_pixels=512, channel=None, direction="forward", stat="mean"):
+        """
+        The rectangle [y0:y1, x0:x1] of the full-resolution map at the coarsest level that still shows it
+        with at least max_pixels along its longer side (or level 0). Returns (level, array).
+        """
+        span = max(x1 - x0, y1 - y0)
+        level = min(max(0, int(math.floor(math.log2(span / max_pixels)))) if span > max_pixels else 0,
+                    len(self.levels) - 1)
+        scale = 2 ** level
+        return level, self.region(level, x0 // scale, y0 // scale, -(-x1 // scale), -(-y1 // scale),
+                                  channel, direction, stat)
+
+    def clear_cache(self):
+        self._cache.clear()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("path", help=".npy file written by ScanRecorder")
+    parser.add_argument("--tile-size", type=int, default=256, help="tile size in pixels")
+    parser.add_argument("--view", type=int, nargs=4, metavar=("X0", "Y0", "X1", "Y1"),
+                        help="time a view of this rectangle instead of building the pyramid")
+    parser.add_argument("--max-pixels", type=int, default=512, help="pixels along the longer side of the view")
+    args = parser.parse_args()
+
+    if args.view is None:
+        started = time.perf_counter()
+        pyramid = build_pyramid(args.path, args.tile_size)
+        print(f"Built {len(pyramid['levels'])} levels {pyramid['levels']} in {time.perf_counter() - started:.2f} s")
+        return
+
+    pyramid = ScanPyramid(args.path)
+    for attempt in ("cold", "cached"):
+        started = time.perf_counter()
+        level, image = pyramid.view(*args.view, max_pixels=args.max_pixels)
+        print(f"{attempt}: level {level}, {image.shape[1]}x{image.shape[0]} pixels in "
+              f"{(time.perf_counter() - started) * 1e3:.2f} ms ({pyramid.hits} tile hits, {pyramid.misses} misses)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,457 @@
+"""
+Declarative measurement recipes
+
+A recipe is a JSON (or, with PyYAML installed, YAML) document describing a measurement job as a list of
+steps:
+
+    {
+        "name": "Overview scan",
+        "steps": [
+            {"name": "scan setup", "set": {"ScannerMode": 0, "ScannerRange": 10.0, "ScannerResolution": 1,
+                                           "ScannerLinesPerSecond": 1.0}},
+            {"name": "feedback", "set": {"AFMPIDConstantP": 10, "AFMPIDConstantI": 290}},
+            {"set": {"MeasurementDataSubscription": {"property": "type", "type": "line", "channel": 0,
+                                                     "format": "base64", "subscription": true}}},
+            {"trigger": "ActionMeasurementStart"},
+            {"wait": {"object": "MeasurementStatus", "value": "Idle", "timeout": 3600}},
+            {"get": ["ScannerRange", "ScannerResolution"]}
+        ]
+    }
+
+Step kinds:
+
+- "set":     {object: value} or {object: payload}; a plain value is sent as {"property": "value", ...}.
+- "get":     a list of objects, or {object: payload}. Replies are collected in RecipeResult.values.
+- "trigger": an action object (or a list of them), sent as {"property": "triggered", "value": true}.
+             A trigger of ActionMeasurementStart ends once the measurement has started, see below.
+- "wait":    {"object", "value", "timeout", "interval"}: wait until a get of the object returns the value.
+- "sleep":   seconds.
+
+Every step may have a "name". Recipes are validated against the objects and commands of API v1.1 before
+anything is sent (see afm_api.objects).
+
+Consecutive set and get steps are independent of each other and are sent as one pipelined batch, so a
+setup of 50 sets costs one round trip instead of 50; "barrier": true starts a new batch at a step. A
+trigger only runs once all earlier steps have succeeded. Waits are event driven: the object is queried
+again when a log message or the last line of a scan arrives (if subscribed), and otherwise only every
+"interval" seconds (default 5) as a fallback. The server may acknowledge ActionMeasurementStart before
+MeasurementStatus leaves "Idle", so a trigger of it also waits (up to 10 s) until the status is no longer
+"Idle" or the "Measurement started" log message arrives; a following wait for "Idle" then waits for the end
+of that scan. Every step is timed.
+
+Usage:
+    python -m afm_api.recipes recipes/standard_scan.json --uri ws://127.0.0.1:1234 --api-key KEY
+    python -m afm_api.recipes recipes/standard_scan.json --check
+
+Run from the examples/python directory.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import time
+
+from .client import AFMClient
+from .fleet import profile_commands
+from .logstore import SCAN_START
+from .objects import check_command
+
+STEP_KINDS = ("set", "get", "trigger", "wait", "sleep")
+BATCH_KINDS = ("set", "get")
+
+DEFAULT_WAIT_TIMEOUT = 3600.0
+DEFAULT_WAIT_INTERVAL = 5.0
+
+# The state usually changes shortly after a hint, e.g. one line period after the last line of a scan: for
+# HINT_POLL_TIME seconds after a hint, waits query the object every HINT_POLL_INTERVAL seconds
+HINT_POLL_TIME = 2.0
+HINT_POLL_INTERVAL = 0.25
+
+# Seconds a scan may take to leave "Idle" after ActionMeasurementStart was acknowledged
+DEFAULT_START_TIMEOUT = 10.0
+
+
+class RecipeError(ValueError):
+    """Invalid recipe. problems lists every problem found."""
+
+    def __init__(self, problems):
+        self.problems = list(problems)
+        super().__init__("Invalid recipe:\n" + "\n".join(f"- {problem}" for problem in self.problems))
+
+
+def load_recipe(path):
+    """Load and validate a recipe from a .json, .yaml or .yml file."""
+    with open(path) as f:
+        if os.path.splitext(path)[1].lower() in (".yaml", ".yml"):
+            try:
+                import yaml
+            except ImportError:
+                raise RecipeError(["YAML recipes require PyYAML (pip install pyyaml)"]) from None
+            data = yaml.safe_load(f)
+        else:
+            data = json.load(f)
+    return Recipe(data)
+
+
+def value_matches(value, expected):
+    """Compare a reply value with an expected value; enumerated values match by index or text."""
+    if isinstance(value, dict):
+        return expected in (value.get("index"), value.get("text"))
+    return value == expected
+
+
+class Step:
+    __slots__ = ("index", "name", "kind", "spec", "barrier")
+
+    def __init__(self, index, data):
+        self.index = index
+        self.kind = next((kind for kind in STEP_KINDS if kind in data), None)
+        self.spec = data.get(self.kind)
+        self.name = data.get("name") or f"{index + 1}: {self.kind}"
+        self.barrier = bool(data.get("barrier", False))
+
+    def commands(self):
+        """(command, object, payload) tuples of set, get and trigger steps."""
+        if self.kind == "set":
+            return profile_commands(self.spec)
+        if self.kind == "get":
+            if isinstance(self.spec, dict):
+                return [("get", obj, payload) for obj, payload in self.spec.items()]
+            return [("get", obj, {"property": "value"}) for obj in self.spec]
+        if self.kind == "trigger":
+            objects = [self.spec] if isinstance(self.spec, str) else self.spec
+            return [("set", obj, {"property": "triggered", "value": True}) for obj in objects]
+        return []
+
+    def validate(self, data):
+        problems = []
+        keys = [key for key in data if key in STEP_KINDS]
+        if len(keys) != 1:
+            return [f"step {self.name!r} must have exactly one of {', '.join(STEP_KINDS)}"]
+        if self.kind == "set" and not isinstance(self.spec, dict):
+            problems.append(f"step {self.name!r}: 'set' must map objects to values or payloads")
+        elif self.kind == "get" and not isinstance(self.spec, (list, dict)):
+            problems.append(f"step {self.name!r}: 'get' must be a list of objects or map objects to payloads")
+        elif self.kind == "trigger" and not (isinstance(self.spec, str) or (
+                isinstance(self.spec, list) and all(isinstance(obj, str) for obj in self.spec))):
+            problems.append(f"step {self.name!r}: 'trigger' must be an object name or a list of them")
+        elif self.kind == "wait":
+            if not isinstance(self.spec, dict) or "object" not in self.spec or "value" not in self.spec:
+                problems.append(f"step {self.name!r}: 'wait' needs an 'object' and a 'value'")
+            else:
+                problem = check_command("get", self.spec["object"])
+                if problem:
+                    problems.append(f"step {self.name!r}: {problem}")
+                for key in ("timeout", "interval"):
+                    if not isinstance(self.spec.get(key, 1), (int, float)) or self.spec.get(key, 1) <= 0:
+                        problems.append(f"step {self.name!r}: wait '{key}' must be a positive number")
+        elif self.kind == "sleep" and (not isinstance(self.spec, (int, float)) or self.spec < 0):
+            problems.append(f"step {self.name!r}: 'sleep' must be a number of seconds")
+        if problems:
+            return problems
+        for command, obj, payload in self.commands():
+            problem = check_command(command, obj)
+            if problem:
+                problems.append(f"step {self.name!r}: {problem}")
+            elif not isinstance(payload, dict):
+                problems.append(f"step {self.name!r}: payload of {obj} must be an object")
+        return problems
+
+
+class StepResult:
+    """Timing and outcome of one step. Times are in seconds from the start of the recipe."""
+
+    __slots__ = ("step", "batch", "started", "duration", "replies", "polls", "error")
+
+    def __init__(self, step, batch, started):
+        self.step = step
+        self.batch = batch
+        self.started = started
+        self.duration = None
+        # object -> seconds from the start of the step until its reply arrived
+        self.replies = {}
+        self.polls = 0
+        self.error = None
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def as_dict(self):
+        return {
+            "name": self.step.name,
+            "kind": self.step.kind,
+            "batch": self.batch,
+            "started_s": round(self.started, 6),
+            "duration_s": None if self.duration is None else round(self.duration, 6),
+            "replies_s": {obj: round(t, 6) for obj, t in self.replies.items()},
+            "polls": self.polls,
+            "error": None if self.error is None else str(self.error),
+        }
+
+
+class RecipeResult:
+    def __init__(self, recipe):
+        self.recipe = recipe
+        self.steps = []
+        self.values = {}
+        self.duration = None
+        self.batches = 0
+
+    @property
+    def ok(self):
+        return len(self.steps) == len(self.recipe.steps) and all(step.ok for step in self.steps)
+
+    def as_dict(self):
+        return {
+            "recipe": self.recipe.name,
+            "ok": self.ok,
+            "duration_s": None if self.duration is None else round(self.duration, 6),
+            "batches": self.batches,
+            "steps": [step.as_dict() for step in self.steps],
+            "values": self.values,
+        }
+
+
+class Recipe:
+    """A validated list of steps that can be run on an AFMClient."""
+
+    def __init__(self, data):
+        if not isinstance(data, dict) or not isinstance(data.get("steps"), list):
+            raise RecipeError(["a recipe must be an object with a list of 'steps'"])
+        self.name = data.get("name", "recipe")
+        self.description = data.get("description", "")
+        self.steps = []
+        problems = []
+        for index, step_data in enumerate(data["steps"]):
+            if not isinstance(step_data, dict):
+                problems.append(f"step {index + 1} must be an object")
+                continue
+            step = Step(index, step_data)
+            problems.extend(step.validate(step_data))
+            self.steps.append(step)
+        if problems:
+            raise RecipeError(problems)
+
+    def batches(self):
+        """Group the steps into the units that are executed one after another."""
+        batches = []
+        for step in self.steps:
+            if (step.kind in BATCH_KINDS and batches and batches[-1][0].kind in BATCH_KINDS
+                    and not step.barrier):
+                batches[-1].append(step)
+            else:
+                batches.append([step])
+        return batches
+
+    async def run(self, client, stop_on_error=True):
+        """Execute the recipe. Returns a RecipeResult; with stop_on_error the run ends at the first failure."""
+        result = RecipeResult(self)
+        started = time.perf_counter()
+        for number, batch in enumerate(self.batches()):
+            result.batches += 1
+            offset = time.perf_counter() - started
+            step_results = [StepResult(step, number, offset) for step in batch]
+            result.steps.extend(step_results)
+            kind = batch[0].kind
+            if kind in BATCH_KINDS:
+                await self._run_commands(client, step_results, result.values)
+            elif kind == "trigger":
+                await self._run_trigger(client, step_results[0], result.values)
+            elif kind == "wait":
+                await self._run_wait(client, step_results[0])
+            else:
+                await asyncio.sleep(batch[0].spec)
+                step_results[0].duration = time.perf_counter() - started - offset
+            if stop_on_error and not all(step.ok for step in step_results):
+                break
+        result.duration = time.perf_counter() - started
+        return result
+
+    async def _run_commands(self, client, step_results, values):
+        # All commands of the batch are sent back-to-back; each reply is timed when it arrives
+        batch_started = time.perf_counter()
+
+        async def timed(step_result, command, obj, payload):
+            try:
+                reply = await client.request(command, obj, payload)
+            except Exception as e:
+                if step_result.error is None:
+                    step_result.error = e
+                return
+            step_result.replies[obj] = time.perf_counter() - batch_started
+            if command == "get":
+                values[obj] = reply
+
+        await asyncio.gather(*(timed(step_result, *command)
+                               for step_result in step_results for command in step_result.step.commands()))
+        for step_result in step_results:
+            step_result.duration = max(step_result.replies.values(), default=time.perf_counter() - batch_started)
+
+    async def _run_trigger(self, client, step_result, values):
+        if not any(obj == "ActionMeasurementStart" for _, obj, _ in step_result.step.commands()):
+            await self._run_commands(client, [step_result], values)
+            return
+        # Registered before the trigger is sent, so the "Measurement started" message cannot be missed
+        started = asyncio.Event()
+        on_frame = scan_start_handler(started)
+        client.add_frame_handler(on_frame)
+        step_started = time.perf_counter()
+
+        def on_poll(reply):
+            step_result.polls += 1
+
+        try:
+            await self._run_commands(client, [step_result], values)
+            if step_result.ok:
+                await wait_for_start(client, started, on_poll=on_poll)
+        except Exception as e:
+            step_result.error = e
+        finally:
+            client.remove_frame_handler(on_frame)
+            step_result.duration = time.perf_counter() - step_started
+
+    async def _run_wait(self, client, step_result):
+        spec = step_result.step.spec
+        started = time.perf_counter()
+
+        def on_poll(reply):
+            step_result.polls += 1
+
+        try:
+            await wait_for_value(client, spec["object"], spec["value"], spec.get("timeout", DEFAULT_WAIT_TIMEOUT),
+                                 spec.get("interval", DEFAULT_WAIT_INTERVAL), on_poll)
+        except Exception as e:
+            step_result.error = e
+        finally:
+            step_result.duration = time.perf_counter() - started
+
+
+async def wait_for_value(client, obj, expected, timeout=DEFAULT_WAIT_TIMEOUT, interval=DEFAULT_WAIT_INTERVAL,
+                         on_poll=None):
+    """
+    Wait until a get of obj returns the expected value. The object is queried again when a log message or
+    the last line of a scan arrives (if subscribed), and otherwise every interval seconds. The last line is
+    recognized by ScannerResolution, which is fetched once if the parameter cache does not hold it. For
+    HINT_POLL_TIME seconds after such a hint the object is queried every HINT_POLL_INTERVAL seconds.
+    on_poll(reply) is called after every get. Raises asyncio.TimeoutError after timeout seconds.
+    """
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    changed = asyncio.Event()
+    if client.parameters.get("ScannerResolution") is None:
+        try:
+            await client.parameters.fetch("ScannerResolution")
+        except Exception:
+            # Without it only log messages and the interval trigger another get
+            pass
+    hinted = None
+
+    def on_frame(data):
+        # A log message or the last line of a scan is a hint that the state may have changed
+        if data.get("object") == "LogEvent":
+            changed.set()
+            return
+        payload = data.get("payload") or {}
+        value = payload.get("value")
+        resolution = client.parameters.get("ScannerResolution")
+        if payload.get("type") == "line" and isinstance(value, dict) and resolution is not None:
+            if value.get("y_position") == resolution - 1:
+                changed.set()
+
+    client.add_frame_handler(on_frame)
+    try:
+        while True:
+            changed.clear()
+            reply = await client.get(obj)
+            if on_poll is not None:
+                on_poll(reply)
+            if value_matches((reply or {}).get("value"), expected):
+                return reply
+            now = loop.time()
+            remaining = started + timeout - now
+            if remaining <= 0:
+                raise asyncio.TimeoutError(f"{obj} did not become {expected!r} within {timeout} s")
+            delay = HINT_POLL_INTERVAL if hinted is not None and now - hinted < HINT_POLL_TIME else interval
+            try:
+                await asyncio.wait_for(changed.wait(), min(delay, remaining))
+                hinted = loop.time()
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        client.remove_frame_handler(on_frame)
+
+
+def scan_start_handler(started):
+    """Frame handler that sets the started event when the "Measurement started" log message arrives."""
+
+    def on_frame(data):
+        if data.get("object") == "LogEvent" and SCAN_START.search(str((data.get("payload") or {}).get("message"))):
+            started.set()
+
+    return on_frame
+
+
+async def wait_for_start(client, started, timeout=DEFAULT_START_TIMEOUT, interval=0.25, on_poll=None):
+    """
+    Wait until MeasurementStatus is no longer "Idle" or the started event is set (see scan_start_handler()).
+    Raises asyncio.TimeoutError if the scan has not started after timeout seconds.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while not started.is_set():
+        reply = await client.get("MeasurementStatus")
+        if on_poll is not None:
+            on_poll(reply)
+        if (reply or {}).get("value") != "Idle":
+            return
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            raise asyncio.TimeoutError(f"The measurement did not start within {timeout} s")
+        try:
+            await asyncio.wait_for(started.wait(), min(interval, remaining))
+        except asyncio.TimeoutError:
+            pass
+
+
+async def run(args, recipe):
+    async with AFMClient(args.uri, args.api_key, args.timeout) as client:
+        result = await recipe.run(client, stop_on_error=not args.keep_going)
+    for step in result.steps:
+        status = "ok" if step.ok else f"FAILED: {step.error}"
+        print(f"batch {step.batch:3d}  {step.started * 1e3:9.1f} ms  {step.duration * 1e3:9.1f} ms  "
+              f"{step.step.name}: {status}")
+    print(f"{recipe.name}: {'ok' if result.ok else 'failed'} in {result.duration:.3f} s, "
+          f"{len(result.steps)} steps in {result.batches} batches")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result.as_dict(), f, indent=2)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("recipe", help="recipe file (.json, .yaml)")
+    parser.add_argument("--uri", default="ws://127.0.0.1:1234")
+    parser.add_argument("--api-key", default="AFM-Control-API-Key")
+    parser.add_argument("--timeout", type=float, default=5.0, help="reply timeout in seconds")
+    parser.add_argument("--check", action="store_true", help="only validate the recipe")
+    parser.add_argument("--keep-going", action="store_true", help="do not stop at the first failed step")
+    parser.add_argument("--output", help="write the results and timings as JSON to this file")
+    args = parser.parse_args()
+    try:
+        recipe = load_recipe(args.recipe)
+    except RecipeError as e:
+        parser.exit(1, f"{e}\n")
+    if args.check:
+        batches = recipe.batches()
+        print(f"{recipe.name}: {len(recipe.steps)} steps in {len(batches)} batches, valid")
+        return
+    result = asyncio.run(run(args, recipe))
+    if not result.ok:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
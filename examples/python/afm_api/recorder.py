@@ -0,0 +1,201 @@
+"""
+On-disk scan recorder assembled from line subscriptions
+
+Transferring full images with "get MeasurementData" is not recommended above 256x256 pixels, so complete
+images are rebuilt from the MeasurementDataSubscription line stream instead. ScanRecorder preallocates a
+.npy file of shape channels x directions x resolution x resolution, memory-maps it and writes every
+incoming line into its row selected by "y_position". Only the pages touched by the current rows are held
+in memory, and the file is flushed incrementally.
+
+Rows that have not been received yet are NaN, so a partially finished scan can be opened at any time
+with open_scan() (or numpy.load(path, mmap_mode="r")) while the recording is still running. A small JSON
+sidecar next to the data file lists the channels, signals and received rows.
+
+With pyramid=True the recorder also keeps downsampled min/max/mean levels of the scan up to date, row by
+row, for browsing large recordings tile by tile (see afm_api.pyramid).
+
+Rows that an auto-reconnecting AFMClient reports as missed during a connection loss are flagged in the
+sidecar ("missed_rows"). They stay flagged until the row is written, e.g. by a later pass of a continuous
+scan or by backfilling it with write_line() from another source.
+"""
+
+import json
+import os
+import re
+import time
+
+import numpy as np
+from numpy.lib.format import open_memmap
+
+from .decoding import decode_line
+
+DIRECTIONS = ("forward", "backward")
+
+
+def parse_resolution(payload):
+    """Return the pixel resolution from a ScannerResolution reply, e.g. {"value": {"text": "128x128"}}."""
+    value = payload.get("value", payload)
+    if isinstance(value, dict):
+        value = value.get("text", "")
+    if isinstance(value, int):
+        return value
+    match = re.match(r"\s*(\d+)", str(value))
+    if not match:
+        raise ValueError(f"Cannot parse scanner resolution from {payload!r}")
+    return int(match.group(1))
+
+
+def metadata_path(path):
+    return os.path.splitext(path)[0] + ".json"
+
+
+def open_scan(path):
+    """Open a recorded (or still recording) scan read-only. Returns (data, metadata)."""
+    data = np.load(path, mmap_mode="r")
+    try:
+        with open(metadata_path(path)) as f:
+            metadata = json.load(f)
+    except FileNotFoundError:
+        metadata = {}
+    return data, metadata
+
+
+class ScanRecorder:
+    """Write streamed scan lines into a memory-mapped channels x directions x rows x columns array."""
+
+    def __init__(self, path, resolution, channels=(0,), dtype=np.float32, flush_rows=16, flush_interval=1.0,
+                 pyramid=False, tile_size=256):
+        self.path = path
+        self.resolution = int(resolution)
+        self.channels = list(channels)
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+
+        self._channel_index = {channel: i for i, channel in enumerate(self.channels)}
+        shape = (len(self.channels), len(DIRECTIONS), self.resolution, self.resolution)
+        self.data = open_memmap(path, mode="w+", dtype=dtype, shape=shape)
+        # Mark every pixel as not acquired; written plane by plane to keep memory use bounded
+        for plane in self.data.reshape(-1, self.resolution, self.resolution):
+            plane[:] = np.nan
+        self.rows_received = np.zeros((len(self.channels), self.resolution), dtype=bool)
+        self.signals = {}
+        self.x_range = None
+        self.lines_written = 0
+        self.lines_rejected = 0
+        # Rows reported as lost in transfer, per channel index
+        self.missed = [set() for _ in self.channels]
+        self.pyramid = None
+        if pyramid:
+            from .pyramid import PyramidBuilder
+            self.pyramid = PyramidBuilder(path, self.data, tile_size)
+
+        self._unflushed_rows = 0
+        self._last_flush = time.monotonic()
+        self.flush()
+
+    @classmethod
+    async def from_client(cls, client, path, channels=(0,), **kwargs):
+        """
+        Create a recorder sized by the current ScannerResolution of the connected instrument (from the
+        client's parameter cache if it is known there). Rows the client reports as missed after a
+        reconnect are flagged automatically.
+        """
+        resolution = await client.parameters.fetch("ScannerResolution")
+        recorder = cls(path, resolution, channels, **kwargs)
+        client.add_missed_rows_handler(recorder.flag_missed)
+        return recorder
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def handle_frame(self, data):
+        """Frame handler for AFMClient.add_frame_handler."""
+        if data.get("object") != "MeasurementDataSubscription":
+            return
+        payload = data.get("payload") or {}
+        if payload.get("type") == "line" and payload.get("channel") in self._channel_index:
+            self.write_line(decode_line(payload))
+
+    def write_line(self, line):
+        """Store one LineData in its row. Returns False if the line does not fit this recording."""
+        channel_index = self._channel_index.get(line.channel)
+        row = line.y_position
+        if (channel_index is None or row is None or not 0 <= row < self.resolution
+                or len(line.x) != self.resolution or not line.is_valid()):
+            self.lines_rejected += 1
+            return False
+
+        self.data[channel_index, 0, row] = line.y_forward
+        self.data[channel_index, 1, row] = line.y_backward
+        self.rows_received[channel_index, row] = True
+        self.missed[channel_index].discard(row)
+        self.signals[line.channel] = line.signal
+        if self.pyramid is not None:
+            self.pyramid.update_row(channel_index, row)
+        if self.x_range is None:
+            self.x_range = (float(line.x[0]), float(line.x[-1]))
+        self.lines_written += 1
+
+        self._unflushed_rows += 1
+        if (self._unflushed_rows >= self.flush_rows
+                or time.monotonic() - self._last_flush >= self.flush_interval):
+            self.flush()
+        return True
+
+    def flag_missed(self, channel, rows):
+        """Missed rows handler for AFMClient.add_missed_rows_handler: flag rows lost in transfer."""
+        channel_index = self._channel_index.get(channel)
+        if channel_index is None:
+            return
+        self.missed[channel_index].update(row for row in rows if 0 <= row < self.resolution)
+        self.flush()
+
+    def missed_rows(self, channel):
+        """Rows of a channel reported as missed that have not been written since."""
+        return sorted(self.missed[self._channel_index[channel]])
+
+    def missing_rows(self, channel=None):
+        """Rows not received yet, for one channel or for any of the recorded channels."""
+        if channel is None:
+            received = self.rows_received.all(axis=0)
+        else:
+            received = self.rows_received[self._channel_index[channel]]
+        return np.flatnonzero(~received).tolist()
+
+    @property
+    def complete(self):
+        return bool(self.rows_received.all())
+
+    def flush(self):
+        """Write modified pages and the metadata sidecar to disk."""
+        self.data.flush()
+        if self.pyramid is not None:
+            self.pyramid.flush()
+        metadata = {
+            "shape": list(self.data.shape),
+            "dtype": str(self.data.dtype),
+            "channels": self.channels,
+            "directions": list(DIRECTIONS),
+            "signals": {str(channel): signal for channel, signal in self.signals.items()},
+            "x_range": self.x_range,
+            "rows_received": [np.flatnonzero(rows).tolist() for rows in self.rows_received],
+            "missed_rows": [sorted(rows) for rows in self.missed],
+        }
+        if self.pyramid is not None:
+            metadata["pyramid"] = self.pyramid.metadata()
+        tmp_path = metadata_path(self.path) + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(metadata, f)
+        os.replace(tmp_path, metadata_path(self.path))
+        self._unflushed_rows = 0
+        self._last_flush = time.monotonic()
+
+    def close(self):
+        if self.data is not None:
+            self.flush()
+            if self.pyramid is not None:
+                self.pyramid.close()
+            self.data = None
@@ -0,0 +1,421 @@
+"""
+Vectorized line plot rendering for Tkinter canvases
+
+LinePlot draws the forward and backward trace of a scan line on a tk.Canvas. All canvas items (axes, tick
+marks, tick labels, axis titles and the two traces) are created once and then updated in place with
+Canvas.coords/itemconfigure, instead of deleting and recreating the whole canvas on every frame.
+
+Per frame the plot bounds are computed once, coordinates are scaled with NumPy, and lines with more points
+than the plot has pixel columns are decimated to the minimum and maximum of every column. The decimated
+trace looks the same as the full one, but Tk only has to handle about two points per pixel column, so
+drawing cost no longer grows with the scan resolution.
+
+MapView shows "map" data (or a map assembled from streamed lines) as a heatmap in a single Tk PhotoImage:
+
+- the map is kept as a NumPy array in MapImage, which knows which rows changed since the last draw. A new
+  map frame is compared with the stored one in a single vectorized step, and only the rows that differ are
+  colored again and written into the PhotoImage, as binary PPM bands,
+- colors come from a lookup table of 256 entries precomputed per colormap; coloring a row is one scaling
+  and one table lookup,
+- the contrast follows percentiles (1 % and 99 % by default) of a histogram that is updated by the
+  changed rows only. The whole image is recolored only when the percentiles move by more than
+  contrast_tolerance of the color range,
+- maps larger than the view are subsampled to it, smaller ones are enlarged by an integer factor.
+"""
+
+import math
+
+import numpy as np
+
+
+def decimate_minmax(x, y, columns):
+    """
+    Reduce a monotonic x/y trace to the min and max of y in each of the given pixel columns.
+
+    Returns (x, y) with at most 2 * columns points. Traces that are already short enough are returned
+    unchanged.
+    """
+    n = len(x)
+    if columns < 1 or n <= 2 * columns:
+        return x, y
+    x_first, x_last = x[0], x[-1]
+    if x_first == x_last:
+        return x[:1], y[:1]
+    bins = ((x - x_first) * ((columns - 1) / (x_last - x_first))).astype(np.intp)
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(bins)) + 1))
+    y_min = np.minimum.reduceat(y, starts)
+    y_max = np.maximum.reduceat(y, starts)
+    return np.repeat(x[starts], 2), np.column_stack((y_min, y_max)).ravel()
+
+
+def data_bounds(*arrays):
+    """(min, max) over all arrays, ignoring NaN."""
+    return (min(float(np.nanmin(a)) for a in arrays),
+            max(float(np.nanmax(a)) for a in arrays))
+
+
+def scale(values, v_min, v_max, p_min, p_max):
+    """Map values linearly from [v_min, v_max] to pixel coordinates [p_min, p_max]."""
+    if v_max == v_min:
+        # Avoid division by zero
+        return np.full(len(values), (p_min + p_max) / 2)
+    return p_min + (values - v_min) * ((p_max - p_min) / (v_max - v_min))
+
+
+def flat_coords(x_pixels, y_pixels):
+    """Interleave pixel coordinates into the flat list expected by Canvas.coords."""
+    coords = np.empty(2 * len(x_pixels))
+    coords[0::2] = x_pixels
+    coords[1::2] = y_pixels
+    if len(x_pixels) == 1:
+        # A canvas line needs at least two points
+        coords = np.concatenate((coords, coords))
+    return coords.tolist()
+
+
+class LinePlot:
+    """Forward/backward line plot on a Tk canvas, updated in place."""
+
+    def __init__(self, canvas, width=600, height=400, margin_left=100, margin_top=20, margin_right=20,
+                 margin_bottom=50, ticks=10, colors=("red", "blue"), x_label="X Axis", y_label="Y Axis"):
+        self.canvas = canvas
+        self.width = width
+        self.height = height
+        self.margin_left = margin_left
+        self.margin_top = margin_top
+        self.margin_right = margin_right
+        self.margin_bottom = margin_bottom
+        self.ticks = ticks
+
+        # Axes, ticks and labels are created once and only moved or relabelled afterwards
+        self.x_axis = canvas.create_line(0, 0, 0, 0, fill='black')
+        self.y_axis = canvas.create_line(0, 0, 0, 0, fill='black')
+        self.x_ticks = [canvas.create_line(0, 0, 0, 0, fill='black') for _ in range(ticks + 1)]
+        self.y_ticks = [canvas.create_line(0, 0, 0, 0, fill='black') for _ in range(ticks + 1)]
+        self.x_tick_labels = [canvas.create_text(0, 0, text="", font=('Arial', 8), anchor='n')
+                              for _ in range(ticks + 1)]
+        self.y_tick_labels = [canvas.create_text(0, 0, text="", font=('Arial', 8), anchor='e')
+                              for _ in range(ticks + 1)]
+        self.x_title = canvas.create_text(0, 0, text=x_label, font=('Arial', 10))
+        self.y_title = canvas.create_text(0, 0, text=y_label, font=('Arial', 10), angle=90)
+        self.traces = [canvas.create_line(0, 0, 0, 0, fill=color, width=2, state='hidden') for color in colors]
+
+        self._layout = None
+
+    @property
+    def plot_area(self):
+        """(x0, y0, x1, y1) of the plot area; y0 is the bottom edge."""
+        return (self.margin_left, self.height - self.margin_bottom,
+                self.width - self.margin_right, self.margin_top)
+
+    def resize(self, width, height):
+        self.width = width
+        self.height = height
+
+    def draw(self, x, *traces):
+        """Draw one trace per configured color, all sharing the x values."""
+        x = np.asarray(x, dtype=np.float64)
+        traces = [np.asarray(y, dtype=np.float64) for y in traces]
+        x0, y0, x1, y1 = self.plot_area
+
+        # Bounds are computed once per frame for all traces
+        x_min, x_max = data_bounds(x)
+        y_min, y_max = data_bounds(*traces)
+        self._update_axes((x_min, x_max, y_min, y_max))
+
+        columns = max(int(x1 - x0), 1)
+        for item, y in zip(self.traces, traces):
+            x_decimated, y_decimated = decimate_minmax(x, y, columns)
+            coords = flat_coords(scale(x_decimated, x_min, x_max, x0, x1),
+                                 scale(y_decimated, y_min, y_max, y0, y1))
+            self.canvas.coords(item, coords)
+            self.canvas.itemconfigure(item, state='normal')
+
+    def _update_axes(self, bounds):
+        layout = (self.width, self.height, bounds)
+        if layout == self._layout:
+            # Neither the canvas size nor the data range changed: axes are up to date
+            return
+        self._layout = layout
+        x_min, x_max, y_min, y_max = bounds
+        x0, y0, x1, y1 = self.plot_area
+        canvas = self.canvas
+
+        canvas.coords(self.x_axis, x0, y0, x1, y0)
+        canvas.coords(self.y_axis, x0, y0, x0, y1)
+
+        for items, labels, v_min, v_max, along_x in ((self.x_ticks, self.x_tick_labels, x_min, x_max, True),
+                                                     (self.y_ticks, self.y_tick_labels, y_min, y_max, False)):
+            # Handle cases where max == min with a single centred tick
+            count = 1 if v_max == v_min else self.ticks + 1
+            values = np.linspace(v_min, v_max, count)
+            if along_x:
+                positions = scale(values, v_min, v_max, x0, x1)
+            else:
+                positions = scale(values, v_min, v_max, y0, y1)
+            for i, (tick, label) in enumerate(zip(items, labels)):
+                if i >= count:
+                    canvas.itemconfigure(tick, state='hidden')
+                    canvas.itemconfigure(label, state='hidden')
+                    continue
+                p = positions[i]
+                if along_x:
+                    canvas.coords(tick, p, y0, p, y0 + 5)
+                    canvas.coords(label, p, y0 + 15)
+                else:
+                    canvas.coords(tick, x0 - 5, p, x0, p)
+                    canvas.coords(label, x0 - 20, p)
+                canvas.itemconfigure(tick, state='normal')
+                canvas.itemconfigure(label, text=f"{values[i]:.2f}", state='normal')
+
+        canvas.coords(self.x_title, (x0 + x1) / 2, y0 + 35)
+        canvas.coords(self.y_title, x0 - 70, (y0 + y1) / 2)
+
+
+# Control points of the colormaps, from the lowest to the highest value
+COLORMAPS = {
+    "gray": ((0, 0, 0), (255, 255, 255)),
+    "afmhot": ((0, 0, 0), (128, 0, 0), (255, 128, 0), (255, 255, 128), (255, 255, 255)),
+    "viridis": ((68, 1, 84), (59, 82, 139), (33, 145, 140), (94, 201, 98), (253, 231, 37)),
+}
+
+# Color of pixels without data (NaN), stored behind the 256 colors of a lookup table
+BACKGROUND = (255, 255, 255)
+
+
+def colormap_lut(name="afmhot", background=BACKGROUND):
+    """Lookup table of 257 RGB colors: 256 steps of the colormap and the background color at index 256."""
+    points = np.asarray(COLORMAPS[name], dtype=np.float64)
+    positions = np.linspace(0.0, 1.0, len(points))
+    steps = np.linspace(0.0, 1.0, 256)
+    lut = np.empty((257, 3), dtype=np.uint8)
+    for i in range(3):
+        lut[:256, i] = np.round(np.interp(steps, positions, points[:, i]))
+    lut[256] = background
+    return lut
+
+
+class RunningHistogram:
+    """
+    Histogram of the finite values of a map, updated when rows are replaced. Its range is set with some
+    headroom on reset(); update() returns False when new values fall outside it, and the caller resets.
+    """
+
+    def __init__(self, bins=4096, headroom=0.1):
+        self.bins = bins
+        self.headroom = headroom
+        self.counts = np.zeros(bins, dtype=np.int64)
+        self.low = None
+        self.high = None
+
+    @property
+    def total(self):
+        return int(self.counts.sum())
+
+    def reset(self, values):
+        values = values[np.isfinite(values)]
+        self.counts[:] = 0
+        if not values.size:
+            self.low = self.high = None
+            return
+        low, high = float(values.min()), float(values.max())
+        margin = (high - low) * self.headroom or 1.0
+        self.low, self.high = low - margin, high + margin
+        self._add(values, 1)
+
+    def update(self, old, new):
+        """Replace the values old (counted before) with new. Returns False if new does not fit the range."""
+        new = new[np.isfinite(new)]
+        if self.low is None or (new.size and (new.min() < self.low or new.max() > self.high)):
+            return False
+        self._add(old[np.isfinite(old)], -1)
+        self._add(new, 1)
+        return True
+
+    def _add(self, values, sign):
+        if not values.size:
+            return
+        bins = ((values - self.low) * (self.bins / (self.high - self.low))).astype(np.intp)
+        np.clip(bins, 0, self.bins - 1, out=bins)
+        self.counts += sign * np.bincount(bins, minlength=self.bins)
+
+    def percentiles(self, percentiles):
+        """Values at the given percentiles (0 to 100), to the resolution of one bin; None if empty."""
+        cumulative = np.cumsum(self.counts)
+        total = cumulative[-1]
+        if self.low is None or total == 0:
+            return None
+        ranks = np.asarray(percentiles, dtype=np.float64) / 100.0 * total
+        bins = np.minimum(np.searchsorted(cumulative, ranks, side="left"), self.bins - 1)
+        return self.low + (bins + 0.5) * ((self.high - self.low) / self.bins)
+
+
+class MapImage:
+    """
+    Map data and its colored image for display, redrawn row by row; see the module docstring.
+
+    set_map() takes a complete map, set_row() a single row (e.g. the forward trace of a streamed line).
+    render() colors the rows changed since the last call and returns the bands (first, end) of display
+    rows that were updated in rgb.
+    """
+
+    def __init__(self, rows, columns, width=None, height=None, colormap="afmhot", percentiles=(1.0, 99.0),
+                 contrast_tolerance=0.02, bins=4096):
+        self.lut = colormap_lut(colormap)
+        self.percentiles = percentiles
+        self.contrast_tolerance = contrast_tolerance
+        self.histogram = RunningHistogram(bins)
+        # Color range of the current image, (low, high)
+        self.contrast = None
+        self.rows_drawn = 0
+        self.full_redraws = 0
+        self._size = (width, height)
+        self._reset(rows, columns)
+
+    def _reset(self, rows, columns):
+        self.image = np.full((rows, columns), np.nan)
+        self.histogram.reset(self.image)
+        self.contrast = None
+        self.fit(*self._size)
+
+    @property
+    def shape(self):
+        return self.image.shape
+
+    def fit(self, width=None, height=None):
+        """Scale the display to at most width x height pixels (integer subsampling or enlargement)."""
+        self._size = (width, height)
+        rows, columns = self.image.shape
+        limits = [size / count for size, count in ((width, columns), (height, rows)) if size]
+        factor = min(limits) if limits else 1.0
+        # Every step-th data row and column is shown, each as zoom x zoom pixels
+        self.step = max(1, math.ceil(1.0 / factor)) if factor < 1 else 1
+        self.zoom = max(1, int(factor)) if factor >= 1 else 1
+        self.display_rows = np.arange(0, rows, self.step)
+        self.rgb = np.empty((len(self.display_rows) * self.zoom, math.ceil(columns / self.step) * self.zoom, 3),
+                            dtype=np.uint8)
+        self.rgb[:] = self.lut[256]
+        self._dirty = set(range(rows))
+
+    @property
+    def display_size(self):
+        """(width, height) of the rendered image in pixels."""
+        return self.rgb.shape[1], self.rgb.shape[0]
+
+    def set_map(self, data):
+        """Replace the map; only rows that differ from the stored ones are marked for redrawing."""
+        data = np.asarray(data, dtype=np.float64)
+        if data.shape != self.image.shape:
+            self._reset(*data.shape)
+            self._set_rows(np.arange(data.shape[0]), data)
+            return
+        old = self.image
+        changed = (data != old) & ~(np.isnan(data) & np.isnan(old))
+        rows = np.flatnonzero(changed.any(axis=1))
+        self._set_rows(rows, data[rows])
+
+    def set_row(self, row, values):
+        """Replace one row of the map."""
+        values = np.asarray(values, dtype=np.float64)
+        if len(values) != self.image.shape[1] or not 0 <= row < self.image.shape[0]:
+            raise ValueError(f"Row {row} with {len(values)} points does not fit a map of {self.image.shape}")
+        self._set_rows(np.array([row]), values[None, :])
+
+    def _set_rows(self, rows, new):
+        if not rows.size:
+            return
+        if not self.histogram.update(self.image[rows], new):
+            self.image[rows] = new
+            self.histogram.reset(self.image)
+        else:
+            self.image[rows] = new
+        self._dirty.update(rows.tolist())
+
+    def _update_contrast(self):
+        """Follow the percentiles; returns True if the whole image has to be recolored."""
+        bounds = self.histogram.percentiles(self.percentiles)
+        if bounds is None:
+            return False
+        low, high = float(bounds[0]), float(bounds[-1])
+        if self.contrast is not None:
+            old_low, old_high = self.contrast
+            tolerance = self.contrast_tolerance * max(old_high - old_low, 1e-12)
+            if abs(low - old_low) <= tolerance and abs(high - old_high) <= tolerance:
+                return False
+        self.contrast = (low, high)
+        return True
+
+    def colorize(self, data):
+        """RGB colors of map values with the current contrast; NaN is drawn in the background color."""
+        low, high = self.contrast if self.contrast is not None else (0.0, 1.0)
+        scaled = (data - low) * (255.0 / max(high - low, 1e-12))
+        np.clip(scaled, 0, 255, out=scaled)
+        scaled[np.isnan(data)] = 256
+        return self.lut.take(scaled.astype(np.intp), axis=0)
+
+    def render(self):
+        if self._update_contrast():
+            self.full_redraws += 1
+            display = np.arange(len(self.display_rows))
+        else:
+            dirty = [row for row in self._dirty if row % self.step == 0]
+            display = np.array(sorted(dirty), dtype=np.intp) // self.step
+        self._dirty.clear()
+        if not display.size:
+            return []
+        colors = self.colorize(self.image[self.display_rows[display], ::self.step])
+        if self.zoom > 1:
+            colors = colors.repeat(self.zoom, axis=1).repeat(self.zoom, axis=0)
+            pixel_rows = (display[:, None] * self.zoom + np.arange(self.zoom)).ravel()
+        else:
+            pixel_rows = display
+        self.rgb[pixel_rows] = colors
+        self.rows_drawn += len(display)
+        # Contiguous bands of display rows, each written to the PhotoImage at once
+        breaks = np.flatnonzero(np.diff(pixel_rows) != 1) + 1
+        starts = np.concatenate(([0], breaks))
+        ends = np.concatenate((breaks, [len(pixel_rows)]))
+        return [(int(pixel_rows[start]), int(pixel_rows[end - 1]) + 1) for start, end in zip(starts, ends)]
+
+    def ppm(self, first=0, end=None):
+        """Binary PPM of the display rows first to end."""
+        band = self.rgb[first:end]
+        return b"P6 %d %d 255\n" % (band.shape[1], band.shape[0]) + band.tobytes()
+
+
+class MapView:
+    """Heatmap of a MapImage in one Tk PhotoImage on a canvas; draw() blits the rows changed since the last draw."""
+
+    def __init__(self, canvas, rows, columns, width=512, height=512, x=0, y=0, **options):
+        import tkinter as tk
+
+        self.canvas = canvas
+        self.map = MapImage(rows, columns, width, height, **options)
+        self.photo = tk.PhotoImage(master=canvas, width=self.map.display_size[0], height=self.map.display_size[1])
+        self.item = canvas.create_image(x, y, image=self.photo, anchor="nw")
+
+    def resize(self, width, height):
+        self.map.fit(width, height)
+        self._resize_photo()
+
+    def _resize_photo(self):
+        width, height = self.map.display_size
+        if (self.photo.width(), self.photo.height()) != (width, height):
+            self.photo.configure(width=width, height=height)
+            self.photo.blank()
+
+    def set_map(self, data):
+        shape = self.map.shape
+        self.map.set_map(data)
+        if self.map.shape != shape:
+            self._resize_photo()
+
+    def set_row(self, row, values):
+        self.map.set_row(row, values)
+
+    def draw(self):
+        """Write the changed bands into the PhotoImage; returns the number of bands."""
+        bands = self.map.render()
+        for first, end in bands:
+            self.photo.tk.call(self.photo.name, "put", self.map.ppm(first, end), "-format", "ppm", "-to", 0, first)
+        return len(bands)
@@ -0,0 +1,281 @@
+"""
+Title: Replay server for captured AFM Control API sessions
+
+Description:
+Plays a capture file written by AFMClient.start_capture() (see afm_api.capture) back over a local
+WebSocket, so that decoding, queueing and rendering can be profiled and benchmarked offline against the
+traffic of a real scan:
+
+- the streamed frames of the capture (line and map data, log messages, unsolicited frames) are sent to
+  every connected client exactly as they were received, in the same order, at the recorded pace scaled
+  by --speed (1 real time, 10 ten times faster, 0 as fast as the client reads). Playback starts after the
+  authentication, at the first streamed frame, and can loop or close the connection at the end,
+- set/get requests of the client are answered with the reply recorded for the same command, object and
+  payload (or, failing that, the same command and object), so clients that configure the instrument
+  before streaming run unchanged. Requests that were never recorded get an error frame.
+
+Usage:
+    python -m afm_api.replay_server session.afmcap --port 1234 --speed 1
+    python -m afm_api.replay_server session.afmcap --speed 0 --loop
+
+Run from the examples/python directory.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import re
+from collections import deque
+
+import websockets
+
+from .capture import RECEIVED, SENT, SessionReader
+from .client import STREAM_OBJECTS, SUBSCRIPTION_OBJECTS, is_stream_frame
+from .mock_server import error_frame
+
+logger = logging.getLogger(__name__)
+
+_COMMAND_RE = re.compile(r'"command"\s*:\s*"([^"]*)"')
+_OBJECT_RE = re.compile(r'"object"\s*:\s*"([^"]*)"')
+
+
+def _request_key(command, obj, payload):
+    return command, obj, json.dumps(payload, sort_keys=True)
+
+
+class SessionIndex:
+    """
+    Classification of the received frames of a capture into replies to requests and streamed frames.
+
+    Replies are correlated with the recorded requests the same way AFMClient does it: by object name and
+    order, and error frames without an object with the oldest open request.
+    """
+
+    def __init__(self, path):
+        self.auth_reply = None
+        # Record numbers of received frames that are replies (not played back)
+        self.reply_records = set()
+        # (command, object, payload) and (command, object) -> recorded replies in order
+        self.exact = {}
+        self.by_object = {}
+        self.stream_frames = 0
+        self._build(SessionReader(path))
+
+    def _build(self, reader):
+        pending = deque()
+        awaiting_auth = False
+        for number, record in enumerate(reader):
+            if isinstance(record.message, bytes):
+                continue
+            if record.direction == SENT:
+                try:
+                    data = json.loads(record.message)
+                except ValueError:
+                    continue
+                if data.get("command") == "authenticate":
+                    awaiting_auth = True
+                    pending.clear()
+                elif data.get("command") in ("get", "set"):
+                    obj = (data.get("object") or "").strip()
+                    pending.append(_request_key(data["command"], obj, data.get("payload") or {}))
+                continue
+            if record.direction != RECEIVED:
+                continue
+            if awaiting_auth:
+                self.auth_reply = record.message
+                self.reply_records.add(number)
+                awaiting_auth = False
+                continue
+            if self._is_stream(record.message):
+                self.stream_frames += 1
+                continue
+            command = _COMMAND_RE.search(record.message)
+            match = _OBJECT_RE.search(record.message)
+            obj = match.group(1).strip() if match else None
+            request = None
+            if obj is not None:
+                request = next((key for key in pending if key[1] == obj), None)
+            elif command is not None and command.group(1) == "error" and pending:
+                request = pending[0]
+            if request is None:
+                # Unsolicited, e.g. the reply to a command sent without waiting: played back as is
+                self.stream_frames += 1
+                continue
+            pending.remove(request)
+            self.reply_records.add(number)
+            self.exact.setdefault(request, []).append(record.message)
+            self.by_object.setdefault(request[:2], []).append(record.message)
+
+    @staticmethod
+    def _is_stream(message):
+        match = _OBJECT_RE.search(message)
+        if match is None:
+            return False
+        obj = match.group(1).strip()
+        if obj in STREAM_OBJECTS:
+            return True
+        if obj in SUBSCRIPTION_OBJECTS:
+            try:
+                return is_stream_frame(json.loads(message))
+            except ValueError:
+                return False
+        return False
+
+    def replies(self):
+        """Fresh per-connection queues of the recorded replies."""
+        return ({key: deque(messages) for key, messages in self.exact.items()},
+                {key: deque(messages) for key, messages in self.by_object.items()})
+
+
+def _next_reply(queues, key):
+    queue = queues.get(key)
+    if not queue:
+        return None
+    # The last recorded reply answers all further requests
+    return queue.popleft() if len(queue) > 1 else queue[0]
+
+
+class ReplayServer:
+    """Serves a capture file to local clients."""
+
+    def __init__(self, path, host="127.0.0.1", port=1234, speed=1.0, loop=False, close_when_done=False):
+        if speed < 0:
+            raise ValueError("speed must be positive, or 0 for as fast as possible")
+        self.path = path
+        self.host = host
+        self.port = port
+        self.speed = speed
+        self.loop = loop
+        # Close the connection after the last frame, e.g. to end a benchmark run
+        self.close_when_done = close_when_done
+        self.index = SessionIndex(path)
+        self.frames_sent = 0
+        self.connections = set()
+        self._server = None
+
+    @property
+    def uri(self):
+        return f"ws://{self.host}:{self.port}"
+
+    async def start(self):
+        self._server = await websockets.serve(self._handler, self.host, self.port, max_size=None)
+        # Pick up the actual port when port 0 was requested
+        self.port = list(self._server.sockets)[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.stop()
+
+    async def serve_forever(self):
+        await self.start()
+        try:
+            await asyncio.Future()
+        finally:
+            await self.stop()
+
+    async def _handler(self, websocket, path=None):
+        send_lock = asyncio.Lock()
+
+        async def send(message):
+            async with send_lock:
+                await websocket.send(message if isinstance(message, str) else json.dumps(message))
+
+        self.connections.add(websocket)
+        player = None
+        exact, by_object = self.index.replies()
+        try:
+            async for message in websocket:
+                try:
+                    request = json.loads(message)
+                except json.JSONDecodeError as e:
+                    await send(error_frame("Invalid JSON", str(e)))
+                    continue
+                command = request.get("command")
+                if player is None:
+                    if command != "authenticate":
+                        await send(error_frame("Authentication failed", "Invalid API key"))
+                        await websocket.close()
+                        return
+                    await send(self.index.auth_reply or {"command": "response", "object": "authenticate",
+                                                         "payload": {"status": "authenticated"}})
+                    player = asyncio.ensure_future(self._play(websocket, send))
+                    continue
+                obj = (request.get("object") or "").strip()
+                reply = (_next_reply(exact, _request_key(command, obj, request.get("payload") or {}))
+                         or _next_reply(by_object, (command, obj)))
+                await send(reply or error_frame("Not recorded", f"{command} {obj}"))
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            self.connections.discard(websocket)
+            if player is not None:
+                player.cancel()
+
+    async def _play(self, websocket, send):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                started = loop.time()
+                first = None
+                for number, record in enumerate(SessionReader(self.path)):
+                    if record.direction != RECEIVED or number in self.index.reply_records:
+                        continue
+                    if first is None:
+                        first = record.time_ns
+                    if self.speed:
+                        # Scheduled against the start, so that delays do not add up
+                        delay = started + (record.time_ns - first) / 1e9 / self.speed - loop.time()
+                        if delay > 0:
+                            await asyncio.sleep(delay)
+                    await send(record.message)
+                    self.frames_sent += 1
+                # A capture without streamed frames would otherwise be re-read forever without yielding
+                if not self.loop or first is None:
+                    break
+                await asyncio.sleep(0)
+            # Without streamed frames the client's recorded requests are still to come
+            if self.close_when_done and first is not None:
+                await websocket.close()
+        except websockets.ConnectionClosed:
+            pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("capture", help="capture file written by AFMClient.start_capture()")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=1234)
+    parser.add_argument("--speed", type=float, default=1.0, help="playback speed factor, 0 for maximum speed")
+    parser.add_argument("--loop", action="store_true", help="repeat the capture until stopped")
+    parser.add_argument("--close", action="store_true", help="close the connections at the end of the capture")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    server = ReplayServer(args.capture, args.host, args.port, args.speed, args.loop, args.close)
+
+    async def run():
+        await server.start()
+        print(f"Replaying {args.capture} ({server.index.stream_frames} streamed frames) on {server.uri}")
+        try:
+            await asyncio.Future()
+        finally:
+            await server.stop()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,470 @@
+"""
+Title: Cantilever frequency sweeps and resonance fitting
+
+Description:
+The automatic sweep of AFM Control (ActionActuationFrequencySweepStart, FrequencySweepStatus,
+FoundResonanceProperties) reports the resonance it found but not the response curve. This module adds a
+client-side sweep that records the curve itself:
+
+- frequency_sweep() steps ActuationFrequency through the given frequencies and reads the amplitude (and
+  phase) at every step through a reader. LineSignalReader averages the streamed lines of the amplitude
+  and phase measurement channels after the lock-in amplifier has settled.
+- fit_resonance() fits the amplitude of a driven damped harmonic oscillator (SHO),
+
+      A(f) = A0 f0^2 / sqrt((f0^2 - f^2)^2 + (f f0 / Q)^2),
+
+  to one sweep or to a stack of sweeps at once. The start values come from a linear least-squares fit of
+  the Lorentzian 1/A^2, which is a parabola in f near the resonance. Levenberg-Marquardt steps then refine
+  A0, f0 and Q, vectorized over all sweeps, with analytic derivatives.
+- The Resonance result has f0, Q, the bandwidth f0/Q and the peak amplitude. It also proposes P and I for
+  the feedback loop and a lock-in time constant (see propose_controller()).
+- tune() runs a coarse sweep and a fine sweep around the resonance found, and can apply the proposals.
+  server_sweep() runs the automatic sweep of the server instead. tune_fleet() tunes all instruments of a
+  Fleet concurrently, so the probes of several tools are changed in the time of one sweep.
+
+Usage:
+    python -m afm_api.resonance --start 30000 --stop 36000 --points 201 --output sweep.csv
+    python -m afm_api.resonance --server --start 30000 --stop 36000 --apply
+
+Run from the examples/python directory. The mock server (python -m afm_api.mock_server --channels 3
+--lines-per-second 100) simulates a cantilever on its amplitude (2) and phase (1) channels.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import time
+from collections import namedtuple
+
+import numpy as np
+
+from .client import AFMClient
+from .decoding import decode_line
+from .streams import DROP_OLDEST
+
+logger = logging.getLogger(__name__)
+
+# Frequencies in Hz, amplitudes and phases as read (V and degrees for the mock server)
+SweepData = namedtuple("SweepData", ("frequency", "amplitude", "phase"))
+
+# AFM Control's proposal for the resonance of its documentation example: P 10 and I 290 at a peak bandwidth
+# of 8.33739 Hz, with a lock-in time constant of 5.99708 ms, i.e. 50 / bandwidth
+REFERENCE_P = 10.0
+REFERENCE_I = 290.0
+REFERENCE_BANDWIDTH = 8.33739
+LOCK_IN_FACTOR = 50.0
+
+
+def sho_amplitude(frequency, a0, f0, q):
+    """Amplitude of a damped harmonic oscillator driven at frequency, A0 being the amplitude at 0 Hz."""
+    frequency = np.asarray(frequency, dtype=float)
+    return a0 * f0 ** 2 / np.sqrt((f0 ** 2 - frequency ** 2) ** 2 + (frequency * f0 / q) ** 2)
+
+
+def sho_phase(frequency, f0, q):
+    """Phase lag in degrees of a damped harmonic oscillator, -90 at the resonance."""
+    frequency = np.asarray(frequency, dtype=float)
+    return -np.degrees(np.arctan2(frequency * f0 / q, f0 ** 2 - frequency ** 2))
+
+
+def propose_controller(bandwidth):
+    """
+    (P, I, lock-in time constant in ms) for a resonance of the given bandwidth.
+
+    The amplitude of a cantilever follows a change within about 1 / (pi bandwidth), so the integral gain is
+    scaled with the bandwidth from AFM Control's reference proposal and P is kept. The lock-in time constant
+    is the one AFM Control proposes, 50 / bandwidth.
+    """
+    return REFERENCE_P, REFERENCE_I * bandwidth / REFERENCE_BANDWIDTH, LOCK_IN_FACTOR / bandwidth
+
+
+class Resonance:
+    """A cantilever resonance, from a fit (source "fit") or from FoundResonanceProperties ("server")."""
+
+    def __init__(self, frequency, q, peak_amplitude, source="fit", residual=None, phase_offset=None,
+                 p=None, i=None, lock_in_ms=None):
+        self.frequency = frequency
+        self.q = q
+        self.peak_amplitude = peak_amplitude
+        self.source = source
+        # RMS of the fit residuals relative to the peak amplitude
+        self.residual = residual
+        # Measured phase minus the SHO phase, i.e. the phase offset of the detection
+        self.phase_offset = phase_offset
+        proposed = propose_controller(self.bandwidth)
+        self.p = proposed[0] if p is None else p
+        self.i = proposed[1] if i is None else i
+        self.lock_in_ms = proposed[2] if lock_in_ms is None else lock_in_ms
+
+    def __repr__(self):
+        return (f"Resonance(frequency={self.frequency:.2f}, q={self.q:.1f}, bandwidth={self.bandwidth:.3f}, "
+                f"source={self.source!r})")
+
+    @property
+    def bandwidth(self):
+        """Full width at half maximum of the power, f0 / Q, in Hz."""
+        return self.frequency / self.q
+
+    @classmethod
+    def from_found_properties(cls, payload):
+        """From the reply of FoundResonanceProperties."""
+        return cls(float(payload["resonanceFrequencyActuation_Hz"]), float(payload["QFactor"]),
+                   float(payload.get("resonanceAmplitude_V", np.nan)), "server",
+                   p=payload.get("Pvalue"), i=payload.get("Ivalue"), lock_in_ms=payload.get("LITimeConstant_ms"))
+
+    def profile(self):
+        """The proposed settings as {object: value}, e.g. for Fleet.apply_profile()."""
+        return {
+            "ActuationFrequency": round(self.frequency, 3),
+            "AFMPIDConstantP": self.p,
+            "AFMPIDConstantI": round(self.i, 3),
+            "DetectionLockInTimeConstant": round(self.lock_in_ms, 3),
+        }
+
+    def as_dict(self):
+        return {
+            "frequency_hz": self.frequency,
+            "q": self.q,
+            "bandwidth_hz": self.bandwidth,
+            "peak_amplitude": self.peak_amplitude,
+            "source": self.source,
+            "residual": self.residual,
+            "phase_offset_deg": self.phase_offset,
+            "p": self.p,
+            "i": self.i,
+            "lock_in_ms": self.lock_in_ms,
+        }
+
+
+def _initial_guess(frequency, amplitude):
+    """
+    A0, f0, Q of every sweep from the Lorentzian approximation near the resonance: 1/A^2 is a parabola in f,
+    fitted by weighted linear least squares (weights A^3, as the noise of 1/A^2 grows with 1/A^3).
+    """
+    center = 0.5 * (frequency[0] + frequency[-1])
+    half_span = 0.5 * abs(frequency[-1] - frequency[0]) or 1.0
+    t = (frequency - center) / half_span
+    basis = np.stack([np.ones_like(t), t, t * t], axis=-1)
+    weight = amplitude ** 3
+    y = weight / amplitude ** 2
+    a = basis[None] * weight[..., None]
+    # Normal equations of all sweeps, solved together
+    ata = np.einsum("spi,spj->sij", a, a)
+    aty = np.einsum("spi,sp->si", a, y)
+    alpha, beta, gamma = np.linalg.solve(ata, aty[..., None])[..., 0].T
+    with np.errstate(divide="ignore", invalid="ignore"):
+        vertex = np.clip(-beta / (2 * gamma), -1.0, 1.0)
+        minimum = alpha + beta * vertex + gamma * vertex ** 2
+        f0 = center + vertex * half_span
+        bandwidth = 2 * half_span * np.sqrt(minimum / gamma)
+    peak = amplitude.max(axis=1)
+    # Fall back to the highest point and a bandwidth of a tenth of the span where the parabola is unusable
+    invalid = ~((gamma > 0) & (minimum > 0) & np.isfinite(bandwidth) & (bandwidth > 0))
+    f0 = np.where(invalid, frequency[np.argmax(amplitude, axis=1)], f0)
+    bandwidth = np.where(invalid, half_span / 5, bandwidth)
+    q = f0 / bandwidth
+    a0 = np.where(invalid, peak, 1 / np.sqrt(np.where(invalid, 1.0, minimum))) / q
+    return np.stack([a0, f0, q], axis=-1)
+
+
+def _jacobian(frequency, parameters):
+    """Model values and derivatives by A0, f0 and Q; shapes (sweeps, points) and (sweeps, points, 3)."""
+    a0, f0, q = (parameters[:, k, None] for k in range(3))
+    difference = f0 ** 2 - frequency ** 2
+    d = difference ** 2 + (frequency * f0 / q) ** 2
+    root = np.sqrt(d)
+    model = a0 * f0 ** 2 / root
+    d_f0 = 4 * f0 * difference + 2 * frequency ** 2 * f0 / q ** 2
+    d_q = -2 * frequency ** 2 * f0 ** 2 / q ** 3
+    jacobian = np.stack([
+        model / a0,
+        a0 * (2 * f0 / root - 0.5 * f0 ** 2 * d_f0 / (d * root)),
+        -0.5 * a0 * f0 ** 2 * d_q / (d * root),
+    ], axis=-1)
+    return model, jacobian
+
+
+def fit_resonance(frequency, amplitude, phase=None, iterations=50, tolerance=1e-10):
+    """
+    Fit the SHO amplitude to sweeps. frequency has shape (points,); amplitude (and phase) have shape
+    (points,) for one sweep or (sweeps, points) for several sweeps over the same frequencies.
+
+    Returns a Resonance, or a list of them for several sweeps. NaN values are left out of the fit.
+    """
+    frequency = np.asarray(frequency, dtype=float)
+    amplitude = np.asarray(amplitude, dtype=float)
+    single = amplitude.ndim == 1
+    amplitude = np.atleast_2d(amplitude)
+    valid = np.isfinite(amplitude)
+    # Missing points get zero weight in the least-squares steps
+    weights = valid.astype(float)
+    filled = np.where(valid, amplitude, 0.0)
+    if (valid.sum(axis=1) < 4).any():
+        raise ValueError("A sweep needs at least 4 valid points for the fit")
+    parameters = _initial_guess(frequency, np.where(valid, amplitude, np.nanmin(amplitude, axis=1)[:, None]))
+    damping = np.full(len(amplitude), 1e-3)
+
+    def cost(values):
+        return ((values - filled) ** 2 * weights).sum(axis=1)
+
+    model, jacobian = _jacobian(frequency, parameters)
+    current = cost(model)
+    for _ in range(iterations):
+        jw = jacobian * weights[..., None]
+        jtj = np.einsum("spi,spj->sij", jw, jacobian)
+        jtr = np.einsum("spi,sp->si", jw, filled - model)
+        # Marquardt's scaling: damping relative to the diagonal makes the step independent of the units
+        diagonal = np.einsum("sii->si", jtj)
+        system = jtj + (damping[:, None] * diagonal)[..., None] * np.eye(3)
+        step = np.linalg.solve(system, jtr[..., None])[..., 0]
+        candidate = parameters + step
+        positive = (candidate > 0).all(axis=1)
+        candidate_model, candidate_jacobian = _jacobian(frequency, np.where(positive[:, None], candidate,
+                                                                            parameters))
+        candidate_cost = np.where(positive, cost(candidate_model), np.inf)
+        better = candidate_cost < current
+        parameters = np.where(better[:, None], candidate, parameters)
+        model = np.where(better[:, None], candidate_model, model)
+        jacobian = np.where(better[:, None, None], candidate_jacobian, jacobian)
+        converged = better & (np.abs(step) <= tolerance * np.abs(parameters)).all(axis=1)
+        current = np.where(better, candidate_cost, current)
+        damping = np.where(better, damping / 3, damping * 4)
+        if (converged | (damping > 1e10)).all():
+            break
+
+    peak = parameters[:, 0] * parameters[:, 2]
+    residual = np.sqrt(current / weights.sum(axis=1)) / peak
+    offsets = [None] * len(amplitude)
+    if phase is not None:
+        phase = np.atleast_2d(np.asarray(phase, dtype=float))
+        for index, (a0, f0, q) in enumerate(parameters):
+            difference = phase[index] - sho_phase(frequency, f0, q)
+            # Circular mean, weighted towards the resonance where the phase is well defined
+            weight = np.nan_to_num(amplitude[index])
+            angle = np.radians(np.nan_to_num(difference))
+            offsets[index] = float(np.degrees(np.arctan2((weight * np.sin(angle)).sum(),
+                                                         (weight * np.cos(angle)).sum())))
+    results = [Resonance(float(f0), float(q), float(a0 * q), "fit", float(error), offset)
+               for (a0, f0, q), error, offset in zip(parameters, residual, offsets)]
+    return results[0] if single else results
+
+
+class LineSignalReader:
+    """
+    Reads amplitude and phase from the line streams of their measurement channels: the mean over the
+    forward and backward trace of a line acquired entirely at the current frequency.
+
+    Lines stream only while a measurement runs, at ScannerLinesPerSecond; continuous scanning (ScannerMode 1)
+    keeps them coming for the whole sweep, and the fastest line rate gives the fastest sweep.
+    """
+
+    def __init__(self, client, amplitude_channel=2, phase_channel=1, skip=1, timeout=10.0):
+        self.client = client
+        self.amplitude_channel = amplitude_channel
+        self.phase_channel = phase_channel
+        # Lines discarded after every frequency step: the line in progress was partly acquired before it
+        self.skip = skip
+        self.timeout = timeout
+        self._streams = {}
+
+    @property
+    def channels(self):
+        return [channel for channel in (self.amplitude_channel, self.phase_channel) if channel is not None]
+
+    async def start(self):
+        for channel in self.channels:
+            self._streams[channel] = self.client.stream("line", channel, maxlen=4, policy=DROP_OLDEST)
+            await self.client.subscribe_measurement_data(channel, "line", "base64")
+
+    async def stop(self):
+        for channel, stream in self._streams.items():
+            self.client.close_stream(stream)
+            try:
+                await self.client.subscribe_measurement_data(channel, "line", "base64", subscription=False)
+            except Exception as e:
+                logger.warning("Unsubscribing channel %s failed: %s", channel, e)
+        self._streams.clear()
+
+    async def _read_channel(self, channel):
+        stream = self._streams[channel]
+        stream.drain()
+        for _ in range(self.skip + 1):
+            frame = await asyncio.wait_for(stream.get(), self.timeout)
+        line = decode_line(frame["payload"])
+        return float(np.nanmean(np.concatenate((line.y_forward, line.y_backward))))
+
+    async def read(self):
+        """(amplitude, phase) at the current frequency; phase is NaN without a phase channel."""
+        values = await asyncio.gather(*(self._read_channel(channel) for channel in self.channels))
+        return values[0], values[1] if self.phase_channel is not None else np.nan
+
+
+async def lock_in_settle_time(client, periods=5.0):
+    """Settling time after a frequency step: the given number of lock-in time constants."""
+    reply = await client.get("DetectionLockInTimeConstant")
+    return periods * float(reply.get("value")) / 1e3
+
+
+async def frequency_sweep(client, frequencies, reader, settle=None, restore=True, progress=None):
+    """
+    Step ActuationFrequency through frequencies and read (amplitude, phase) after every step.
+
+    settle is the time in seconds to wait after a step (default: five lock-in time constants). With
+    restore=True the actuation frequency is set back at the end. progress(index, frequency, amplitude)
+    is called after every point. Returns SweepData.
+    """
+    frequencies = np.asarray(frequencies, dtype=float)
+    if settle is None:
+        settle = await lock_in_settle_time(client)
+    original = (await client.get("ActuationFrequency")).get("value") if restore else None
+    amplitude = np.full(len(frequencies), np.nan)
+    phase = np.full(len(frequencies), np.nan)
+    await reader.start()
+    try:
+        for index, frequency in enumerate(frequencies):
+            await client.set("ActuationFrequency", float(frequency))
+            await asyncio.sleep(settle)
+            amplitude[index], phase[index] = await reader.read()
+            if progress is not None:
+                progress(index, frequency, amplitude[index])
+    finally:
+        await reader.stop()
+        if original is not None:
+            await client.set("ActuationFrequency", original)
+    return SweepData(frequencies, amplitude, phase)
+
+
+async def server_sweep(client, start=None, stop=None, poll_interval=0.25, timeout=300.0):
+    """
+    Run the automatic frequency sweep of AFM Control (between start and stop in Hz, if given) and return
+    the Resonance of FoundResonanceProperties.
+    """
+    commands = []
+    if start is not None:
+        commands.append(("set", "ActuationFrequencySweepStart", {"property": "value", "value": float(start)}))
+    if stop is not None:
+        commands.append(("set", "ActuationFrequencySweepStop", {"property": "value", "value": float(stop)}))
+    if commands:
+        await client.pipeline(commands)
+    await client.trigger("ActionActuationFrequencySweepStart")
+    deadline = time.monotonic() + timeout
+    # The sweep may not have started yet when the trigger is acknowledged
+    await asyncio.sleep(poll_interval)
+    while (await client.get("FrequencySweepStatus")).get("value") == "Sweep":
+        if time.monotonic() > deadline:
+            await client.trigger("ActionActuationFrequencySweepStop")
+            raise asyncio.TimeoutError(f"The frequency sweep did not finish within {timeout} s")
+        await asyncio.sleep(poll_interval)
+    return Resonance.from_found_properties(await client.get("FoundResonanceProperties"))
+
+
+async def tune(client, start, stop, points=101, reader=None, settle=None, fine_span=8.0, apply=False,
+               progress=None):
+    """
+    Find the resonance with a coarse sweep from start to stop and a fine sweep over fine_span bandwidths
+    around it (fine_span=0 skips the fine sweep), then fit. With apply=True the actuation frequency, P, I and
+    the lock-in time constant are set to the proposals.
+
+    Returns (Resonance, [SweepData of every sweep]).
+    """
+    reader = reader or LineSignalReader(client)
+    if settle is None:
+        settle = await lock_in_settle_time(client)
+    sweeps = [await frequency_sweep(client, np.linspace(start, stop, points), reader, settle, progress=progress)]
+    resonance = fit_resonance(sweeps[0].frequency, sweeps[0].amplitude, sweeps[0].phase)
+    if fine_span:
+        half = 0.5 * fine_span * resonance.bandwidth
+        low, high = max(resonance.frequency - half, min(start, stop)), min(resonance.frequency + half, max(start, stop))
+        if high > low:
+            sweeps.append(await frequency_sweep(client, np.linspace(low, high, points), reader, settle,
+                                                progress=progress))
+            resonance = fit_resonance(sweeps[1].frequency, sweeps[1].amplitude, sweeps[1].phase)
+    if apply:
+        await client.pipeline([("set", obj, {"property": "value", "value": value})
+                               for obj, value in resonance.profile().items()])
+    return resonance, sweeps
+
+
+async def tune_fleet(fleet, start, stop, points=101, names=None, server=False, **kwargs):
+    """
+    Tune all (or the named) instruments of a Fleet concurrently, with tune() or, with server=True, with
+    server_sweep(). Returns {name: Resonance or exception}.
+    """
+    names = fleet.connected if names is None else list(names)
+
+    async def run(name):
+        client = fleet.clients[name]
+        if server:
+            return await server_sweep(client, start, stop)
+        resonance, _ = await tune(client, start, stop, points, **kwargs)
+        return resonance
+
+    results = await asyncio.gather(*(run(name) for name in names), return_exceptions=True)
+    return dict(zip(names, results))
+
+
+def save_sweeps(path, sweeps):
+    """Write sweeps as CSV with the columns sweep, frequency, amplitude, phase."""
+    with open(path, "w") as f:
+        f.write("sweep,frequency_hz,amplitude,phase_deg\n")
+        for index, sweep in enumerate(sweeps):
+            for row in zip(*sweep):
+                f.write(f"{index},{row[0]:.4f},{row[1]:.6g},{row[2]:.6g}\n")
+
+
+async def run(args):
+    async with AFMClient(args.uri, args.api_key) as client:
+        if args.server:
+            resonance = await server_sweep(client, args.start, args.stop)
+            sweeps = []
+            if args.apply:
+                await client.pipeline([("set", obj, {"property": "value", "value": value})
+                                       for obj, value in resonance.profile().items()])
+        else:
+            status = (await client.get("MeasurementStatus")).get("value")
+            started = status == "Idle" and args.start_measurement
+            if started:
+                # Lines only stream while a measurement runs; continuous scanning keeps them coming
+                mode = (await client.get("ScannerMode")).get("value")
+                await client.set("ScannerMode", 1, property="index")
+                await client.trigger("ActionMeasurementStart")
+            reader = LineSignalReader(client, args.amplitude_channel, args.phase_channel)
+            try:
+                resonance, sweeps = await tune(
+                    client, args.start, args.stop, args.points, reader, args.settle, args.fine_span, args.apply,
+                    progress=lambda index, frequency, amplitude: print(
+                        f"\r{frequency:12.2f} Hz  {amplitude:.4g}", end="", flush=True))
+                print()
+            finally:
+                if started:
+                    await client.trigger("ActionMeasurementStop")
+                    if isinstance(mode, dict):
+                        await client.set("ScannerMode", mode.get("index"), property="index")
+    print(json.dumps(resonance.as_dict(), indent=2))
+    if args.output and sweeps:
+        save_sweeps(args.output, sweeps)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--uri", default="ws://127.0.0.1:1234")
+    parser.add_argument("--api-key", default="AFM-Control-API-Key")
+    parser.add_argument("--start", type=float, required=True, help="start frequency in Hz")
+    parser.add_argument("--stop", type=float, required=True, help="stop frequency in Hz")
+    parser.add_argument("--points", type=int, default=101, help="points per sweep")
+    parser.add_argument("--settle", type=float, help="seconds to wait after a step (default: 5 lock-in time "
+                                                     "constants)")
+    parser.add_argument("--fine-span", type=float, default=8.0, help="bandwidths of the fine sweep, 0 for none")
+    parser.add_argument("--amplitude-channel", type=int, default=2)
+    parser.add_argument("--phase-channel", type=int, default=1)
+    parser.add_argument("--no-start", dest="start_measurement", action="store_false",
+                        help="do not start a measurement for the line stream")
+    parser.add_argument("--server", action="store_true", help="use the automatic sweep of the server")
+    parser.add_argument("--apply", action="store_true", help="apply the proposed frequency, P, I and lock-in time")
+    parser.add_argument("--output", help="write the sweeps as CSV to this file")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
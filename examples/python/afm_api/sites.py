@@ -0,0 +1,360 @@
+"""
+Title: Multi-site scan scheduler
+
+Description:
+Runs one scan at each of a list of sites, e.g. the wells of a plate, with per-site scan parameters:
+
+    {
+        "start": [0.0, 0.0],
+        "defaults": {"ScannerMode": 0, "ScannerRange": 5.0, "ScannerLinesPerSecond": 2.0},
+        "sites": [
+            {"name": "A1", "x": 0.0, "y": 0.0},
+            {"name": "A2", "x": 90.0, "y": 0.0, "set": {"ScannerRange": 2.0}},
+            ...
+        ]
+    }
+
+x and y are the ScannerCenterX and ScannerCenterY of the site; "set" is applied on top of "defaults", with
+plain values or complete payloads as in recipes. "start" is the position the route starts from (default:
+the current scan centre).
+
+- The sites are visited in the order that keeps the total travel of the scanner between them short: a
+  nearest-neighbour route from the start, improved with 2-opt moves (reversing a part of the route) until
+  no move shortens it. Every 2-opt pass evaluates all moves at once on the distance matrix. The distance
+  is Euclidean, or with metric="chebyshev" the longer of the x and y travel, for stages that move both
+  axes at the same time.
+- Each site costs one round trip before its scan: the navigation mode "point", the new centre, the
+  parameters that differ from the previous site and ActionMeasurementStart are sent as one pipelined
+  batch once the previous scan has ended. The server may acknowledge the start before MeasurementStatus
+  leaves "Idle", so the scheduler first waits for the scan to start (a status other than "Idle" or the
+  "Measurement started" log message), then for its end. Both are detected from the log stream (see
+  recipes.wait_for_start() and recipes.wait_for_value()), not only by polling MeasurementStatus.
+- Every site is timed: the setup batch, the scan and the travel to it. The result compares the travel of
+  the route with the travel in list order.
+
+Usage:
+    python -m afm_api.sites plate.json --uri ws://127.0.0.1:1234 --api-key KEY --output sites.json
+    python -m afm_api.sites plate.json --plan
+
+Run from the examples/python directory.
+"""
+
+import argparse
+import asyncio
+import json
+import time
+from collections import namedtuple
+
+import numpy as np
+
+from .client import AFMClient
+from .fleet import profile_commands
+from .frames import Command, trigger_command
+from .objects import check_command
+from .recipes import (DEFAULT_START_TIMEOUT, DEFAULT_WAIT_INTERVAL, DEFAULT_WAIT_TIMEOUT, scan_start_handler,
+                      wait_for_start, wait_for_value)
+
+METRICS = ("euclidean", "chebyshev")
+
+# Position in µm (ScannerCenterX, ScannerCenterY) and {object: value or payload} of one site
+Site = namedtuple("Site", ("name", "x", "y", "parameters"))
+
+
+class SiteListError(ValueError):
+    """Invalid site list. problems lists every problem found."""
+
+    def __init__(self, problems):
+        self.problems = list(problems)
+        super().__init__("Invalid site list:\n" + "\n".join(f"- {problem}" for problem in self.problems))
+
+
+def load_sites(path):
+    """Load and validate a site list (see the module docstring). Returns (sites, start or None)."""
+    with open(path) as f:
+        data = json.load(f)
+    if not isinstance(data, dict) or not isinstance(data.get("sites"), list):
+        raise SiteListError(["a site list must be an object with a list of 'sites'"])
+    defaults = data.get("defaults", {})
+    problems = []
+    sites = []
+    for index, entry in enumerate(data["sites"]):
+        name = entry.get("name", f"site {index + 1}") if isinstance(entry, dict) else f"site {index + 1}"
+        if not isinstance(entry, dict) or not all(isinstance(entry.get(key), (int, float)) for key in "xy"):
+            problems.append(f"{name}: a site needs numeric 'x' and 'y'")
+            continue
+        parameters = dict(defaults)
+        parameters.update(entry.get("set", {}))
+        for command, obj, payload in profile_commands(parameters):
+            problem = check_command(command, obj)
+            if problem:
+                problems.append(f"{name}: {problem}")
+        sites.append(Site(name, float(entry["x"]), float(entry["y"]), parameters))
+    start = data.get("start")
+    if start is not None and (not isinstance(start, list) or len(start) != 2):
+        problems.append("'start' must be [x, y]")
+    if problems:
+        raise SiteListError(problems)
+    return sites, None if start is None else (float(start[0]), float(start[1]))
+
+
+def distance_matrix(points, metric="euclidean"):
+    """Pairwise distances of an (n, 2) array of positions."""
+    difference = np.abs(points[:, None, :] - points[None, :, :])
+    if metric == "chebyshev":
+        return difference.max(axis=-1)
+    return np.hypot(difference[..., 0], difference[..., 1])
+
+
+def route_length(distances, path):
+    """Length of a path of node indexes through a distance matrix."""
+    path = np.asarray(path)
+    return float(distances[path[:-1], path[1:]].sum())
+
+
+def nearest_neighbour(distances, first=0):
+    """Path from node first that always continues to the closest node not visited yet."""
+    visited = np.zeros(len(distances), dtype=bool)
+    path = [first]
+    visited[first] = True
+    for _ in range(len(distances) - 1):
+        remaining = np.where(visited, np.inf, distances[path[-1]])
+        node = int(np.argmin(remaining))
+        path.append(node)
+        visited[node] = True
+    return path
+
+
+def two_opt(distances, path, max_passes=None):
+    """
+    Shorten an open path with fixed first node by reversing sub-paths. Each pass applies the reversal with
+    the largest gain, computed for all pairs of edges at once; the path ends at a free node of distance 0.
+    """
+    count = len(path)
+    if count < 3:
+        return list(path)
+    # A virtual end node, at distance 0 from every node, lets the last node of the path change as well
+    extended = np.zeros((count + 1, count + 1))
+    extended[:count, :count] = distances
+    route = np.array(list(path) + [count])
+    passes = 0
+    while max_passes is None or passes < max_passes:
+        passes += 1
+        before, first = route[:-2], route[1:-1]            # edges (route[i - 1], route[i]) for i = 1..count - 1
+        last, after = route[1:-1], route[2:]               # edges (route[j], route[j + 1]) for j = 1..count - 1
+        # Reversing route[i:j + 1] replaces the edges (a, b) and (c, d) with (a, c) and (b, d)
+        gain = (extended[before, first][:, None] + extended[last, after][None, :]
+                - extended[np.ix_(before, last)] - extended[np.ix_(first, after)])
+        gain[np.tril_indices(len(gain))] = 0.0
+        i, j = np.unravel_index(int(np.argmax(gain)), gain.shape)
+        if gain[i, j] <= 1e-9:
+            break
+        route[i + 1:j + 2] = route[i + 1:j + 2][::-1].copy()
+    return route[:-1].tolist()
+
+
+def plan_route(sites, start=(0.0, 0.0), metric="euclidean", optimize=True):
+    """
+    Order in which to visit the sites from start. Returns (order, travel, list_travel): site indexes and
+    the travel of that route and of the list order in µm.
+    """
+    points = np.array([start] + [(site.x, site.y) for site in sites], dtype=float)
+    distances = distance_matrix(points, metric)
+    in_list_order = list(range(len(points)))
+    path = two_opt(distances, nearest_neighbour(distances)) if optimize else in_list_order
+    return [node - 1 for node in path[1:]], route_length(distances, path), route_length(distances, in_list_order)
+
+
+def site_commands(site, previous=None, point_mode=True):
+    """
+    The batch that moves to a site and applies its parameters; parameters with the same payload as in
+    previous ({object: payload} last sent) are left out.
+    """
+    commands = [trigger_command("ScannerNavigationModePoint")] if point_mode else []
+    commands += [Command("set", "ScannerCenterX", {"property": "value", "value": site.x}),
+                 Command("set", "ScannerCenterY", {"property": "value", "value": site.y})]
+    for command, obj, payload in profile_commands(site.parameters):
+        if previous is None or previous.get(obj) != payload:
+            commands.append(Command(command, obj, payload))
+    return commands
+
+
+class SiteResult:
+    """Timing and outcome of one site. Times are in seconds, started from the start of the schedule."""
+
+    __slots__ = ("site", "order", "travel", "commands", "started", "setup", "scan", "polls", "error")
+
+    def __init__(self, site, order, travel, started):
+        self.site = site
+        self.order = order
+        self.travel = travel
+        self.commands = 0
+        self.started = started
+        self.setup = None
+        self.scan = None
+        self.polls = 0
+        self.error = None
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    @property
+    def duration(self):
+        return (self.setup or 0.0) + (self.scan or 0.0)
+
+    def as_dict(self):
+        return {
+            "name": self.site.name,
+            "order": self.order,
+            "x": self.site.x,
+            "y": self.site.y,
+            "travel_um": round(self.travel, 6),
+            "commands": self.commands,
+            "started_s": round(self.started, 6),
+            "setup_s": None if self.setup is None else round(self.setup, 6),
+            "scan_s": None if self.scan is None else round(self.scan, 6),
+            "polls": self.polls,
+            "error": None if self.error is None else str(self.error),
+        }
+
+
+class ScheduleResult:
+    def __init__(self, sites, travel, list_travel):
+        self.sites = sites
+        self.results = []
+        self.travel = travel
+        self.list_travel = list_travel
+        self.duration = None
+
+    @property
+    def ok(self):
+        return len(self.results) == len(self.sites) and all(result.ok for result in self.results)
+
+    def as_dict(self):
+        return {
+            "ok": self.ok,
+            "duration_s": None if self.duration is None else round(self.duration, 6),
+            "travel_um": round(self.travel, 6),
+            "list_order_travel_um": round(self.list_travel, 6),
+            "sites": [result.as_dict() for result in self.results],
+        }
+
+
+async def run_sites(client, sites, start=None, metric="euclidean", optimize=True, point_mode=True,
+                    timeout=DEFAULT_WAIT_TIMEOUT, interval=DEFAULT_WAIT_INTERVAL,
+                    start_timeout=DEFAULT_START_TIMEOUT, stop_on_error=False, after_scan=None):
+    """
+    Scan every site once, in the planned order (see the module docstring). start defaults to the current
+    scan centre. A scan that has not left "Idle" start_timeout seconds after its start was acknowledged
+    fails the site. after_scan(result), if given, is awaited after every scan, e.g. to save the data.
+    Returns a ScheduleResult.
+    """
+    if start is None:
+        x, y = await client.pipeline([("get", "ScannerCenterX", {"property": "value"}),
+                                      ("get", "ScannerCenterY", {"property": "value"})])
+        start = (float(x.get("value")), float(y.get("value")))
+    order, travel, list_travel = plan_route(sites, start, metric, optimize)
+    schedule = ScheduleResult(sites, travel, list_travel)
+    # Log messages tell wait_for_start() and wait_for_value() when a scan may have started or finished
+    measurement_started = asyncio.Event()
+    on_frame = scan_start_handler(measurement_started)
+    client.add_frame_handler(on_frame)
+    # A log subscription made by the caller is left in place
+    subscribed_log = ("log", None) not in client.subscriptions
+    if subscribed_log:
+        await client.subscribe_log()
+    began = time.perf_counter()
+    previous = {}
+    position = start
+    try:
+        for number, index in enumerate(order):
+            site = sites[index]
+            distance = distance_matrix(np.array([position, (site.x, site.y)]), metric)[0, 1]
+            result = SiteResult(site, number, float(distance), time.perf_counter() - began)
+            schedule.results.append(result)
+            commands = site_commands(site, previous, point_mode)
+            commands.append(trigger_command("ActionMeasurementStart"))
+            result.commands = len(commands)
+            try:
+                measurement_started.clear()
+                started = time.perf_counter()
+                await client.pipeline(commands)
+                result.setup = time.perf_counter() - started
+                previous.update((obj, payload) for command, obj, payload in commands if obj in site.parameters)
+                position = (site.x, site.y)
+                started = time.perf_counter()
+
+                def on_poll(reply):
+                    result.polls += 1
+
+                await wait_for_start(client, measurement_started, start_timeout, on_poll=on_poll)
+                await wait_for_value(client, "MeasurementStatus", "Idle", timeout, interval, on_poll)
+                result.scan = time.perf_counter() - started
+                if after_scan is not None:
+                    await after_scan(result)
+            except Exception as e:
+                result.error = e
+                # The parameters of a failed batch are unknown; send all of them to the next site
+                previous.clear()
+                if stop_on_error:
+                    break
+    finally:
+        schedule.duration = time.perf_counter() - began
+        client.remove_frame_handler(on_frame)
+        if subscribed_log:
+            try:
+                await client.subscribe_log(False)
+            except Exception:
+                pass
+    return schedule
+
+
+async def run(args, sites, start):
+    async with AFMClient(args.uri, args.api_key, args.timeout) as client:
+        schedule = await run_sites(client, sites, start, args.metric, not args.list_order,
+                                   point_mode=not args.no_point_mode, stop_on_error=args.stop_on_error)
+    for result in schedule.results:
+        status = "ok" if result.ok else f"FAILED: {result.error}"
+        print(f"{result.order:4d}  {result.site.name:12s} ({result.site.x:9.2f}, {result.site.y:9.2f})  "
+              f"travel {result.travel:9.2f} µm  setup {(result.setup or 0.0) * 1e3:8.1f} ms  "
+              f"scan {result.scan or 0.0:8.2f} s  {status}")
+    print(f"{len(schedule.results)} sites in {schedule.duration:.2f} s, travel {schedule.travel:.1f} µm "
+          f"({schedule.list_travel:.1f} µm in list order)")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(schedule.as_dict(), f, indent=2)
+    return schedule
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("sites", help="site list (.json)")
+    parser.add_argument("--uri", default="ws://127.0.0.1:1234")
+    parser.add_argument("--api-key", default="AFM-Control-API-Key")
+    parser.add_argument("--timeout", type=float, default=5.0, help="reply timeout in seconds")
+    parser.add_argument("--metric", choices=METRICS, default="euclidean", help="distance between two sites")
+    parser.add_argument("--list-order", action="store_true", help="visit the sites in list order")
+    parser.add_argument("--no-point-mode", action="store_true",
+                        help="do not switch to the navigation mode point before moving")
+    parser.add_argument("--stop-on-error", action="store_true", help="stop at the first failed site")
+    parser.add_argument("--plan", action="store_true", help="only print the planned route")
+    parser.add_argument("--output", help="write the results and timings as JSON to this file")
+    args = parser.parse_args()
+    try:
+        sites, start = load_sites(args.sites)
+    except SiteListError as e:
+        parser.exit(1, f"{e}\n")
+    if args.plan:
+        started = time.perf_counter()
+        order, travel, list_travel = plan_route(sites, start or (0.0, 0.0), args.metric, not args.list_order)
+        print(" -> ".join(sites[index].name for index in order))
+        print(f"{len(sites)} sites, travel {travel:.1f} µm ({list_travel:.1f} µm in list order), "
+              f"planned in {(time.perf_counter() - started) * 1e3:.1f} ms")
+        return
+    schedule = asyncio.run(run(args, sites, start))
+    if not schedule.ok:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+"""
+Bounded stream buffers for subscription data
+
+Every consumer of streamed frames (plotter, recorder, analysis) gets its own StreamBuffer from
+AFMClient.stream(). A buffer holds at most maxlen frames and applies one of three policies when the
+consumer falls behind:
+
+- DROP_OLDEST: the oldest queued frame is discarded to make room; the consumer sees the most recent
+  maxlen frames.
+- COALESCE:    only the latest frame is kept; a new frame replaces the one not yet consumed. Meant for
+  display consumers that only ever draw the newest line.
+- BLOCK:       the client's reader task waits until the consumer has made room. Meant for recording
+  consumers that must not lose a line; the server is throttled by TCP flow control instead.
+
+Counters for received, delivered, dropped and coalesced frames make it visible when a consumer cannot
+keep up. Buffers are asyncio objects and must be used from the event loop thread of the client.
+"""
+
+import asyncio
+import time
+from collections import deque
+
+DROP_OLDEST = "drop_oldest"
+COALESCE = "coalesce"
+BLOCK = "block"
+
+POLICIES = (DROP_OLDEST, COALESCE, BLOCK)
+
+
+def stream_key(data):
+    """Return the (type, channel) key of a streamed frame, e.g. ("line", 0) or ("log", None)."""
+    if data.get("object") == "LogEvent":
+        return "log", None
+    payload = data.get("payload") or {}
+    return payload.get("type"), payload.get("channel")
+
+
+class StreamStats:
+    __slots__ = ("received", "delivered", "dropped", "coalesced", "blocked", "blocked_time", "high_watermark")
+
+    def __init__(self):
+        self.received = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.blocked = 0
+        self.blocked_time = 0.0
+        self.high_watermark = 0
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __repr__(self):
+        return "StreamStats(" + ", ".join(f"{name}={getattr(self, name)}" for name in self.__slots__) + ")"
+
+
+class StreamBuffer:
+    """Bounded FIFO of streamed frames with a selectable overflow policy."""
+
+    def __init__(self, data_type="line", channel=None, maxlen=64, policy=DROP_OLDEST):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown stream policy {policy!r}, expected one of {POLICIES}")
+        if maxlen < 1:
+            raise ValueError("maxlen must be at least 1")
+        self.data_type = data_type
+        self.channel = channel
+        self.policy = policy
+        self.maxlen = 1 if policy == COALESCE else maxlen
+        self.stats = StreamStats()
+        self.closed = False
+
+        self._items = deque()
+        self._not_empty = asyncio.Event()
+        self._not_full = asyncio.Event()
+        self._not_full.set()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __repr__(self):
+        return (f"StreamBuffer(data_type={self.data_type!r}, channel={self.channel!r}, policy={self.policy!r}, "
+                f"queued={len(self._items)}/{self.maxlen})")
+
+    def matches(self, key):
+        data_type, channel = key
+        return data_type == self.data_type and (self.channel is None or channel == self.channel)
+
+    # Producer side
+
+    def put_nowait(self, item):
+        """Queue an item without waiting. Returns False only for a full BLOCK buffer."""
+        if self.closed:
+            return True
+        if len(self._items) >= self.maxlen:
+            if self.policy == BLOCK:
+                return False
+            self._items.popleft()
+            if self.policy == COALESCE:
+                self.stats.coalesced += 1
+            else:
+                self.stats.dropped += 1
+        self._append(item)
+        return True
+
+    async def put(self, item):
+        """Queue an item, waiting for free space if the policy is BLOCK."""
+        if self.put_nowait(item):
+            return
+        self.stats.blocked += 1
+        started = time.monotonic()
+        while len(self._items) >= self.maxlen and not self.closed:
+            self._not_full.clear()
+            await self._not_full.wait()
+        self.stats.blocked_time += time.monotonic() - started
+        if not self.closed:
+            self._append(item)
+
+    def _append(self, item):
+        self._items.append(item)
+        self.stats.received += 1
+        self.stats.high_watermark = max(self.stats.high_watermark, len(self._items))
+        self._not_empty.set()
+        if len(self._items) >= self.maxlen:
+            self._not_full.clear()
+
+    # Consumer side
+
+    def get_nowait(self):
+        """Return the oldest queued item. Raises asyncio.QueueEmpty if there is none."""
+        if not self._items:
+            raise asyncio.QueueEmpty
+        item = self._items.popleft()
+        self.stats.delivered += 1
+        if not self._items:
+            self._not_empty.clear()
+        self._not_full.set()
+        return item
+
+    def drain(self):
+        """Return all queued items at once, oldest first."""
+        items = list(self._items)
+        self._items.clear()
+        self.stats.delivered += len(items)
+        self._not_empty.clear()
+        self._not_full.set()
+        return items
+
+    async def get(self):
+        """Wait for the next item. Raises StopAsyncIteration once the buffer is closed and empty."""
+        while not self._items:
+            if self.closed:
+                raise StopAsyncIteration
+            await self._not_empty.wait()
+        return self.get_nowait()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self.get()
+
+    def close(self):
+        """Stop accepting items and wake up waiting producers and consumers."""
+        self.closed = True
+        self._not_empty.set()
+        self._not_full.set()
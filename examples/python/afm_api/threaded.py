@@ -0,0 +1,264 @@
+"""
+Network thread for GUI clients
+
+Tkinter (like most GUI toolkits) has its own main loop, and driving asyncio from it with periodic
+loop.run_until_complete(asyncio.sleep(0.1)) calls only services the socket for a fraction of the wall
+time, while every GUI handler blocks network reads. ClientThread runs the AFMClient on its own event loop
+in a background thread instead. The GUI never drives the loop; it only exchanges data through thread-safe
+objects:
+
+- ClientThread.run(coroutine, callback) schedules a coroutine on the network loop. The callback is
+  delivered back to the GUI thread as an event when the coroutine has finished.
+- ClientThread.stream() returns a ThreadSafeStream that is filled (and optionally decoded) on the network
+  thread and drained by the GUI thread, with the drop-oldest or coalesce-to-latest policy.
+- Log messages, unsolicited frames, finished calls, disconnects and reconnects are queued as events; the
+  GUI fetches them with poll_events() from its own timer. With log_to(sink), log messages go to an
+  afm_api.logstore.LogSink instead, and the GUI shows the sink's bounded tail.
+
+Every streamed item is stamped with its receive time, so the GUI can measure the latency from socket to
+display (ThreadSafeStream.last_latency). A frame that cannot be decoded is logged, counted in
+ThreadSafeStream.rejected and skipped, without affecting the connection.
+"""
+
+import asyncio
+import logging
+import queue
+import threading
+import time
+from collections import deque
+
+from .client import AFMClient
+from .decoding import DECODERS
+from .streams import BLOCK, COALESCE, POLICIES, StreamStats, stream_key
+
+# Event kinds delivered by ClientThread.poll_events()
+EVENT_FRAME = "frame"
+EVENT_RESULT = "result"
+EVENT_DISCONNECTED = "disconnected"
+EVENT_RECONNECTED = "reconnected"
+EVENT_MISSED_ROWS = "missed_rows"
+
+logger = logging.getLogger(__name__)
+
+
+class ThreadSafeStream:
+    """
+    Bounded stream filled on the network thread and consumed from another thread.
+
+    Supports the DROP_OLDEST and COALESCE policies. BLOCK would stall the network thread on a GUI
+    consumer; recording consumers that must not lose data should use AFMClient.stream() on the network
+    loop instead.
+    """
+
+    def __init__(self, data_type="line", channel=None, maxlen=64, policy=COALESCE, decode=True):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown stream policy {policy!r}, expected one of {POLICIES}")
+        if policy == BLOCK:
+            raise ValueError("BLOCK streams must be consumed on the network loop, use AFMClient.stream()")
+        self.data_type = data_type
+        self.channel = channel
+        self.policy = policy
+        self.maxlen = 1 if policy == COALESCE else maxlen
+        self.decoder = DECODERS.get(data_type) if decode else None
+        self.stats = StreamStats()
+        # Frames that could not be decoded
+        self.rejected = 0
+        self.closed = False
+        self.last_latency = None
+
+        self._items = deque()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def matches(self, key):
+        data_type, channel = key
+        return data_type == self.data_type and (self.channel is None or channel == self.channel)
+
+    def put_nowait(self, frame):
+        """Called on the network thread. Decodes the frame and queues it with its receive time."""
+        if self.closed:
+            return True
+        received = time.monotonic()
+        try:
+            item = self.decoder(frame.get("payload") or {}) if self.decoder else frame
+        except Exception as e:
+            # A malformed frame is skipped; it must not end the connection
+            self.rejected += 1
+            logger.warning("Failed to decode %s frame: %s", self.data_type, e)
+            return True
+        with self._lock:
+            if len(self._items) >= self.maxlen:
+                self._items.popleft()
+                if self.policy == COALESCE:
+                    self.stats.coalesced += 1
+                else:
+                    self.stats.dropped += 1
+            self._items.append((received, item))
+            self.stats.received += 1
+            self.stats.high_watermark = max(self.stats.high_watermark, len(self._items))
+        return True
+
+    async def put(self, frame):
+        self.put_nowait(frame)
+
+    def get_nowait(self):
+        """Return the oldest queued item. Raises queue.Empty if there is none."""
+        with self._lock:
+            if not self._items:
+                raise queue.Empty
+            received, item = self._items.popleft()
+            self.stats.delivered += 1
+        self.last_latency = time.monotonic() - received
+        return item
+
+    def drain(self):
+        """Return all queued items at once, oldest first."""
+        with self._lock:
+            items = list(self._items)
+            self._items.clear()
+            self.stats.delivered += len(items)
+        if items:
+            self.last_latency = time.monotonic() - items[-1][0]
+        return [item for _, item in items]
+
+    def close(self):
+        self.closed = True
+
+
+class ClientThread:
+    """Run an AFMClient on a dedicated event loop thread and hand its data to the GUI thread."""
+
+    def __init__(self, uri, api_key, timeout=5.0, max_events=10000, reconnect=False):
+        self.client = AFMClient(uri, api_key, timeout, reconnect=reconnect)
+        self.loop = None
+        self.events_dropped = 0
+
+        # Frames are bounded, results and disconnects are rare and must never be lost
+        self._events = queue.Queue(max_events)
+        self._control_events = queue.SimpleQueue()
+        self._thread = None
+        self._started = threading.Event()
+        self._log_sink = None
+
+        self.client.add_frame_handler(self._on_frame)
+        self.client.add_disconnect_handler(self._on_disconnect)
+        self.client.add_reconnect_handler(self._on_reconnect)
+        self.client.add_missed_rows_handler(self._on_missed_rows)
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        """Start the network thread and its event loop."""
+        if self.running:
+            return
+        self._started.clear()
+        self._thread = threading.Thread(target=self._run_loop, name="afm-network", daemon=True)
+        self._thread.start()
+        self._started.wait()
+
+    def _run_loop(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.loop.call_soon(self._started.set)
+        try:
+            self.loop.run_forever()
+        finally:
+            self.loop.run_until_complete(self.loop.shutdown_asyncgens())
+            self.loop.close()
+
+    def stop(self, timeout=5.0):
+        """Close the connection and stop the network thread."""
+        if not self.running:
+            return
+        try:
+            asyncio.run_coroutine_threadsafe(self.client.close(), self.loop).result(timeout)
+        except Exception:
+            pass
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(timeout)
+        self._thread = None
+
+    # Calls from the GUI thread
+
+    def run(self, coroutine, callback=None):
+        """
+        Schedule a coroutine on the network loop and return a concurrent.futures.Future.
+
+        If a callback is given, callback(future) is called from poll_events() in the consumer thread once
+        the coroutine has finished.
+        """
+        future = asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+        if callback is not None:
+            future.add_done_callback(lambda f: self._control_events.put((EVENT_RESULT, (callback, f))))
+        return future
+
+    def connect(self, callback=None):
+        return self.run(self.client.connect(), callback)
+
+    def stream(self, data_type="line", channel=None, maxlen=64, policy=COALESCE, decode=True):
+        """Return a ThreadSafeStream of decoded frames for consumption in the GUI thread."""
+        stream = ThreadSafeStream(data_type, channel, maxlen, policy, decode)
+        self.loop.call_soon_threadsafe(self.client.add_stream, stream)
+        return stream
+
+    def log_to(self, sink):
+        """Record LogEvent frames with a LogSink instead of queueing them as events."""
+        self._log_sink = sink
+        self.loop.call_soon_threadsafe(sink.attach, self.client)
+        return sink
+
+    def poll_events(self, max_events=None):
+        """
+        Return the queued events as (kind, value) tuples without blocking.
+
+        Kinds are EVENT_FRAME (value: frame dict), EVENT_DISCONNECTED (value: exception or None),
+        EVENT_RECONNECTED (value: (attempts, downtime)), EVENT_MISSED_ROWS (value: (channel, rows)) and
+        EVENT_RESULT, which is handled here by calling the callback given to run().
+        """
+        events = []
+        while True:
+            try:
+                kind, value = self._control_events.get_nowait()
+            except queue.Empty:
+                break
+            if kind == EVENT_RESULT:
+                callback, future = value
+                callback(future)
+            else:
+                events.append((kind, value))
+        while max_events is None or len(events) < max_events:
+            try:
+                events.append(self._events.get_nowait())
+            except queue.Empty:
+                break
+        return events
+
+    # Network thread side
+
+    def _post(self, kind, value):
+        try:
+            self._events.put_nowait((kind, value))
+        except queue.Full:
+            self.events_dropped += 1
+
+    def _on_frame(self, data):
+        # Line and map data are delivered through streams, log messages to the log sink if there is one;
+        # everything else becomes an event
+        data_type = stream_key(data)[0]
+        if data_type in DECODERS or (data_type == "log" and self._log_sink is not None):
+            return
+        self._post(EVENT_FRAME, data)
+
+    def _on_disconnect(self, error):
+        self._control_events.put((EVENT_DISCONNECTED, error))
+
+    def _on_reconnect(self, attempts, downtime):
+        self._control_events.put((EVENT_RECONNECTED, (attempts, downtime)))
+
+    def _on_missed_rows(self, channel, rows):
+        self._control_events.put((EVENT_MISSED_ROWS, (channel, rows)))
+
@@ -0,0 +1,76 @@
+"""
+Title: Capture an AFM Control API session by nano analytik GmbH
+
+Compatible with API v1.1 and above
+
+Description:
+Headless example that records the complete WebSocket traffic of a scan to a capture file with
+AFMClient.start_capture(). It subscribes to the line data of the given channels (and to the log), can start
+the measurement, and records until the measurement has finished or the duration has passed. The capture
+can be played back with afm_api.replay_server and benchmarked with benchmarks/bench_replay.py.
+
+Usage:
+    python api_capture.py scan.afmcap --uri ws://192.168.0.11:1234 --api-key KEY --start
+    python api_capture.py scan.afmcap --channels 0 1 --format float --duration 60 --zstd
+
+Run from the examples/python directory.
+
+Author:
+- nano analytik GmbH
+
+License:
+- MIT License
+"""
+
+import argparse
+import asyncio
+import json
+import time
+
+from afm_api.capture import SessionReader
+from afm_api.client import AFMClient
+
+
+async def run(args):
+    client = AFMClient(args.uri, args.api_key)
+    capture = client.start_capture(args.capture, compress=args.zstd)
+    finished = asyncio.Event()
+
+    def on_frame(data):
+        if data.get("object") == "LogEvent" and "finished" in json.dumps(data.get("payload")).lower():
+            finished.set()
+
+    async with client:
+        client.add_frame_handler(on_frame)
+        await client.subscribe_log()
+        for channel in args.channels:
+            await client.subscribe_measurement_data(channel, "line", args.format)
+        if args.start:
+            await client.trigger("ActionMeasurementStart")
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(finished.wait(), args.duration)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            elapsed = time.monotonic() - started
+            print(f"Captured {capture.records} frames ({capture.bytes / 1e6:.1f} MB) in {elapsed:.1f} s")
+    summary = SessionReader(args.capture).summary()
+    print(json.dumps(summary, indent=2))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("capture", help="capture file to write")
+    parser.add_argument("--uri", default="ws://127.0.0.1:1234")
+    parser.add_argument("--api-key", default="AFM-Control-API-Key")
+    parser.add_argument("--channels", type=int, nargs="+", default=[0])
+    parser.add_argument("--format", default="base64", choices=["float", "txt", "base64"])
+    parser.add_argument("--duration", type=float, default=600.0, help="longest capture in seconds")
+    parser.add_argument("--start", action="store_true", help="start the measurement after subscribing")
+    parser.add_argument("--zstd", action="store_true", help="compress the capture (requires zstandard)")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
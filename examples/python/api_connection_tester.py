@@ -11,12 +11,15 @@ Users can input the server IP, port, and API key to connect to a WebSocket serve
 attempts to connect and authenticate with the provided API key, displaying the connection and authentication
 status. It supports connecting and disconnecting from the server.
 
+Once connected, the 'Monitor' button starts a health monitor (afm_api.health) that measures the round-trip
+time of APIEcho requests and shows the current and p99 RTT, timeouts and reconnects.
+
 Dependencies:
-- Python 3.6 or higher
-- asyncio
+- Python 3.9 or higher
+- asyncio (runs on a separate network thread, see afm_api.threaded)
 - websockets
 - tkinter
-- json
+- afm_api (client library in this directory)
 
 Usage:
 1. Ensure that the 'websockets' library is installed:
@@ -26,6 +29,7 @@ Usage:
 - Enter the API Key, Server IP, and Server Port.
 - Click 'Connect' to establish a connection and authenticate.
 - Click 'Disconnect' to close the connection.
+- Click 'Monitor' to start or stop the latency probes.
 
 Author:
 - nano analytik GmbH
@@ -37,29 +41,34 @@ License:
 
 
 
-import asyncio
-import json
 import tkinter as tk
-import websockets
+
+from afm_api import AFMAuthenticationError
+from afm_api.health import HealthMonitor
+from afm_api.threaded import ClientThread, EVENT_DISCONNECTED
+
+# APIEcho probes per second and display refresh interval (ms) of the monitor mode
+MONITOR_RATE = 10
+MONITOR_REFRESH = 500
 
 
 class ClientWindow:
-    def __init__(self, root, loop):
+    def __init__(self, root):
         self.root = root
-        self.loop = loop
         self.root.title('WebSocket Connection Tester')
 
         # Allow window resizing
-        self.root.geometry('450x200')  # Starting size
-        self.root.minsize(450, 200)  # Minimum size
+        self.root.geometry('450x230')  # Starting size
+        self.root.minsize(450, 230)  # Minimum size
         self.root.resizable(False, False)
 
-        # Connection and authentication status
-        self.websocket = None
+        # Connection and authentication status; the network thread owns the WebSocket connection
+        self.network = None
         self.connected = False
         self.authenticated = False
         self.api_key = None
         self.websocket_uri = None
+        self.monitor = None
 
         # Configure grid layout for the root window
         self.root.columnconfigure(0, weight=1)
@@ -104,6 +113,10 @@ class ClientWindow:
                                            state='disabled')
         self.disconnect_button.grid(row=0, column=1, padx=5, pady=5, sticky='w')
 
+        self.monitor_button = tk.Button(button_frame, text="Monitor", command=self.toggle_monitor, width=15,
+                                        state='disabled')
+        self.monitor_button.grid(row=0, column=2, padx=5, pady=5, sticky='w')
+
         # Status Label to inform the user about connection and authentication status
         status_frame = tk.Frame(main_frame)
         status_frame.grid(row=4, column=0, columnspan=2, pady=5, sticky='w')
@@ -111,8 +124,12 @@ class ClientWindow:
         self.status_label = tk.Label(status_frame, text="Status: Disconnected", fg="red")
         self.status_label.pack(side=tk.LEFT)
 
-        # Start the update loop for tkinter
-        self.root.after(100, self.update_event_loop)
+        # Health monitor results
+        self.monitor_label = tk.Label(main_frame, text="", anchor='w')
+        self.monitor_label.grid(row=5, column=0, columnspan=2, sticky='w')
+
+        # Start the polling of network events for tkinter
+        self.root.after(100, self.poll_network_events)
 
     def start_connection(self):
         if not self.connected or not self.authenticated:
@@ -131,83 +148,122 @@ class ClientWindow:
 
             self.websocket_uri = f"ws://{server_ip}:{server_port}"
             self.update_status(f"Connecting to {self.websocket_uri}...", "orange")
-            asyncio.ensure_future(self.connect_and_authenticate(), loop=self.loop)
-
-    async def connect_and_authenticate(self):
-        try:
-            self.websocket = await websockets.connect(self.websocket_uri)
-            self.connected = True
             self.authenticated = False  # Initially not authenticated
-            self.update_status("Connected. Authenticating...", "orange")
 
             # Update button states: Connect disabled until authentication
             self.connect_button.config(state='disabled')
             # Disconnect button remains disabled until authenticated
 
-            # Authenticate with the API key
-            auth_request = {
-                "command": "authenticate",
-                "apikey": self.api_key
-            }
-            await self.websocket.send(json.dumps(auth_request))
-
-            response = await self.websocket.recv()
-            response_data = json.loads(response)
-
-            if response_data.get("command") == "error":
-                error_message = response_data.get("payload", {}).get("details", "Unknown error.")
-                self.authenticated = False
-                self.update_status(f"Connected. Authentication Failed: {error_message}", "red")
-                # Optionally, keep the connection open for re-authentication
-                self.connect_button.config(state='normal')  # Allow re-attempt
-            else:
-                self.authenticated = True
-                self.update_status("Authenticated successfully.", "green")
-                # Enable Disconnect button now that authenticated
-                self.disconnect_button.config(state='normal')
+            # Connect and authenticate with the API key on the network thread
+            self.network = ClientThread(self.websocket_uri, self.api_key)
+            self.network.start()
+            self.network.connect(self.on_authenticated)
 
+    def on_authenticated(self, future):
+        try:
+            future.result()
+        except AFMAuthenticationError as e:
+            self.network.stop()
+            self.authenticated = False
+            self.update_status(f"Authentication Failed: {e.details or e.title}", "red")
+            self.connect_button.config(state='normal')  # Allow re-attempt
+            return
         except Exception as e:
+            self.network.stop()
             self.update_status(f"Connection Error: {e}", "red")
-            self.connected = False
-            self.authenticated = False
-            self.connect_button.config(state='normal')
-            self.disconnect_button.config(state='disabled')
+            self.reset_connection_state()
+            return
+
+        self.connected = True
+        self.authenticated = True
+        self.update_status("Authenticated successfully.", "green")
+        # Enable Disconnect and Monitor buttons now that authenticated
+        self.disconnect_button.config(state='normal')
+        self.monitor_button.config(state='normal')
+
+    def on_connection_lost(self, error):
+        self.update_status(f"Connection lost: {error or 'closed by the server'}", "red")
+        self.reset_connection_state()
+
+    def reset_connection_state(self):
+        self.connected = False
+        self.authenticated = False
+        self.stop_monitor()
+        self.connect_button.config(state='normal')
+        self.disconnect_button.config(state='disabled')
+        self.monitor_button.config(state='disabled', text="Monitor")
+
+    def toggle_monitor(self):
+        if self.monitor is None:
+            # Probes run on the network thread next to any other traffic of the connection
+            self.monitor = HealthMonitor(self.network.client, MONITOR_RATE)
+            self.network.loop.call_soon_threadsafe(self.monitor.start)
+            self.monitor_button.config(text="Stop Monitor")
+            self.root.after(MONITOR_REFRESH, self.update_monitor)
+        else:
+            self.stop_monitor()
+
+    def stop_monitor(self):
+        if self.monitor is not None and self.network is not None and self.network.running:
+            self.network.loop.call_soon_threadsafe(self.monitor.stop)
+        self.monitor = None
+        self.monitor_button.config(text="Monitor")
+
+    def update_monitor(self):
+        if self.monitor is None:
+            return
+        report = self.monitor.snapshot()
+        self.monitor_label.config(
+            text=f"RTT: {report['rtt_current_ms']} ms, p99: {report['rtt_ms']['p99']} ms, "
+                 f"timeouts: {report['timeouts']}, reconnects: {report['reconnects']}")
+        self.root.after(MONITOR_REFRESH, self.update_monitor)
 
     def disconnect(self):
-        if self.connected and self.authenticated and self.websocket:
-            asyncio.ensure_future(self.close_connection(), loop=self.loop)
+        if self.connected and self.authenticated and self.network:
+            self.stop_monitor()
+            self.network.run(self.network.client.close(), self.on_disconnected)
         else:
             self.update_status("Cannot disconnect: Not connected or not authenticated.", "red")
 
-    async def close_connection(self):
-        try:
-            await self.websocket.close()
+    def on_disconnected(self, future):
+        error = future.exception()
+        if error is not None:
+            self.update_status(f"Disconnect Error: {error}", "red")
+        else:
             self.update_status("Disconnected from the server.", "red")
-        except Exception as e:
-            self.update_status(f"Disconnect Error: {e}", "red")
-        finally:
-            self.connected = False
-            self.authenticated = False
-            self.connect_button.config(state='normal')
-            self.disconnect_button.config(state='disabled')
+        self.network.stop()
+        self.reset_connection_state()
 
     def update_status(self, message, color):
         self.status_label.config(text=f"Status: {message}", fg=color)
 
-    def update_event_loop(self):
+    def poll_network_events(self):
         try:
-            self.loop.run_until_complete(asyncio.sleep(0.1))
+            if self.network is not None:
+                # Finished calls are handled inside poll_events; only disconnects are of interest here
+                for kind, value in self.network.poll_events():
+                    if kind == EVENT_DISCONNECTED:
+                        self.stop_monitor()
+                        self.network.stop()
+                        self.on_connection_lost(value)
         except Exception as e:
-            self.update_status(f"Event Loop Error: {e}", "red")
+            self.update_status(f"Network Event Error: {e}", "red")
         finally:
-            self.root.after(50, self.update_event_loop)
+            self.root.after(50, self.poll_network_events)
+
+    def on_close(self):
+        if self.network is not None:
+            self.stop_monitor()
+            self.network.stop()
+        self.root.destroy()
 
 
 def main():
     root = tk.Tk()
-    loop = asyncio.get_event_loop()
 
-    window = ClientWindow(root, loop)
+    # The GUI only runs the Tk main loop; networking runs on the client's own thread
+    window = ClientWindow(root)
+    root.protocol("WM_DELETE_WINDOW", window.on_close)
 
     root.mainloop()
 
@@ -0,0 +1,94 @@
+"""
+Title: Fleet control of several AFM Control servers by nano analytik GmbH
+
+Compatible with API v1.1 and above
+
+Description:
+Headless example that drives several instruments from one process with afm_api.fleet.Fleet. It connects
+to all instruments at once, applies the same scan and feedback profile to every tool, subscribes to the
+line data of one channel, starts the measurements and prints the lines of all instruments as they arrive
+from one merged stream.
+
+Usage:
+    python api_fleet.py --api-key KEY afm1=ws://192.168.0.11:1234 afm2=ws://192.168.0.12:1234
+    python api_fleet.py --api-key KEY --duration 30 --no-start afm1=ws://127.0.0.1:1234
+
+Run from the examples/python directory.
+
+Author:
+- nano analytik GmbH
+
+License:
+- MIT License
+"""
+
+import argparse
+import asyncio
+import time
+
+from afm_api.fleet import Fleet
+
+# Applied to every instrument before the measurement
+PROFILE = {
+    "ScannerRange": 10.0,
+    "ScannerLinesPerSecond": 1.0,
+    "AFMPIDConstantP": 10,
+    "AFMPIDConstantI": 290,
+}
+
+CHANNEL = 0
+
+
+async def run(args):
+    instruments = {}
+    for spec in args.instruments:
+        name, _, uri = spec.partition("=")
+        instruments[name] = (uri, args.api_key)
+
+    async with Fleet(instruments, max_in_flight=args.max_in_flight) as fleet:
+        for name, error in fleet.errors.items():
+            print(f"{name}: connection failed: {error}")
+        names = fleet.connected
+        if not names:
+            return
+
+        results = await fleet.apply_profile(PROFILE, names)
+        for name, errors in Fleet.failures(results).items():
+            print(f"{name}: profile not fully applied: {', '.join(map(str, errors))}")
+        await fleet.subscribe_measurement_data(CHANNEL, "line", "base64", names)
+
+        async with fleet.stream("line", CHANNEL) as lines:
+            if args.start:
+                await fleet.trigger("ActionMeasurementStart", names)
+            started = time.monotonic()
+            counts = dict.fromkeys(names, 0)
+            try:
+                while time.monotonic() - started < args.duration:
+                    try:
+                        instrument, line = await asyncio.wait_for(lines.__anext__(),
+                                                                  args.duration - (time.monotonic() - started))
+                    except asyncio.TimeoutError:
+                        break
+                    counts[instrument] += 1
+                    print(f"{instrument}: line {line.y_position} ({line.signal}), "
+                          f"range {line.y_range[0]:.3g} to {line.y_range[1]:.3g}")
+            finally:
+                if args.start:
+                    await fleet.trigger("ActionMeasurementStop", names)
+        print("Lines received:", ", ".join(f"{name} {count}" for name, count in counts.items()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("instruments", nargs="+", metavar="NAME=URI")
+    parser.add_argument("--api-key", default="AFM-Control-API-Key")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds to stream")
+    parser.add_argument("--max-in-flight", type=int, default=8, help="requests in flight per instrument")
+    parser.add_argument("--no-start", dest="start", action="store_false",
+                        help="only listen, do not start and stop the measurements")
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
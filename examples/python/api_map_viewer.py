@@ -0,0 +1,160 @@
+"""
+Title: Live map viewer for AFM Control by nano analytik GmbH
+
+Compatible with API v1.1 and above
+
+Description:
+Shows the image of a running measurement as a heatmap. With --source map the viewer subscribes to "map"
+data and shows each map frame; with --source line it subscribes to line data and writes the forward trace
+of every line into its row of the map, so the image builds up at the line rate.
+
+The map is drawn with afm_api.rendering.MapView: the image is kept as a NumPy array, colored through a
+precomputed colormap table and written into a single Tk PhotoImage. On every timer tick only the rows that
+changed since the last draw are colored and written again, and the contrast follows the 1 % and 99 %
+percentiles of a histogram that is updated with those rows. The connection runs on its own network thread
+(afm_api.threaded.ClientThread).
+
+Usage:
+    python api_map_viewer.py --api-key KEY --uri ws://127.0.0.1:1234 --channel 0
+    python api_map_viewer.py --api-key KEY --source line --colormap gray --start
+
+Run from the examples/python directory.
+
+Author:
+- nano analytik GmbH
+
+License:
+- MIT License
+"""
+
+import argparse
+import queue
+import time
+import tkinter as tk
+
+from afm_api import COALESCE, DROP_OLDEST
+from afm_api.rendering import COLORMAPS, MapView
+from afm_api.threaded import ClientThread, EVENT_DISCONNECTED
+
+# Milliseconds between two redraws
+REFRESH_MS = 40
+
+
+def map_image(vectors):
+    """
+    The image of a map frame decoded by afm_api.decode_map(): the "data" entry sent by the mock server, or
+    else the first N x N entry.
+    """
+    data = vectors.get("data")
+    if getattr(data, "ndim", 0) == 2:
+        return data
+    return next(value for value in vectors.values() if getattr(value, "ndim", 0) == 2)
+
+
+class MapWindow:
+    def __init__(self, root, args):
+        self.root = root
+        self.args = args
+        self.root.title(f"Map of channel {args.channel} ({args.source} data)")
+
+        self.canvas = tk.Canvas(root, width=args.size, height=args.size, bg="white", highlightthickness=0)
+        self.canvas.pack(side=tk.TOP)
+        self.status = tk.Label(root, anchor="w")
+        self.status.pack(side=tk.BOTTOM, fill=tk.X)
+        self.view = None
+        self.frames = 0
+        self.draw_time = 0.0
+        self.started = time.monotonic()
+
+        self.network = ClientThread(args.uri, args.api_key, reconnect=True)
+        self.network.start()
+        if args.source == "map":
+            # Every map frame holds the complete image; only the newest one is of interest
+            self.stream = self.network.stream("map", args.channel, policy=COALESCE)
+        else:
+            self.stream = self.network.stream("line", args.channel, maxlen=4096, policy=DROP_OLDEST)
+        self.network.run(self.connect(), self.on_connected)
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
+        self.root.after(REFRESH_MS, self.update)
+
+    async def connect(self):
+        # Runs on the network thread
+        client = self.network.client
+        await client.connect()
+        await client.subscribe_measurement_data(self.args.channel, self.args.source, self.args.format)
+        if self.args.start:
+            await client.trigger("ActionMeasurementStart")
+
+    def on_connected(self, future):
+        error = future.exception()
+        self.status.config(text=f"Connection failed: {error}" if error else f"Connected to {self.args.uri}")
+
+    def ensure_view(self, rows, columns):
+        if self.view is None or self.view.map.shape != (rows, columns):
+            self.canvas.delete("all")
+            self.view = MapView(self.canvas, rows, columns, self.args.size, self.args.size,
+                                colormap=self.args.colormap)
+
+    def update(self):
+        try:
+            for kind, value in self.network.poll_events(max_events=100):
+                if kind == EVENT_DISCONNECTED:
+                    self.status.config(text=f"Connection lost: {value}")
+            started = time.perf_counter()
+            if self.args.source == "map":
+                if len(self.stream):
+                    data = map_image(self.stream.get_nowait())
+                    self.ensure_view(*data.shape)
+                    self.view.set_map(data)
+                elif self.stream.rejected and self.view is None:
+                    self.status.config(text=f"{self.stream.rejected} map frames could not be decoded, see the log")
+            else:
+                for line in self.stream.drain():
+                    if line.y_position is None or not line.is_valid():
+                        continue
+                    points = len(line)
+                    self.ensure_view(points, points)
+                    if line.y_position < points:
+                        self.view.set_row(line.y_position, line.y_forward)
+            if self.view is not None:
+                bands = self.view.draw()
+                self.frames += 1
+                self.draw_time += time.perf_counter() - started
+                image = self.view.map
+                low, high = image.contrast or (0.0, 0.0)
+                self.status.config(
+                    text=f"{image.shape[1]}x{image.shape[0]} map, {bands} bands redrawn, "
+                         f"{image.rows_drawn} rows and {image.full_redraws} full redraws so far, "
+                         f"{self.draw_time / self.frames * 1e3:.1f} ms per update, "
+                         f"contrast {low:.4g} to {high:.4g}")
+        except queue.Empty:
+            pass
+        finally:
+            self.root.after(REFRESH_MS, self.update)
+
+    def on_close(self):
+        self.network.stop()
+        self.root.destroy()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--uri", default="ws://127.0.0.1:1234", help="URI of the AFM Control server")
+    parser.add_argument("--api-key", required=True, help="API key")
+    parser.add_argument("--channel", type=int, default=0, help="measurement channel")
+    parser.add_argument("--source", choices=("map", "line"), default="map",
+                        help="build the image from map frames or from the line stream")
+    parser.add_argument("--format", choices=("float", "txt", "base64"), default="base64",
+                        help="data format of the subscription")
+    parser.add_argument("--colormap", choices=sorted(COLORMAPS), default="afmhot")
+    parser.add_argument("--size", type=int, default=512, help="size of the view in pixels")
+    parser.add_argument("--start", action="store_true", help="start a measurement after connecting")
+    args = parser.parse_args()
+
+    root = tk.Tk()
+    MapWindow(root, args)
+    root.mainloop()
+
+
+if __name__ == '__main__':
+    main()
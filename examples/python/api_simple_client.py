@@ -13,25 +13,30 @@ The script performs the following actions:
 - Sends commands to start and stop measurements.
 - Processes incoming data and displays it.
   - Measurement data is plotted in real-time using Tkinter.
-  - Log messages and other outputs are displayed in a console text area.
+  - Log messages are written to an indexed SQLite log (afm_api.logstore) by a background thread; the console
+    text area shows only the newest lines of the log and of other outputs.
 
 Note:
 - The programming language used is Python with Tkinter for GUI and asyncio for asynchronous operations.
+- The WebSocket connection runs on its own network thread (afm_api.threaded.ClientThread); the Tkinter main loop only consumes decoded data from thread-safe queues.
+- If the connection drops, the client reconnects automatically and restores the subscriptions; line rows missed in the meantime are reported in the console.
 - The data processing and plotting are included to demonstrate that the API mechanism works and how data can be handled upon reception.
 - The actual data processing logic and GUI implementation are beyond the scope of this example.
 
 Usage:
 - Replace `"your_actual_api_key"` with your actual API key.
-- Run the script using Python 3.7 or higher.
+- Run the script using Python 3.9 or higher.
 
 """
 
 import sys
-import asyncio
-import json
 import tkinter as tk
 from datetime import datetime
-import websockets
+
+from afm_api import AFMAuthenticationError, COALESCE
+from afm_api.logstore import LogSink
+from afm_api.rendering import LinePlot
+from afm_api.threaded import ClientThread, EVENT_DISCONNECTED, EVENT_FRAME, EVENT_MISSED_ROWS, EVENT_RECONNECTED
 
 # API Key for authentication
 # API_KEY = "d1f89a72-3f0b-4d57-b3a9-0f7c63a2e914"  # Replace with your actual API key
@@ -39,27 +44,50 @@ import websockets
 # Specify the channel you want to subscribe to
 CHANNEL = 0  # Change this to the desired channel number
 
+# Data format of the line subscription: "float", "txt" or "base64"
+DATA_FORMAT = "float"
+
+# SQLite database of the system log messages, see afm_api.logstore
+LOG_DATABASE = "afm_log.sqlite"
+
+# Lines kept in the console text area
+CONSOLE_LINES = 1000
+
 
 class StdoutRedirector:
-    def __init__(self, text_widget):
+    """
+    Collects the text printed between two GUI timer ticks; update() inserts it into the text widget at once
+    and trims the widget to the newest max_lines lines, so a burst of output costs one insert.
+    """
+
+    def __init__(self, text_widget, max_lines=CONSOLE_LINES):
         self.text_widget = text_widget
+        self.max_lines = max_lines
+        self.pending = []
 
     def write(self, s):
-        self.text_widget.insert(tk.END, s)
-        self.text_widget.see(tk.END)  # Scroll to the end
+        self.pending.append(s)
 
     def flush(self):
         pass  # This method is needed for file-like objects
 
+    def update(self):
+        if not self.pending:
+            return
+        text = "".join(self.pending)
+        self.pending.clear()
+        self.text_widget.insert(tk.END, text)
+        self.text_widget.delete("1.0", f"end-{self.max_lines + 1}l")
+        self.text_widget.see(tk.END)  # Scroll to the end
+
 
 class ClientWindow:
-    def __init__(self, root, loop):
+    def __init__(self, root):
         self.root = root
-        self.loop = loop
         self.root.title('Real-time Data Plots')
 
-        # Connection status
-        self.websocket = None
+        # Connection status; the network thread owns the WebSocket connection and its event loop
+        self.network = None
         self.connected = False
         self.api_key = None
         self.websocket_uri = None
@@ -114,15 +142,21 @@ class ClientWindow:
         self.canvas = tk.Canvas(self.root, bg='white')
         self.canvas.pack(side=tk.TOP, fill=tk.BOTH, expand=True)
 
+        # Forward (red) and backward (blue) line plot, updated in place on every frame
+        self.plot = LinePlot(self.canvas, self.canvas_width, self.canvas_height,
+                             margin_left=self.margin_left, margin_top=self.margin_top,
+                             margin_right=self.margin_right, margin_bottom=self.margin_bottom)
+
         # Bind the configure event to update canvas size
         self.canvas.bind('<Configure>', self.on_canvas_resize)
 
-        # Data queue
-        self.line_data_queue = []
+        # Display stream of line data, created on connect
+        self.line_stream = None
+
+        # Log messages are recorded by the sink's writer thread; the console shows its tail
+        self.log_sink = LogSink(LOG_DATABASE, tail=CONSOLE_LINES)
+        self.log_cursor = self.log_sink.tail.total
 
-        # Variables to store data for scaling
-        self.x_values = []
-        self.y_values = []
         self.last_plot_data = None  # Store the last plot data
 
         # Create a frame for the console output
@@ -141,7 +175,8 @@ class ClientWindow:
         console_scrollbar.config(command=self.console_text.yview)
 
         # Redirect stdout to the console_text widget
-        sys.stdout = StdoutRedirector(self.console_text)
+        self.console = StdoutRedirector(self.console_text)
+        sys.stdout = self.console
 
         # Start the update loop for tkinter
         self.root.after(100, self.update_plots)
@@ -150,28 +185,10 @@ class ClientWindow:
         # Update canvas dimensions
         self.canvas_width = event.width
         self.canvas_height = event.height
+        self.plot.resize(event.width, event.height)
         # Redraw the plot with new dimensions
         self.redraw_plot()
 
-    def scale_x(self, x):
-        x_min, x_max = min(self.x_values), max(self.x_values)
-        plot_width = self.canvas_width - self.margin_left - self.margin_right
-        if x_max == x_min:
-            # Avoid division by zero
-            return self.margin_left + plot_width / 2
-        else:
-            return self.margin_left + (x - x_min) / (x_max - x_min) * plot_width
-
-    def scale_y(self, y):
-        y_min, y_max = min(self.y_values), max(self.y_values)
-        plot_height = self.canvas_height - self.margin_top - self.margin_bottom
-        if y_max == y_min:
-            # Avoid division by zero
-            return self.margin_top + plot_height / 2
-        else:
-            # Invert y-axis for canvas coordinates
-            return self.margin_top + (y_max - y) / (y_max - y_min) * plot_height
-
     def start_connection(self):
         if not self.connected:
             # Get IP and port from entry fields
@@ -180,86 +197,74 @@ class ClientWindow:
             self.websocket_uri = f"ws://{server_ip}:{server_port}"
             self.api_key = self.api_key_entry.get()
 
-            # Start the WebSocket connection in the background
-            asyncio.ensure_future(self.connect_and_subscribe(), loop=self.loop)
+            # Start the network thread and connect in the background; lost connections are restored
+            # together with the subscriptions
+            self.network = ClientThread(self.websocket_uri, self.api_key, reconnect=True)
+            self.network.start()
+            self.line_stream = self.network.stream("line", CHANNEL, policy=COALESCE)
+            self.network.log_to(self.log_sink)
+            self.network.run(self.connect_and_subscribe(), self.on_connected)
 
     async def connect_and_subscribe(self):
+        # Runs on the network thread: no Tk calls here, the result is handled by on_connected
+        client = self.network.client
+
+        # Connect and authenticate with the API key
+        await client.connect()
+
+        # Subscribe to line data and log data in one round trip
+        return await client.pipeline([
+            ("set", "MeasurementDataSubscription", {
+                "property": "type",
+                "type": "line",
+                "format": DATA_FORMAT,
+                "channel": CHANNEL,
+                "subscription": True
+            }),
+            ("set", "DataSubscription", {
+                "property": "type",
+                "type": "log",
+                "format": "txt",
+                "subscription": True
+            }),
+        ], return_exceptions=True)
+
+    def on_connected(self, future):
         try:
-            self.websocket = await websockets.connect(self.websocket_uri)
-            print("Connected to the WebSocket server.")
-            self.connected = True
-            self.start_measurement_button.config(state='normal')  # Enable the Start Measurement button
-            self.stop_measurement_button.config(state='normal')   # Enable the Stop Measurement button
-
-            api_key = self.api_key
-
-            # Authenticate with the API key
-            auth_request = {
-                "command": "authenticate",
-                "apikey": api_key
-            }
-            await self.websocket.send(json.dumps(auth_request))
-            response = await self.websocket.recv()
-            response_data = json.loads(response)
-            if response_data.get("command") == "error":
-                print("Authentication failed:", response_data)
-                return
-            else:
-                print("Authentication successful.")
-
-            # Subscribe to line data
-            subscribe_line_request = {
-                "command": "set",
-                "object": "MeasurementDataSubscription",
-                "payload": {
-                    "property": "type",
-                    "type": "line",
-                    "format": "float",
-                    "channel": CHANNEL,
-                    "subscription": True
-                }
-            }
-            await self.websocket.send(json.dumps(subscribe_line_request))
-            response = await self.websocket.recv()
-            response_data = json.loads(response)
-            if response_data.get("command") == "error":
-                print("Line data subscription failed:", response_data)
-                return
-            else:
-                print(f"Subscribed to line data on channel {CHANNEL}.")
-
-            # Subscribe to log data
-            subscribe_log_request = {
-                "command": "set",
-                "object": "DataSubscription",
-                "payload": {
-                    "property": "type",
-                    "type": "log",
-                    "format": "txt",
-                    "subscription": True
-                }
-            }
-            await self.websocket.send(json.dumps(subscribe_log_request))
-            response = await self.websocket.recv()
-            response_data = json.loads(response)
-            if response_data.get("command") == "error":
-                print("Log data subscription failed:", response_data)
-                return
-            else:
-                print("Subscribed to log data")
-
-            # Listen for incoming measurement and log data
-            async for message in self.websocket:
-                await self.process_message(message)
+            line_result, log_result = future.result()
+        except AFMAuthenticationError as e:
+            print("Authentication failed:", e)
+            self.network.stop()
+            return
         except Exception as e:
             print("Error in connect_and_subscribe:", e)
-            self.connected = False
-            self.start_measurement_button.config(state='disabled')  # Disable the Start Measurement button
-            self.stop_measurement_button.config(state='disabled')   # Disable the Stop Measurement button
+            self.network.stop()
+            self.on_connection_lost(e)
+            return
+
+        print("Connected to the WebSocket server.")
+        print("Authentication successful.")
+        self.connected = True
+        self.start_measurement_button.config(state='normal')  # Enable the Start Measurement button
+        self.stop_measurement_button.config(state='normal')   # Enable the Stop Measurement button
+
+        if isinstance(line_result, Exception):
+            print("Line data subscription failed:", line_result)
+        else:
+            print(f"Subscribed to line data on channel {CHANNEL}.")
+
+        if isinstance(log_result, Exception):
+            print("Log data subscription failed:", log_result)
+        else:
+            print("Subscribed to log data")
+
+    def on_connection_lost(self, error):
+        self.connected = False
+        self.start_measurement_button.config(state='disabled')  # Disable the Start Measurement button
+        self.stop_measurement_button.config(state='disabled')   # Disable the Stop Measurement button
 
-    async def process_message(self, message):
+    def process_message(self, data):
         try:
-            data = json.loads(message)
             command = data.get("command")
             obj = data.get("object")
             payload = data.get("payload", {})
@@ -271,47 +276,13 @@ class ClientWindow:
                     channel = payload.get("channel")
                     if channel != CHANNEL:
                         return  # Ignore data from other channels
-                    timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
                     if data_type == "line":
-                        value = payload.get("value", {})
-                        x_values = value.get("x", [])
-                        y_forward = value.get("y_forward", [])
-                        y_backward = value.get("y_backward", [])
-
-                        # Validate data
-                        if not x_values or not y_forward or not y_backward:
-                            print("Invalid data received: x_values or y_values are empty.")
-                            return
-
-                        if len(x_values) != len(y_forward) or len(x_values) != len(y_backward):
-                            print("Invalid data received: lengths of x_values and y_values do not match.")
-                            return
-
-                        # Store the last plot data
-                        self.last_plot_data = {
-                            'x_values': x_values,
-                            'y_forward': y_forward,
-                            'y_backward': y_backward,
-                            'signal_name': payload.get("signal", "Measurement Data"),
-                            'channel': channel,
-                            'timestamp': timestamp
-                        }
-
-                        # Add the data to the line data queue
-                        self.line_data_queue.append(self.last_plot_data)
-
-                        # Print timestamp and data receipt message
-                        print(f"[{timestamp}] Received line data on channel {channel}.")
+                        # Line data is consumed through the display stream in update_plots
+                        pass
 
                     else:
                         print(f"Received unknown data type '{data_type}' on channel {channel}.")
 
-                elif obj == "LogEvent":
-                    # Handle log messages
-                    message_text = payload.get("message", "")
-                    timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                    print(f"[{timestamp}] Log: {message_text}")
-
                 else:
                     # Handle other responses, e.g., subscription confirmations
                     pass
@@ -324,61 +295,90 @@ class ClientWindow:
 
             else:
                 print(f"Received unknown command '{command}'.")
-        except json.JSONDecodeError as e:
-            print("Failed to decode JSON:", e)
         except Exception as e:
             print("Error processing message:", e)
 
     def start_measurement(self):
-        if self.connected and self.websocket:
-            asyncio.ensure_future(self.send_start_measurement_command(), loop=self.loop)
-        else:
-            print("Not connected to the server. Please connect first.")
-
-    async def send_start_measurement_command(self):
-        try:
-            start_measurement_command = {
-                "command": "set",
-                "object": "ActionMeasurementStart",
-                "payload": {
-                    "property": "triggered",
-                    "value": True
-                }
-            }
-            await self.websocket.send(json.dumps(start_measurement_command))
-            print("Sent start measurement command.")
-        except Exception as e:
-            print("Error sending start measurement command:", e)
+        self.send_trigger("ActionMeasurementStart", "start measurement")
 
     def stop_measurement(self):
-        if self.connected and self.websocket:
-            asyncio.ensure_future(self.send_stop_measurement_command(), loop=self.loop)
+        self.send_trigger("ActionMeasurementStop", "stop measurement")
+
+    def send_trigger(self, obj, description):
+        if self.connected and self.network:
+            self.network.run(self.network.client.trigger(obj),
+                             lambda future: self.on_command_sent(future, description))
         else:
             print("Not connected to the server. Please connect first.")
 
-    async def send_stop_measurement_command(self):
-        try:
-            stop_measurement_command = {
-                "command": "set",
-                "object": "ActionMeasurementStop",
-                "payload": {
-                    "property": "triggered",
-                    "value": True
-                }
-            }
-            await self.websocket.send(json.dumps(stop_measurement_command))
-            print("Sent stop measurement command.")
-        except Exception as e:
-            print("Error sending stop measurement command:", e)
+    def on_command_sent(self, future, description):
+        error = future.exception()
+        if error is not None:
+            print(f"Error sending {description} command:", error)
+        else:
+            print(f"Sent {description} command.")
 
     def update_plots(self):
         try:
-            if self.line_data_queue:
-                data = self.line_data_queue.pop(0)
-                self.draw_plot(data)
+            if self.network is not None:
+                # Log messages, other frames and disconnects queued by the network thread
+                for kind, value in self.network.poll_events(max_events=100):
+                    if kind == EVENT_FRAME:
+                        self.process_message(value)
+                    elif kind == EVENT_RECONNECTED:
+                        attempts, downtime = value
+                        print(f"Connection restored after {downtime:.1f} s ({attempts} attempts), "
+                              f"subscriptions renewed.")
+                    elif kind == EVENT_MISSED_ROWS:
+                        channel, rows = value
+                        print(f"Missed {len(rows)} lines on channel {channel} while reconnecting "
+                              f"(rows {rows[0]} to {rows[-1]}).")
+                    elif kind == EVENT_DISCONNECTED:
+                        print("Connection lost:", value)
+                        self.network.stop()
+                        self.on_connection_lost(value)
+
+            # New log messages written by the log sink since the last tick
+            lines, self.log_cursor = self.log_sink.tail.since(self.log_cursor)
+            if lines:
+                print("\n".join(lines))
+
+            if self.line_stream is not None and len(self.line_stream):
+                # The display stream coalesces to the latest line, which is already decoded into NumPy
+                # arrays by the network thread, so the plot never falls behind
+                line = self.line_stream.get_nowait()
+                timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+                # Validate data
+                if not len(line.x) or not len(line.y_forward) or not len(line.y_backward):
+                    print("Invalid data received: x_values or y_values are empty.")
+                    return
+
+                if not line.is_valid():
+                    print("Invalid data received: lengths of x_values and y_values do not match.")
+                    return
+
+                # Store the last plot data
+                self.last_plot_data = {
+                    'x_values': line.x,
+                    'y_forward': line.y_forward,
+                    'y_backward': line.y_backward,
+                    'signal_name': line.signal,
+                    'channel': line.channel,
+                    'timestamp': timestamp
+                }
+                self.draw_plot(self.last_plot_data)
+
+                # Print timestamp and data receipt message, including lines skipped by the display and
+                # the time from reception on the network thread to display
+                stats = self.line_stream.stats
+                print(f"[{timestamp}] Plotted line {line.y_position} on channel {line.channel} "
+                      f"({stats.received} received, {stats.coalesced} skipped, "
+                      f"latency {self.line_stream.last_latency * 1e3:.1f} ms).")
         except Exception as e:
             print("Error in update_plots:", e)
         finally:
+            self.console.update()
             self.root.after(100, self.update_plots)
 
     def redraw_plot(self):
@@ -392,7 +392,7 @@ class ClientWindow:
             y_backward = data['y_backward']
 
             # Validate data
-            if not x_values or not y_forward or not y_backward:
+            if not len(x_values) or not len(y_forward) or not len(y_backward):
                 print("Invalid data: Empty x_values or y_values.")
                 return
 
@@ -400,128 +400,42 @@ class ClientWindow:
                 print("Invalid data: x_values and y_values lengths do not match.")
                 return
 
-            # Store data for scaling
-            self.x_values = x_values
-            self.y_values = y_forward + y_backward  # Combine for scaling
-
-            # Clear the canvas
-            self.canvas.delete("all")
-
-            # Draw axes
-            self.draw_axes()
-
-            # Draw forward scan line
-            scaled_points_forward = []
-            for x, y in zip(x_values, y_forward):
-                scaled_x = self.scale_x(x)
-                scaled_y = self.scale_y(y)
-                scaled_points_forward.extend([scaled_x, scaled_y])
-
-            self.canvas.create_line(scaled_points_forward, fill='red', tags='forward_line', width=2)
-
-            # Draw backward scan line
-            scaled_points_backward = []
-            for x, y in zip(x_values, y_backward):
-                scaled_x = self.scale_x(x)
-                scaled_y = self.scale_y(y)
-                scaled_points_backward.extend([scaled_x, scaled_y])
-
-            self.canvas.create_line(scaled_points_backward, fill='blue', tags='backward_line', width=2)
+            # Scale, decimate to the canvas width and move the existing canvas items
+            self.plot.draw(x_values, y_forward, y_backward)
 
         except Exception as e:
             print("Error in draw_plot:", e)
 
-    def draw_axes(self):
-        # Draw x and y axes
-        try:
-            x0 = self.margin_left
-            y0 = self.canvas_height - self.margin_bottom
-            x1 = self.canvas_width - self.margin_right
-            y1 = self.margin_top
-
-            # X-axis
-            self.canvas.create_line(x0, y0, x1, y0, fill='black')
-            # Y-axis
-            self.canvas.create_line(x0, y0, x0, y1, fill='black')
-
-            # Check if we have valid data
-            if not self.x_values or not self.y_values:
-                print("No data to draw axes.")
-                return
-
-            x_min, x_max = min(self.x_values), max(self.x_values)
-            y_min, y_max = min(self.y_values), max(self.y_values)
-
-            # Handle cases where x_max == x_min or y_max == y_min
-            if x_max == x_min:
-                x_ticks_count = 1
-                x_ticks = [x_min]
-                x_positions = [(x0 + x1) / 2]
-            else:
-                x_ticks_count = 10
-                x_ticks = [x_min + i * (x_max - x_min) / x_ticks_count for i in range(x_ticks_count + 1)]
-                x_positions = [x0 + i * (x1 - x0) / x_ticks_count for i in range(x_ticks_count + 1)]
-
-            if y_max == y_min:
-                y_ticks_count = 1
-                y_ticks = [y_min]
-                y_positions = [(y0 + y1) / 2]
-            else:
-                y_ticks_count = 10
-                y_ticks = [y_min + i * (y_max - y_min) / y_ticks_count for i in range(y_ticks_count + 1)]
-                y_positions = [y0 - i * (y0 - y1) / y_ticks_count for i in range(y_ticks_count + 1)]
-
-            # Draw tick marks and labels for x-axis
-            for x, x_value in zip(x_positions, x_ticks):
-                self.canvas.create_line(x, y0, x, y0 + 5, fill='black')
-                self.canvas.create_text(x, y0 + 15, text=f"{x_value:.2f}", font=('Arial', 8), anchor='n')
-
-            # Draw tick marks and labels for y-axis
-            for y, y_value in zip(y_positions, y_ticks):
-                self.canvas.create_line(x0 - 5, y, x0, y, fill='black')
-                self.canvas.create_text(x0 - 20, y, text=f"{y_value:.2f}", font=('Arial', 8), anchor='e')
-
-            # Labels for axes
-            self.canvas.create_text((x0 + x1) / 2, y0 + 35, text="X Axis", font=('Arial', 10))
-            self.canvas.create_text(x0 - 70, (y0 + y1) / 2, text="Y Axis", font=('Arial', 10), angle=90)
-
-        except Exception as e:
-            print("Error in draw_axes:", e)
-
     def disconnect(self):
-        if self.connected and self.websocket:
-            asyncio.ensure_future(self.close_connection(), loop=self.loop)
+        if self.connected and self.network:
+            self.network.run(self.network.client.close(), self.on_disconnected)
         else:
             print("Not connected to any server.")
 
-    async def close_connection(self):
-        try:
-            await self.websocket.close()
+    def on_disconnected(self, future):
+        error = future.exception()
+        if error is not None:
+            print("Error during disconnect:", error)
+        else:
             print("Disconnected from the WebSocket server.")
-        except Exception as e:
-            print("Error during disconnect:", e)
-        finally:
-            self.connected = False
-            self.start_measurement_button.config(state='disabled')  # Disable the Start Measurement button
-            self.stop_measurement_button.config(state='disabled')   # Disable the Stop Measurement button
+        self.network.stop()
+        self.on_connection_lost(None)
+
+    def on_close(self):
+        if self.network is not None:
+            self.network.stop()
+        self.log_sink.close()
+        sys.stdout = sys.__stdout__
+        self.root.destroy()
 
 
 def main():
     root = tk.Tk()
-    loop = asyncio.get_event_loop()
 
-    window = ClientWindow(root, loop)
-
-    # Periodically run the asyncio event loop
-    def run_loop():
-        try:
-            loop.run_until_complete(asyncio.sleep(0.1))
-        except Exception as e:
-            print("Error in event loop:", e)
-        finally:
-            root.after(50, run_loop)
+    # The GUI only runs the Tk main loop; networking runs on the client's own thread
+    window = ClientWindow(root)
+    root.protocol("WM_DELETE_WINDOW", window.on_close)
 
-    root.after(50, run_loop)
     root.mainloop()
 
 
@@ -0,0 +1,98 @@
+"""
+Title: Line decoding benchmark
+
+Description:
+Compares the list-based line handling of the original examples (json.loads into Python lists, then
+y_forward + y_backward and min()/max() for the Y range) with the NumPy decoding layer in
+afm_api.decoding for the "float", "txt" and "base64" subscription formats.
+
+Every variant starts from the raw JSON text of a MeasurementDataSubscription line frame, so the
+measured time covers the complete path from the socket to the plot bounds.
+
+Usage:
+    python benchmarks/bench_decoding.py [--points 1024] [--repeat 2000]
+
+Run from the examples/python directory.
+"""
+
+import argparse
+import base64
+import json
+import os
+import sys
+import timeit
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from afm_api.decoding import BASE64_DTYPE, decode_line  # noqa: E402
+
+
+def make_frame(points, data_format, seed=0):
+    rng = np.random.default_rng(seed)
+    vectors = {
+        "x": np.linspace(0.0, 10.0, points),
+        "y_forward": rng.normal(0.0, 1.0, points).round(5),
+        "y_backward": rng.normal(0.0, 1.0, points).round(5),
+    }
+    if data_format == "base64":
+        value = {name: base64.b64encode(v.astype(BASE64_DTYPE).tobytes()).decode("ascii")
+                 for name, v in vectors.items()}
+    elif data_format == "txt":
+        value = {name: [f"{x:.4e}" for x in v] for name, v in vectors.items()}
+    else:
+        value = {name: v.tolist() for name, v in vectors.items()}
+    value["y_position"] = 0
+    return json.dumps({
+        "command": "response",
+        "object": "MeasurementDataSubscription",
+        "payload": {"channel": 0, "format": data_format, "signal": "topography", "type": "line", "value": value}
+    })
+
+
+def list_path(message):
+    # Equivalent of process_message/draw_plot in the original api_simple_client.py
+    payload = json.loads(message).get("payload", {})
+    value = payload.get("value", {})
+    x_values = value.get("x", [])
+    y_forward = value.get("y_forward", [])
+    y_backward = value.get("y_backward", [])
+    if payload.get("format") == "txt":
+        x_values = [float(v) for v in x_values]
+        y_forward = [float(v) for v in y_forward]
+        y_backward = [float(v) for v in y_backward]
+    y_values = y_forward + y_backward
+    return min(x_values), max(x_values), min(y_values), max(y_values)
+
+
+def numpy_path(message):
+    line = decode_line(json.loads(message).get("payload", {}))
+    y_min, y_max = line.y_range
+    return line.x.min(), line.x.max(), y_min, y_max
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--points", type=int, default=1024, help="points per line (ScannerResolution)")
+    parser.add_argument("--repeat", type=int, default=2000, help="frames decoded per measurement")
+    args = parser.parse_args()
+
+    # Speedup is reported relative to the original list path on "float" frames
+    print(f"{'format':<8} {'path':<8} {'bytes/frame':>12} {'us/frame':>10} {'speedup':>8}")
+    baseline = None
+    for data_format in ("float", "txt", "base64"):
+        message = make_frame(args.points, data_format)
+        paths = (("list", list_path), ("numpy", numpy_path))
+        for name, path in paths:
+            if name == "list" and data_format == "base64":
+                # The list path of the original examples cannot consume base64 frames
+                continue
+            seconds = min(timeit.repeat(lambda: path(message), number=args.repeat, repeat=3)) / args.repeat
+            baseline = baseline or seconds
+            print(f"{data_format:<8} {name:<8} {len(message):>12} {seconds * 1e6:>10.1f} "
+                  f"{baseline / seconds:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+"""
+Title: Frame decoding and encoding benchmark
+
+Description:
+Measures the per-frame cost of the client's JSON layer (afm_api.frames) for every installed backend
+(msgspec, orjson, json), compared with the original path: json.loads followed by is_stream_frame() and the
+.get() chains of dispatching, stream routing and row tracking.
+
+- decode: text of a frame to routed dict, for line frames in "float", "txt" and "base64" format, a log
+  event and a set reply,
+- encode: wire text of a trigger command, built per call with json.dumps or taken from the cached
+  Command of trigger_command().
+
+Usage:
+    python benchmarks/bench_frames.py [--points 1024] [--repeat 2000] [--output results.json]
+
+Run from the examples/python directory.
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import timeit
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from afm_api import frames  # noqa: E402
+from afm_api.client import is_stream_frame  # noqa: E402
+from afm_api.streams import stream_key  # noqa: E402
+from bench_decoding import make_frame  # noqa: E402
+
+OTHER_FRAMES = {
+    "log": {"command": "response", "object": "LogEvent",
+            "payload": {"level": "info", "message": "Measurement started", "timestamp": 1700000000.0}},
+    "reply": {"command": "response", "object": "ScannerRange",
+              "payload": {"property": "value", "value": 10.0, "unit": "µm"}},
+}
+
+
+def original_path(message):
+    # Dispatch of the client before afm_api.frames: stdlib decoding, classification repeated per stage
+    data = json.loads(message)
+    command = data.get("command")
+    if (command == "response" and not is_stream_frame(data)) or command == "error":
+        return data.get("payload") or {}
+    payload = data.get("payload") or {}
+    if data.get("object") == "MeasurementDataSubscription" and payload.get("type") == "line":
+        value = payload.get("value")
+        if isinstance(value, dict):
+            value.get("y_position", payload.get("y_position"))
+    if is_stream_frame(data):
+        return stream_key(data)
+
+
+def frames_path(loads):
+    def path(message):
+        data = loads(message)
+        kind = frames.frame_kind(data)
+        if kind is frames.RESPONSE or kind is frames.ERROR:
+            return data.get("payload") or {}
+        if kind is frames.DATA:
+            payload = data["payload"]
+            if payload.get("type") == "line":
+                payload["value"].get("y_position", payload.get("y_position"))
+        if kind in frames.STREAM_KINDS:
+            return stream_key(data)
+    return path
+
+
+def measure(function, argument, repeat):
+    return min(timeit.repeat(lambda: function(argument), number=repeat, repeat=3)) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--points", type=int, default=1024, help="points per line (ScannerResolution)")
+    parser.add_argument("--repeat", type=int, default=2000, help="frames per measurement")
+    parser.add_argument("--output", help="write the JSON results to this file")
+    args = parser.parse_args()
+
+    messages = {f"line {data_format}": make_frame(args.points, data_format)
+                for data_format in ("float", "txt", "base64")}
+    messages.update((name, json.dumps(frame)) for name, frame in OTHER_FRAMES.items())
+    backends = frames.available_backends()
+
+    results = []
+    print(f"{'frame':<12} {'bytes':>8} {'original us':>12} " + " ".join(f"{name + ' us':>11}" for name in backends))
+    for name, message in messages.items():
+        baseline = measure(original_path, message, args.repeat)
+        row = {"frame": name, "bytes": len(message), "original_us": round(baseline * 1e6, 3)}
+        for backend in backends:
+            loads, _ = frames.backend_functions(backend)
+            row[f"{backend}_us"] = round(measure(frames_path(loads), message, args.repeat) * 1e6, 3)
+        results.append(row)
+        print(f"{name:<12} {len(message):>8} {row['original_us']:>12.2f} "
+              + " ".join(f"{row[f'{backend}_us']:>11.2f}" for backend in backends))
+
+    repeat = args.repeat * 50
+    encoding = {"json.dumps_us": measure(lambda obj: json.dumps(
+        {"command": "set", "object": obj, "payload": {"property": "triggered", "value": True}}),
+        "ActionMeasurementStart", repeat) * 1e6}
+    for backend in backends:
+        _, dumps = frames.backend_functions(backend)
+        encoding[f"{backend}_us"] = measure(lambda obj: dumps(
+            {"command": "set", "object": obj, "payload": {"property": "triggered", "value": True}}),
+            "ActionMeasurementStart", repeat) * 1e6
+    encoding["cached_command_us"] = measure(lambda obj: frames.trigger_command(obj).message,
+                                            "ActionMeasurementStart", repeat) * 1e6
+    encoding = {name: round(value, 3) for name, value in encoding.items()}
+    print("encode trigger: " + ", ".join(f"{name} {value:.2f}" for name, value in encoding.items()))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({
+                "benchmark": "frames",
+                "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                "environment": {"python": platform.python_version(), "numpy": np.__version__,
+                                "platform": platform.platform(), "backends": backends},
+                "settings": {"points": args.points, "repeat": args.repeat},
+                "decode": results,
+                "encode": encoding,
+            }, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
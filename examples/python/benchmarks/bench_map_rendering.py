@@ -0,0 +1,97 @@
+"""
+Title: Map rendering benchmark
+
+Description:
+Measures the time per update of a live map view for a map of --resolution x --resolution points shown in a
+--size x --size view, while a scan adds --rows-per-update new rows between two updates:
+
+- full: every update computes the percentiles over the whole map with numpy.percentile, colors the whole
+  (subsampled) map and encodes it as one PPM image,
+- MapImage: afm_api.rendering.MapImage finds the changed rows of the new map frame, updates its contrast
+  histogram with them and colors and encodes only those rows.
+
+With a display available the PPM data is also written into a Tk PhotoImage, so the times include Tk.
+
+Usage:
+    python benchmarks/bench_map_rendering.py [--resolution 1024] [--size 512] [--rows-per-update 16]
+
+Run from the examples/python directory.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from afm_api.rendering import MapImage, colormap_lut  # noqa: E402
+
+
+def full_update(data, lut, step):
+    low, high = np.percentile(data[np.isfinite(data)], (1.0, 99.0))
+    view = data[::step, ::step]
+    scaled = np.clip((view - low) * (255.0 / max(high - low, 1e-12)), 0, 255)
+    scaled[np.isnan(view)] = 256
+    rgb = lut.take(scaled.astype(np.intp), axis=0)
+    return [b"P6 %d %d 255\n" % (rgb.shape[1], rgb.shape[0]) + rgb.tobytes()], 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--resolution", type=int, default=1024, help="points per line and lines per map")
+    parser.add_argument("--size", type=int, default=512, help="size of the view in pixels")
+    parser.add_argument("--rows-per-update", type=int, default=16, help="new rows between two updates")
+    parser.add_argument("--headless", action="store_true", help="do not use a Tk PhotoImage")
+    args = parser.parse_args()
+
+    photo = None
+    if not args.headless:
+        try:
+            import tkinter as tk
+            root = tk.Tk()
+            photo = tk.PhotoImage(master=root, width=args.size, height=args.size)
+        except Exception as e:
+            print(f"No Tk display available ({e}), running headless.")
+
+    n = args.resolution
+    rng = np.random.default_rng(0)
+    sample = rng.normal(0, 0.05, (n, n)) + np.sin(np.linspace(0, 12, n))[None, :] + np.linspace(0, 2, n)[:, None]
+    frames = []
+    scanned = np.full((n, n), np.nan)
+    for end in range(args.rows_per_update, n + 1, args.rows_per_update):
+        scanned[end - args.rows_per_update:end] = sample[end - args.rows_per_update:end]
+        frames.append(scanned.copy())
+
+    def put(images, first_rows):
+        if photo is not None:
+            for data, first in zip(images, first_rows):
+                photo.tk.call(photo.name, "put", data, "-format", "ppm", "-to", 0, first)
+
+    image = MapImage(n, n, args.size, args.size)
+    lut = colormap_lut()
+
+    started = time.perf_counter()
+    for frame in frames:
+        data, first = full_update(frame, lut, image.step)
+        put(data, [first])
+    full = (time.perf_counter() - started) / len(frames)
+
+    started = time.perf_counter()
+    for frame in frames:
+        image.set_map(frame)
+        bands = image.render()
+        put([image.ppm(first, end) for first, end in bands], [first for first, _ in bands])
+    delta = (time.perf_counter() - started) / len(frames)
+
+    print(f"{n}x{n} map in a {image.display_size[0]}x{image.display_size[1]} view, "
+          f"{args.rows_per_update} new rows per update, {'Tk' if photo else 'headless'}")
+    print(f"full redraw: {full * 1e3:8.2f} ms/update")
+    print(f"MapImage:    {delta * 1e3:8.2f} ms/update ({full / delta:.1f}x, "
+          f"{image.full_redraws} full redraws for contrast changes in {len(frames)} updates)")
+
+
+if __name__ == '__main__':
+    main()
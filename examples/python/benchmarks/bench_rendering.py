@@ -0,0 +1,128 @@
+"""
+Title: Line plot rendering benchmark
+
+Description:
+Measures the time per frame needed to turn one scan line into canvas coordinates, comparing the per-point
+scale_x/scale_y approach of the original api_simple_client.py (min()/max() over the whole line for every
+point) with afm_api.rendering.LinePlot (bounds once, NumPy scaling, min/max decimation to the plot width,
+in-place canvas updates).
+
+With a display available, a real tk.Canvas is used and the times include Tk. Without a display (or with
+--headless) a canvas stand-in that accepts but discards all calls is used, so only the Python/NumPy part
+of the work is measured.
+
+Usage:
+    python benchmarks/bench_rendering.py [--points 4096] [--width 600] [--frames 5] [--headless]
+
+Run from the examples/python directory.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from afm_api.rendering import LinePlot  # noqa: E402
+
+
+class NullCanvas:
+    """Accepts the Canvas calls used by the renderers and discards them."""
+
+    def __init__(self):
+        self._items = 0
+
+    def _create(self, *args, **kwargs):
+        self._items += 1
+        return self._items
+
+    create_line = create_text = _create
+
+    def coords(self, *args):
+        pass
+
+    def itemconfigure(self, *args, **kwargs):
+        pass
+
+    def delete(self, *args):
+        pass
+
+
+def original_frame(canvas, x_values, y_forward, y_backward, width, height):
+    # Per-point scaling of the original example, including the full canvas rebuild
+    margin_left, margin_right, margin_top, margin_bottom = 100, 20, 20, 50
+    y_values = y_forward + y_backward
+
+    def scale_x(x):
+        x_min, x_max = min(x_values), max(x_values)
+        return margin_left + (x - x_min) / (x_max - x_min) * (width - margin_left - margin_right)
+
+    def scale_y(y):
+        y_min, y_max = min(y_values), max(y_values)
+        return margin_top + (y_max - y) / (y_max - y_min) * (height - margin_top - margin_bottom)
+
+    canvas.delete("all")
+    for trace, color in ((y_forward, 'red'), (y_backward, 'blue')):
+        points = []
+        for x, y in zip(x_values, trace):
+            points.extend([scale_x(x), scale_y(y)])
+        canvas.create_line(points, fill=color, width=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--points", type=int, default=4096, help="points per line")
+    parser.add_argument("--width", type=int, default=600, help="canvas width in pixels")
+    parser.add_argument("--height", type=int, default=400, help="canvas height in pixels")
+    parser.add_argument("--frames", type=int, default=5, help="frames per measurement")
+    parser.add_argument("--headless", action="store_true", help="do not use a real Tk canvas")
+    args = parser.parse_args()
+
+    root = None
+    if not args.headless:
+        try:
+            import tkinter as tk
+            root = tk.Tk()
+        except Exception as e:
+            print(f"No Tk display available ({e}), running headless.")
+    if root is not None:
+        canvas = tk.Canvas(root, width=args.width, height=args.height)
+        canvas.pack()
+        root.update()
+    else:
+        canvas = NullCanvas()
+
+    rng = np.random.default_rng(0)
+    x = np.linspace(0.0, 10.0, args.points)
+    lines = [(rng.normal(0, 1, args.points), rng.normal(0, 1, args.points)) for _ in range(args.frames)]
+
+    x_list = x.tolist()
+    list_lines = [(f.tolist(), b.tolist()) for f, b in lines]
+
+    def run(draw, frames):
+        started = time.perf_counter()
+        for y_forward, y_backward in frames:
+            draw(y_forward, y_backward)
+            if root is not None:
+                root.update_idletasks()
+        return (time.perf_counter() - started) / len(frames)
+
+    original = run(lambda f, b: original_frame(canvas, x_list, f, b, args.width, args.height), list_lines)
+
+    if root is not None:
+        canvas.delete("all")
+    plot = LinePlot(canvas, args.width, args.height)
+    vectorized = run(lambda f, b: plot.draw(x, f, b), lines)
+
+    print(f"{args.points} points, {args.width}x{args.height} canvas, {'Tk' if root else 'headless'}")
+    print(f"original per-point renderer: {original * 1e3:10.2f} ms/frame")
+    print(f"LinePlot:                    {vectorized * 1e3:10.2f} ms/frame ({original / vectorized:.0f}x)")
+    if root is not None:
+        root.destroy()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+"""
+Title: Client benchmark against a captured session
+
+Description:
+Replays a capture file of a real scan (see api_capture.py and afm_api.replay_server) from a separate process
+and measures how the client handles exactly that traffic:
+
+- frames/s and MB/s consumed by the client,
+- decode CPU time per line frame (decode_line, thread CPU time) and client process CPU per frame
+  (including WebSocket and JSON handling),
+- frames dropped by the client's DROP_OLDEST stream buffer.
+
+At --speed 0 the capture is played as fast as the client reads, which measures the client's maximum
+throughput; at --speed 1 it runs at the recorded pace, e.g. to check for drops with a slow consumer
+(--work-ms). The results are written as JSON like those of bench_streaming.py.
+
+Usage:
+    python benchmarks/bench_replay.py scan.afmcap [--speed 0] [--repeat 3] [--output results.json]
+
+Run from the examples/python directory.
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import time
+
+import numpy as np
+import websockets
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from afm_api import DROP_OLDEST, AFMClient, decode_line  # noqa: E402
+from afm_api.replay_server import ReplayServer  # noqa: E402
+
+
+def serve(path, speed, ready):
+    """Replay server process; reports its port through the ready queue."""
+    async def run():
+        server = ReplayServer(path, port=0, speed=speed, close_when_done=True)
+        await server.start()
+        ready.put(server.port)
+        await asyncio.Future()
+
+    asyncio.run(run())
+
+
+async def consume(stream, samples, work):
+    async for frame in stream:
+        started = time.thread_time()
+        decode_line(frame["payload"])
+        samples.append(time.thread_time() - started)
+        if work:
+            # Simulated per-line processing of a slow consumer
+            await asyncio.sleep(work)
+
+
+async def run_case(uri, maxlen, work):
+    samples = []
+    closed = asyncio.Event()
+    client = AFMClient(uri, "replay")
+    client.add_disconnect_handler(lambda error: closed.set())
+    cpu_before = time.process_time()
+    started = time.perf_counter()
+    async with client:
+        stream = client.stream("line", maxlen=maxlen, policy=DROP_OLDEST)
+        consumer = asyncio.ensure_future(consume(stream, samples, work))
+        await closed.wait()
+        elapsed = time.perf_counter() - started
+        cpu = time.process_time() - cpu_before
+        stream.close()
+        await consumer
+    frames = client.messages_received
+    return {
+        "duration_s": round(elapsed, 3),
+        "frames": frames,
+        "line_frames": len(samples),
+        "frames_per_s": round(frames / elapsed, 1),
+        "mb_per_s": round(client.bytes_received / elapsed / 1e6, 3),
+        "decode_cpu_ms_per_frame": round(float(np.mean(samples)) * 1e3, 4) if samples else None,
+        "client_cpu_ms_per_frame": round(cpu / frames * 1e3, 4) if frames else None,
+        "dropped_frames": stream.stats.dropped,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("capture", help="capture file")
+    parser.add_argument("--speed", type=float, default=0.0, help="playback speed factor, 0 for maximum speed")
+    parser.add_argument("--repeat", type=int, default=3, help="number of runs")
+    parser.add_argument("--maxlen", type=int, default=64, help="client stream buffer length")
+    parser.add_argument("--work-ms", type=float, default=0.0, help="simulated processing time per line")
+    parser.add_argument("--output", help="write the JSON results to this file instead of stdout")
+    args = parser.parse_args()
+
+    ready = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve, args=(args.capture, args.speed, ready), daemon=True)
+    server.start()
+    results = []
+    try:
+        uri = f"ws://127.0.0.1:{ready.get(timeout=60)}"
+        for run in range(args.repeat):
+            result = asyncio.run(run_case(uri, args.maxlen, args.work_ms / 1e3))
+            results.append(result)
+            print(f"run {run + 1}: {result['frames_per_s']:8.1f} frames/s  {result['mb_per_s']:7.2f} MB/s  "
+                  f"decode {result['decode_cpu_ms_per_frame']} ms  dropped {result['dropped_frames']}",
+                  file=sys.stderr)
+    finally:
+        server.terminate()
+        server.join()
+
+    report = {
+        "benchmark": "replay",
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "environment": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "websockets": websockets.__version__,
+            "platform": platform.platform(),
+        },
+        "settings": {"capture": os.path.basename(args.capture), "speed": args.speed, "maxlen": args.maxlen,
+                     "work_ms": args.work_ms},
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+"""
+Title: Streaming throughput and latency benchmark
+
+Description:
+Sweeps scan resolution, channel count, payload format and lines per second against the mock server
+(afm_api.mock_server, started in a separate process) and measures for each combination:
+
+- frames/s and MB/s actually consumed by the client,
+- decode CPU time per frame (decode_line, thread CPU time) and client process CPU per frame (including
+  WebSocket and JSON handling),
+- p50/p99 latency from the server sending a line to the consumer having decoded it (the mock server
+  stamps frames with its send time; both run on the same host clock),
+- frames dropped by the client's DROP_OLDEST stream buffer.
+
+The results are written as JSON, together with the Python, NumPy and websockets versions, so runs of
+different client versions can be compared. A lines per second value of 0 streams as fast as possible.
+
+Usage:
+    python benchmarks/bench_streaming.py [--resolutions 256 1024] [--channels 1 2]
+        [--formats float txt base64] [--rates 10 100 0] [--duration 5] [--output results.json]
+
+Run from the examples/python directory.
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import time
+
+import numpy as np
+import websockets
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from afm_api import DROP_OLDEST, AFMClient, decode_line  # noqa: E402
+from afm_api.mock_server import RESOLUTIONS, MockAFMServer  # noqa: E402
+
+API_KEY = "benchmark"
+
+
+def serve(channels, ready):
+    """Mock server process; reports its port through the ready queue."""
+    async def run():
+        server = MockAFMServer(port=0, api_key=API_KEY, channels=channels, stamp_frames=True)
+        await server.start()
+        ready.put(server.port)
+        await asyncio.Future()
+
+    asyncio.run(run())
+
+
+async def consume(stream, samples, work):
+    async for frame in stream:
+        payload = frame["payload"]
+        started = time.thread_time()
+        decode_line(payload)
+        samples["decode_cpu"].append(time.thread_time() - started)
+        samples["latency"].append(time.time() - payload["server_time"])
+        if work:
+            # Simulated per-line processing of a slow consumer
+            await asyncio.sleep(work)
+
+
+async def run_case(uri, resolution, channels, data_format, rate, duration, maxlen, work):
+    samples = {"decode_cpu": [], "latency": []}
+    async with AFMClient(uri, API_KEY) as client:
+        stream = client.stream("line", maxlen=maxlen, policy=DROP_OLDEST)
+        await client.pipeline(
+            [("set", "ScannerResolution", {"property": "value", "value": RESOLUTIONS.index(resolution)}),
+             ("set", "ScannerLinesPerSecond", {"property": "value", "value": rate}),
+             ("set", "ScannerMode", {"property": "value", "value": 1})]
+            + [("set", "MeasurementDataSubscription",
+                {"property": "subscription", "value": True, "channel": channel, "type": "line",
+                 "format": data_format}) for channel in range(channels)])
+        consumer = asyncio.ensure_future(consume(stream, samples, work))
+
+        bytes_before = client.bytes_received
+        cpu_before = time.process_time()
+        started = time.perf_counter()
+        await client.trigger("ActionMeasurementStart")
+        await asyncio.sleep(duration)
+        await client.trigger("ActionMeasurementStop")
+        elapsed = time.perf_counter() - started
+        cpu = time.process_time() - cpu_before
+        received_bytes = client.bytes_received - bytes_before
+
+        client.close_stream(stream)
+        await consumer
+
+    frames = len(samples["latency"])
+    latency = np.array(samples["latency"]) * 1e3
+    return {
+        "resolution": resolution,
+        "channels": channels,
+        "format": data_format,
+        "lines_per_second": rate,
+        "duration_s": round(elapsed, 3),
+        "frames": frames,
+        "frames_per_s": round(frames / elapsed, 1),
+        "mb_per_s": round(received_bytes / elapsed / 1e6, 3),
+        "bytes_per_frame": round(received_bytes / frames) if frames else None,
+        "decode_cpu_ms_per_frame": round(float(np.mean(samples["decode_cpu"])) * 1e3, 4) if frames else None,
+        "client_cpu_ms_per_frame": round(cpu / frames * 1e3, 4) if frames else None,
+        "latency_p50_ms": round(float(np.percentile(latency, 50)), 3) if frames else None,
+        "latency_p99_ms": round(float(np.percentile(latency, 99)), 3) if frames else None,
+        "dropped_frames": stream.stats.dropped,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--resolutions", type=int, nargs="+", default=[256, 1024], choices=RESOLUTIONS)
+    parser.add_argument("--channels", type=int, nargs="+", default=[1, 2], choices=range(1, 5))
+    parser.add_argument("--formats", nargs="+", default=["float", "txt", "base64"],
+                        choices=["float", "txt", "base64"])
+    parser.add_argument("--rates", type=float, nargs="+", default=[10, 100, 0],
+                        help="lines per second, 0 for unthrottled")
+    parser.add_argument("--duration", type=float, default=5.0, help="seconds of streaming per case")
+    parser.add_argument("--maxlen", type=int, default=64, help="client stream buffer length")
+    parser.add_argument("--work-ms", type=float, default=0.0, help="simulated processing time per line")
+    parser.add_argument("--output", help="write the JSON results to this file instead of stdout")
+    args = parser.parse_args()
+
+    results = []
+    for channels in args.channels:
+        ready = multiprocessing.Queue()
+        server = multiprocessing.Process(target=serve, args=(channels, ready), daemon=True)
+        server.start()
+        try:
+            uri = f"ws://127.0.0.1:{ready.get(timeout=10)}"
+            for resolution in args.resolutions:
+                for data_format in args.formats:
+                    for rate in args.rates:
+                        result = asyncio.run(run_case(uri, resolution, channels, data_format, rate, args.duration,
+                                                      args.maxlen, args.work_ms / 1e3))
+                        results.append(result)
+                        print(f"{resolution:5d} px  {channels} ch  {data_format:6s}  {rate:6g} lines/s: "
+                              f"{result['frames_per_s']:8.1f} frames/s  {result['mb_per_s']:7.2f} MB/s  "
+                              f"p50 {result['latency_p50_ms']} ms  p99 {result['latency_p99_ms']} ms  "
+                              f"dropped {result['dropped_frames']}", file=sys.stderr)
+        finally:
+            server.terminate()
+            server.join()
+
+    report = {
+        "benchmark": "streaming",
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "environment": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "websockets": websockets.__version__,
+            "platform": platform.platform(),
+        },
+        "settings": {"duration_s": args.duration, "maxlen": args.maxlen, "work_ms": args.work_ms},
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""
+Title: JSON backend encoding check
+
+Description:
+Encodes sample commands with dumps() of every installed JSON backend of afm_api.frames, including its
+fallback to json, and checks that json.loads() reads back the same values as from json.dumps(). Ordinary
+commands (numbers, None, strings containing "null") must be encoded by the backend itself; NumPy scalars,
+NaN, Infinity and keys that are not strings may fall back to json.
+
+Usage:
+    python checks/check_frames.py
+
+Run from the examples/python directory.
+"""
+
+import argparse
+import json
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from afm_api import frames  # noqa: E402
+
+# Commands every backend encodes itself
+ORDINARY = [
+    {"command": "set", "object": "ScannerRange", "payload": {"property": "value", "value": 1.5}},
+    {"command": "set", "object": "ActionMeasurementStart", "payload": {"property": "triggered", "value": True}},
+    {"property": "value", "value": None},
+    {"property": "comment", "value": "null offset"},
+    {"property": "value", "value": [1, -2.5e-7, None, "nullable"]},
+]
+
+# Objects that need the fallback to json
+SPECIAL = [
+    {"property": "value", "value": np.linspace(1, 10, 3)[1]},
+    {"property": "value", "value": float("nan")},
+    {"property": "value", "value": [1.0, float("inf"), None]},
+    {"property": "value", "value": {"offset": -float("inf")}},
+    {1: "key that is not a string"},
+]
+
+
+def normalized(text):
+    # NaN != NaN, so decoded values are compared by their json text
+    return json.dumps(json.loads(text), sort_keys=True)
+
+
+def check_backend(name):
+    problems = []
+    _, raw_dumps = frames.backend_functions(name)
+    _, dumps = frames.backend_functions(name, fallback=True)
+    for ordinary, sample in [(True, sample) for sample in ORDINARY] + [(False, sample) for sample in SPECIAL]:
+        try:
+            text = dumps(sample)
+        except Exception as e:
+            problems.append(f"{name}: {sample!r} raised {e!r}")
+            continue
+        if normalized(text) != normalized(json.dumps(sample)):
+            problems.append(f"{name}: {sample!r} encoded as {text}, json gives {json.dumps(sample)}")
+        elif ordinary and text != raw_dumps(sample):
+            problems.append(f"{name}: {sample!r} fell back to json")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.parse_args()
+    print(f"JSON backend: {frames.BACKEND} (installed: {', '.join(frames.available_backends())})")
+    problems = []
+    for name in frames.available_backends():
+        problems += check_backend(name)
+    for problem in problems:
+        print(problem)
+    if problems:
+        raise SystemExit("FAILED: encoding differs from json")
+    print("Passed: every backend encodes the same values as json")
+
+
+if __name__ == '__main__':
+    main()
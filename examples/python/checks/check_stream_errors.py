@@ -0,0 +1,92 @@
+"""
+Title: Malformed stream frame check
+
+Description:
+Starts the mock server (afm_api.mock_server) and connects a ClientThread with a line stream. The server then
+sends a line frame whose "y_forward" vector is not valid base64, followed by a valid line frame. The check
+passes when the malformed frame is counted in ThreadSafeStream.rejected, the connection stays open and the
+valid line arrives decoded. It exits with an error message otherwise.
+
+Usage:
+    python checks/check_stream_errors.py
+
+Run from the examples/python directory.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from afm_api import DROP_OLDEST  # noqa: E402
+from afm_api.mock_server import MockAFMServer, encode_vector  # noqa: E402
+from afm_api.threaded import ClientThread  # noqa: E402
+
+POINTS = 64
+
+
+def line_frame(x, data_format="base64"):
+    value = {name: encode_vector(x, data_format) for name in ("x", "y_forward", "y_backward")}
+    value["y_position"] = 0
+    return json.dumps({
+        "command": "response",
+        "object": "MeasurementDataSubscription",
+        "payload": {"channel": 0, "format": data_format, "signal": "topography", "type": "line", "value": value}
+    })
+
+
+def corrupt(text, vector="y_forward"):
+    """Replace the first character of a base64 coded vector with one outside the base64 alphabet."""
+    idx = text.index(f'"{vector}": "') + len(f'"{vector}": "')
+    return text[:idx] + "*" + text[idx + 1:]
+
+
+async def check_malformed_frame(timeout):
+    x = np.linspace(0.0, 1.0, POINTS)
+    valid = line_frame(x)
+    server = MockAFMServer(port=0)
+    await server.start()
+    network = ClientThread(server.uri, "key")
+    network.start()
+    try:
+        stream = network.stream("line", 0, policy=DROP_OLDEST)
+        await asyncio.wrap_future(network.connect())
+        await asyncio.wrap_future(network.run(network.client.subscribe_measurement_data(0, "line", "base64")))
+        await server.broadcast(corrupt(valid))
+        await server.broadcast(valid)
+        deadline = time.monotonic() + timeout
+        while not len(stream) and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+        if not network.client.connected:
+            raise SystemExit("FAILED: the malformed frame closed the connection")
+        if stream.rejected != 1:
+            raise SystemExit(f"FAILED: {stream.rejected} frames rejected, expected 1")
+        if not len(stream):
+            raise SystemExit(f"FAILED: the valid frame did not arrive within {timeout} s")
+        line = stream.get_nowait()
+        if not np.allclose(line.y_forward, x, atol=1e-4):
+            raise SystemExit(f"FAILED: the valid frame was not decoded: {line}")
+        print(f"Passed: malformed frame rejected, next line received ({stream.stats})")
+    finally:
+        # stop() waits for the close handshake, which needs the server on this loop
+        await asyncio.to_thread(network.stop)
+        await server.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--timeout", type=float, default=5.0, help="seconds to wait for the valid frame")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.run(check_malformed_frame(args.timeout))
+
+
+if __name__ == '__main__':
+    main()